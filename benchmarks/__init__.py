@@ -0,0 +1 @@
+"""Benchmarks of dosh-core, run them with `python -m benchmarks`."""
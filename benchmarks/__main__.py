@@ -0,0 +1,7 @@
+"""Run the benchmark suite."""
+
+import sys
+
+from benchmarks.runner import main
+
+sys.exit(main())
@@ -0,0 +1,347 @@
+"""Benchmark registry, timing and comparison with the stored baseline."""
+
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Dict, List, Optional, Sequence
+
+__all__ = [
+    "BENCHMARKS",
+    "Benchmark",
+    "Case",
+    "Comparison",
+    "Measurement",
+    "benchmark",
+    "compare_results",
+    "main",
+    "run_benchmarks",
+]
+
+BASELINE_PATH = Path(__file__).parent / "baseline.json"
+DEFAULT_THRESHOLD = 0.25
+RESULT_VERSION = 1
+
+
+@dataclass
+class Case:
+    """
+    A prepared benchmark case.
+
+    `run` may return the amount of work it has done, like copied bytes, to
+    report the throughput. `reset` runs before each call without being
+    timed, for cases changing their input like copying into a new folder.
+    """
+
+    run: Callable[[], Optional[int]]
+    reset: Optional[Callable[[], None]] = None
+
+
+Setup = Callable[[Path, Any], ContextManager[Case]]
+
+
+@dataclass
+class Benchmark:
+    """A benchmark with its parameters."""
+
+    name: str
+    setup: Setup
+    params: Sequence[Any] = (None,)
+    quick_params: Optional[Sequence[Any]] = None
+    number: int = 1
+    unit: Optional[str] = None
+
+    def get_cases(self, quick: bool = False) -> List[Any]:
+        """Get the parameters to run, fewer of them in quick mode."""
+        if quick and self.quick_params is not None:
+            return list(self.quick_params)
+        return list(self.params)
+
+    def get_name(self, param: Any) -> str:
+        """Get the name of the benchmark with its parameter."""
+        return self.name if param is None else f"{self.name}[{param}]"
+
+
+@dataclass
+class Measurement:
+    """Timings of a benchmark in seconds per call."""
+
+    median: float
+    minimum: float
+    maximum: float
+    repeat: int
+    number: int
+    unit: Optional[str] = None
+    throughput: Optional[float] = None
+
+    @classmethod
+    def from_timings(
+        cls,
+        timings: List[float],
+        number: int,
+        work: Optional[int] = None,
+        unit: Optional[str] = None,
+    ) -> Measurement:
+        """Summarize the timings, throughput is the work per second."""
+        median = statistics.median(timings)
+        throughput = None
+        if work is not None and median > 0:
+            throughput = work / median
+        return cls(
+            median=median,
+            minimum=min(timings),
+            maximum=max(timings),
+            repeat=len(timings),
+            number=number,
+            unit=unit,
+            throughput=throughput,
+        )
+
+
+@dataclass
+class Comparison:
+    """Change of a benchmark against the baseline."""
+
+    name: str
+    baseline: Optional[float]
+    current: Optional[float]
+    ratio: Optional[float] = None
+    is_regression: bool = False
+
+
+BENCHMARKS: List[Benchmark] = []
+
+
+def benchmark(
+    name: str,
+    params: Sequence[Any] = (None,),
+    quick_params: Optional[Sequence[Any]] = None,
+    number: int = 1,
+    unit: Optional[str] = None,
+) -> Callable[[Callable[..., Any]], Setup]:
+    """
+    Register a generator function yielding the case as a benchmark.
+
+    The function gets a temporary folder and one of the parameters, the
+    code after `yield` cleans up.
+    """
+
+    def decorator(func: Callable[..., Any]) -> Setup:
+        setup: Setup = contextlib.contextmanager(func)
+        BENCHMARKS.append(Benchmark(name, setup, params, quick_params, number, unit))
+        return setup
+
+    return decorator
+
+
+def _measure(case: Case, number: int, repeat: int) -> List[float]:
+    """Time the case, each timing is the average of `number` calls."""
+    timings = []
+    for _ in range(repeat):
+        elapsed = 0
+        for _ in range(number):
+            if case.reset is not None:
+                case.reset()
+            start = time.perf_counter_ns()
+            case.run()
+            elapsed += time.perf_counter_ns() - start
+        timings.append(elapsed / number / 1e9)
+    return timings
+
+
+def run_benchmarks(
+    selected: Optional[Sequence[str]] = None,
+    quick: bool = False,
+    repeat: int = 5,
+    benchmarks: Optional[Sequence[Benchmark]] = None,
+) -> Dict[str, Measurement]:
+    """Run the benchmarks whose names start with one of `selected`."""
+    results: Dict[str, Measurement] = {}
+    for bench in BENCHMARKS if benchmarks is None else benchmarks:
+        for param in bench.get_cases(quick):
+            name = bench.get_name(param)
+            if selected and not any(name.startswith(item) for item in selected):
+                continue
+
+            with tempfile.TemporaryDirectory(prefix="dosh-bench-") as workdir:
+                with bench.setup(Path(workdir), param) as case:
+                    if case.reset is not None:
+                        case.reset()
+                    work = case.run()  # warm up.
+                    timings = _measure(case, bench.number, repeat)
+
+            results[name] = Measurement.from_timings(
+                timings, bench.number, work, bench.unit
+            )
+            print(_format_measurement(name, results[name]), file=sys.stderr)
+    return results
+
+
+def compare_results(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float
+) -> List[Comparison]:
+    """Compare median timings, slower than `1 + threshold` is a regression."""
+    comparisons = []
+    for name in sorted({*baseline, *current}):
+        old = baseline.get(name, {}).get("median")
+        new = current.get(name, {}).get("median")
+        comparison = Comparison(name, old, new)
+        if old and new is not None:
+            comparison.ratio = new / old
+            comparison.is_regression = comparison.ratio > 1 + threshold
+        comparisons.append(comparison)
+    return comparisons
+
+
+def get_environment() -> Dict[str, str]:
+    """Get the details of the machine, results are comparable on the same one."""
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.lua_runtime import LUA_IMPLEMENTATION
+
+    return {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": str(os.cpu_count()),
+        "lua": LUA_IMPLEMENTATION,
+    }
+
+
+def _format_time(seconds: Optional[float]) -> str:
+    """Format the time with a readable unit."""
+    if seconds is None:
+        return "-"
+    for unit, scale in (("s", 1.0), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def _format_measurement(name: str, measurement: Measurement) -> str:
+    """Format the measurement as a line."""
+    line = (
+        f"{name:<36} {_format_time(measurement.median):>12} "
+        f"(min {_format_time(measurement.minimum)}, "
+        f"max {_format_time(measurement.maximum)})"
+    )
+    if measurement.throughput is not None:
+        line += f"  {measurement.throughput:,.0f} {measurement.unit or 'items'}/s"
+    return line
+
+
+def _format_comparison(comparison: Comparison) -> str:
+    """Format the comparison as a line."""
+    change = "new" if comparison.baseline is None else "removed"
+    if comparison.ratio is not None:
+        change = f"{(comparison.ratio - 1) * 100:+.1f}%"
+    mark = "  REGRESSION" if comparison.is_regression else ""
+    return (
+        f"{comparison.name:<36} {_format_time(comparison.baseline):>12} "
+        f"{_format_time(comparison.current):>12} {change:>9}{mark}"
+    )
+
+
+def _read_results(path: Path) -> Dict[str, Any]:
+    """Read benchmark results of a JSON file."""
+    data: Dict[str, Any] = json.loads(path.read_text(encoding="utf-8"))
+    if data.get("version") != RESULT_VERSION:
+        raise ValueError(f"Unsupported benchmark results: {path}")
+    return data
+
+
+def _write_results(path: Path, results: Dict[str, Measurement]) -> None:
+    """Write benchmark results as a JSON file."""
+    data = {
+        "version": RESULT_VERSION,
+        "environment": get_environment(),
+        "benchmarks": {name: asdict(value) for name, value in results.items()},
+    }
+    path.write_text(json.dumps(data, indent=2) + "\n", encoding="utf-8")
+
+
+def get_parser() -> argparse.ArgumentParser:
+    """Get the argument parser of the benchmark runner."""
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks", description="dosh-core benchmarks"
+    )
+    parser.add_argument("names", nargs="*", help="run benchmarks with these prefixes")
+    parser.add_argument("--quick", action="store_true", help="run smaller cases")
+    parser.add_argument("--repeat", type=int, default=5, help="timings per case")
+    parser.add_argument("--output", type=Path, help="save the results as JSON")
+    parser.add_argument(
+        "--baseline",
+        type=Path,
+        default=BASELINE_PATH,
+        help="compare with these results (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="allowed slowdown ratio (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save the results as the new baseline",
+    )
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmarks, the exit code is 1 if any of them regressed."""
+    args = get_parser().parse_args(argv)
+
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.logger import set_verbosity
+
+    # pylint: disable-next=import-outside-toplevel,unused-import
+    import benchmarks.suite  # noqa: F401
+
+    set_verbosity(0)
+    cache_env = os.environ.get("DOSH_CACHE_DIR")
+    with tempfile.TemporaryDirectory(prefix="dosh-bench-cache-") as cache_dir:
+        os.environ["DOSH_CACHE_DIR"] = cache_dir
+        try:
+            results = run_benchmarks(args.names, quick=args.quick, repeat=args.repeat)
+        finally:
+            if cache_env is None:
+                os.environ.pop("DOSH_CACHE_DIR", None)
+            else:
+                os.environ["DOSH_CACHE_DIR"] = cache_env
+
+    if args.output:
+        _write_results(args.output, results)
+    if args.save_baseline:
+        _write_results(args.baseline, results)
+        return 0
+    if not args.baseline.exists():
+        return 0
+
+    baseline = _read_results(args.baseline)
+    if baseline["environment"] != get_environment():
+        print("The baseline is saved on another environment.", file=sys.stderr)
+
+    current = {name: asdict(value) for name, value in results.items()}
+    comparisons = [
+        comparison
+        for comparison in compare_results(
+            baseline["benchmarks"], current, args.threshold
+        )
+        if comparison.current is not None
+    ]
+    print(f"\n{'BENCHMARK':<36} {'BASELINE':>12} {'CURRENT':>12} {'CHANGE':>9}")
+    for comparison in comparisons:
+        print(_format_comparison(comparison))
+
+    return 1 if any(comparison.is_regression for comparison in comparisons) else 0
@@ -0,0 +1,298 @@
+"""Benchmarks of config parsing, task dispatch and the built-in commands."""
+
+from __future__ import annotations
+
+import functools
+import http.server
+import os
+import shutil
+import subprocess
+import threading
+from logging import INFO, StreamHandler
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+from benchmarks.runner import Case, benchmark
+from dosh_core.batch import evaluate_configs
+from dosh_core.commands import external
+from dosh_core.config import ConfigParser
+from dosh_core.logger import flush_logs, get_log_writer, get_logger
+from dosh_core.lua_modules import get_module_cache
+from dosh_core.lua_runtime import get_lua_runtime
+
+TASK_COUNTS = (10, 100, 1000, 10000)
+
+
+def generate_config(task_count: int) -> str:
+    """Generate a config with the given number of tasks."""
+    tasks = [
+        f"""
+        cmd.add_task{{
+            name="task_{index}",
+            description="task number {index}",
+            required_platforms={{ "linux", "macos", "windows" }},
+            command=function (...)
+                local count = select("#", ...)
+            end
+        }}
+        """
+        for index in range(task_count)
+    ]
+    return 'env.HELP_DESCRIPTION = "benchmark"\n' + "".join(tasks)
+
+
+def create_tree(root: Path, file_count: int, file_size: int, width: int = 50) -> int:
+    """Create files in nested folders, get the total size."""
+    data = bytes(range(256)) * (file_size // 256) + b"x" * (file_size % 256)
+    for index in range(file_count):
+        folder = root / f"dir_{index // width:04}"
+        folder.mkdir(parents=True, exist_ok=True)
+        (folder / f"file_{index:06}.txt").write_bytes(data)
+    return file_count * file_size
+
+
+def _ignore(_: Any) -> None:
+    """Drop the result of a call without a throughput."""
+
+
+def to_options(**options: Any) -> Any:
+    """Convert the options to a Lua table."""
+    return get_lua_runtime().table_from(options)
+
+
+@benchmark(
+    "config_parse", params=TASK_COUNTS, quick_params=TASK_COUNTS[:2], unit="tasks"
+)
+def config_parse(_: Path, task_count: int) -> Iterator[Case]:
+    """Evaluate configs with many tasks."""
+    content = generate_config(task_count)
+    yield Case(lambda: len(ConfigParser(content).tasks))
+
+
+@benchmark("config_modules", params=("cold", "warm"), unit="modules")
+def config_modules(workdir: Path, mode: str) -> Iterator[Case]:
+    """Evaluate a config requiring 50 helper modules, with 20 functions each."""
+    library = workdir / "lib"
+    library.mkdir()
+    functions = "".join(
+        f"function M.helper_{index}(value) return value .. '{index}' end\n"
+        for index in range(20)
+    )
+    for index in range(50):
+        (library / f"module_{index}.lua").write_text(
+            f"local M = {{}}\n{functions}return M\n", encoding="utf-8"
+        )
+    content = "".join(
+        f'local module_{index} = require("lib.module_{index}")\n' for index in range(50)
+    )
+
+    module_cache = get_module_cache()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+
+    def reset() -> None:
+        shutil.rmtree(module_cache.directory, ignore_errors=True)
+        module_cache.clear()
+
+    def run() -> int:
+        with ConfigParser(content):
+            return 50
+
+    try:
+        yield Case(run, reset if mode == "cold" else None)
+    finally:
+        os.chdir(cwd)
+
+
+@benchmark("config_batch", params=("threads", "processes"), unit="configs")
+def config_batch(workdir: Path, mode: str) -> Iterator[Case]:
+    """Evaluate 50 configs with 100 tasks each, without the config cache."""
+    config_paths = []
+    for index in range(50):
+        config_path = workdir / f"dosh_{index}.lua"
+        config_path.write_text(generate_config(100), encoding="utf-8")
+        config_paths.append(config_path)
+
+    def run() -> int:
+        summaries = evaluate_configs(
+            config_paths, use_processes=mode == "processes", use_cache=False
+        )
+        return sum(1 for summary in summaries if summary.error is None)
+
+    yield Case(run)
+
+
+@benchmark("run_task", params=(10, 10000), number=200, unit="tasks")
+def run_task(_: Path, task_count: int) -> Iterator[Case]:
+    """Find and run an empty task, the dispatch overhead of dosh."""
+    parser = ConfigParser(generate_config(task_count))
+    task_name = f"task_{task_count - 1}"
+    yield Case(lambda: 1 if parser.run_task(task_name, ["a", "b"]) else 0)
+
+
+@benchmark("lua_logging", params=("debug", "info"), number=5, unit="messages")
+def lua_logging(_: Path, level: str) -> Iterator[Case]:
+    """Log 1,000 messages from a task, debug messages are disabled."""
+    parser = ConfigParser(
+        f"""
+        cmd.add_task{{
+            name="log",
+            command=function ()
+                for index = 1, 1000 do
+                    cmd.{level}("message %s", index)
+                end
+            end
+        }}
+        """
+    )
+    verbosity = get_logger().level
+    get_logger().setLevel(INFO)
+    with open(os.devnull, "w", encoding="utf-8") as devnull:
+        streams = [
+            (handler, handler.setStream(devnull))
+            for handler in get_log_writer().handlers
+            if isinstance(handler, StreamHandler)
+        ]
+        try:
+            yield Case(lambda: 1000 if parser.run_task("log", []) else 0)
+        finally:
+            flush_logs()
+            get_logger().setLevel(verbosity)
+            for handler, stream in streams:
+                handler.setStream(stream)
+
+
+@benchmark(
+    "cmd_run",
+    params=("shell", "plain", "argv", "capture", "subprocess"),
+    quick_params=("shell", "plain"),
+    number=20,
+)
+def cmd_run(_: Path, mode: str) -> Iterator[Case]:
+    """
+    Run a no-op command, the overhead of each call.
+
+    `shell` forces `/bin/sh`, `plain` and `argv` spawn the program directly,
+    and `subprocess` is the reference of the standard library.
+    """
+    if mode == "subprocess":
+        yield Case(lambda: _ignore(subprocess.run("true", shell=True, check=False)))
+        return
+
+    command: Any = "true"
+    if mode == "argv":
+        command = get_lua_runtime().table_from(["true"])
+    options = to_options(capture=mode == "capture", shell=mode == "shell" or None)
+    yield Case(lambda: _ignore(external.run(command, options)))
+
+
+@benchmark("link_files", params=("native", "shell", "unchanged"), unit="links")
+def link_files(workdir: Path, mode: str) -> Iterator[Case]:
+    """Link 200 dotfiles into a folder, `shell` runs `ln -sf` for each."""
+    src = workdir / "dotfiles"
+    dst = workdir / "home"
+    create_tree(src, 200, 16, width=200)
+    paths = sorted(str(path) for path in src.glob("*/*"))
+    targets = get_lua_runtime().table_from(paths)
+
+    def reset() -> None:
+        shutil.rmtree(dst, ignore_errors=True)
+        dst.mkdir()
+
+    def run() -> int:
+        if mode == "shell":
+            for path in paths:
+                external.run(f"ln -sf {path} {dst}")
+        else:
+            external.link(targets, str(dst))
+        return len(paths)
+
+    if mode == "unchanged":
+        reset()
+        run()
+    yield Case(run, None if mode == "unchanged" else reset)
+
+
+def _copy_case(workdir: Path, file_count: int, file_size: int, fresh: bool) -> Case:
+    """Prepare a copy case, `fresh` copies into an empty folder each time."""
+    src = workdir / "src"
+    dst = workdir / "dst"
+    create_tree(src, file_count, file_size)
+
+    def reset() -> None:
+        shutil.rmtree(dst, ignore_errors=True)
+
+    def run() -> Optional[int]:
+        stats = external.copy(str(src), str(dst))
+        return int(stats["bytes"]) if fresh else None
+
+    return Case(run, reset if fresh else None)
+
+
+@benchmark("copy_small_files", params=("fresh", "unchanged"), unit="bytes")
+def copy_small_files(workdir: Path, mode: str) -> Iterator[Case]:
+    """Copy 2,000 files of 4 KiB."""
+    yield _copy_case(workdir, 2000, 4 * 1024, fresh=mode == "fresh")
+
+
+@benchmark("copy_large_files", params=("fresh", "unchanged"), unit="bytes")
+def copy_large_files(workdir: Path, mode: str) -> Iterator[Case]:
+    """Copy 4 files of 16 MiB."""
+    yield _copy_case(workdir, 4, 16 * 1024 * 1024, fresh=mode == "fresh")
+
+
+@benchmark(
+    "scan_directory",
+    params=("flat", "recursive", "pattern", "iterate"),
+    quick_params=("recursive",),
+    unit="entries",
+)
+def scan_directory(workdir: Path, mode: str) -> Iterator[Case]:
+    """List a folder with 20,000 files in 400 sub folders."""
+    create_tree(workdir, 20000, 0)
+    options = {
+        "flat": to_options(),
+        "recursive": to_options(recursive=True),
+        "pattern": to_options(recursive=True, pattern="**/file_*5.txt"),
+        "iterate": to_options(recursive=True, iterate=True),
+    }[mode]
+
+    def run() -> int:
+        result: Any = external.scan_directory(str(workdir), options)
+        if mode == "iterate":
+            return sum(1 for _ in iter(result, None))
+        return len(result)
+
+    yield Case(run)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    """Serve files without logging the requests."""
+
+    def log_message(self, format: str, *args: Any) -> None:  # noqa: A002
+        """Don't log the requests."""
+
+
+@benchmark("run_url", params=("revalidate", "cached", "stream"), number=10)
+def run_url(workdir: Path, mode: str) -> Iterator[Case]:
+    """Run a script served by a local HTTP server."""
+    (workdir / "script.sh").write_text("exit 0\n", encoding="utf-8")
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(workdir))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = f"http://127.0.0.1:{server.server_address[1]}/script.sh"
+    options = {
+        "revalidate": to_options(),
+        "cached": to_options(max_age=3600),
+        "stream": to_options(stream=True),
+    }[mode]
+
+    try:
+        yield Case(lambda: _ignore(external.run_url(url, options)))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
@@ -1,10 +1,39 @@
 """DOSH module."""
 
-import importlib.metadata
+import functools
+import os
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any
 
-__version__ = importlib.metadata.version(__package__ or __name__)
+
+@functools.lru_cache(maxsize=None)
+def get_version() -> str:
+    """Get the installed version of dosh-core."""
+    # importlib.metadata is slow to import, it's loaded only when it's needed.
+    import importlib.metadata  # pylint: disable=import-outside-toplevel
+
+    return importlib.metadata.version(__package__ or __name__)
+
+
+def __getattr__(name: str) -> Any:
+    """Compute `__version__` on the first access."""
+    if name == "__version__":
+        return get_version()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _get_cache_directory() -> Path:
+    """Get the directory for dosh caches, honoring `DOSH_CACHE_DIR`."""
+    cache_dir = os.getenv("DOSH_CACHE_DIR")
+    if cache_dir:
+        return Path(cache_dir).expanduser()
+
+    base_dir = os.getenv("XDG_CACHE_HOME") or os.getenv("LOCALAPPDATA")
+    if base_dir:
+        return Path(base_dir).expanduser() / "dosh"
+
+    return Path.home() / ".cache" / "dosh"
 
 
 @dataclass
@@ -13,3 +42,4 @@ class DoshInitializer:  # pylint: disable=too-few-public-methods
 
     base_directory: Path = field(default_factory=Path.cwd)
     config_path: Path = field(default_factory=lambda: Path.cwd() / "dosh.lua")
+    cache_directory: Path = field(default_factory=_get_cache_directory)
@@ -0,0 +1,344 @@
+"""Content-addressed cache of task outputs."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import platform
+import shutil
+import stat
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from dosh_core import DoshInitializer
+from dosh_core.commands.base import Task, hash_file
+from dosh_core.fingerprints import expand_paths
+from dosh_core.logger import get_logger
+from dosh_core.lua_runtime import CHUNK_NAME, LUA_IMPLEMENTATION, get_lua_runtime
+
+__all__ = [
+    "ArtifactCache",
+    "CacheStats",
+    "get_artifact_cache",
+    "get_command_hash",
+    "get_command_source",
+]
+
+logger = get_logger()
+
+_stats_lock = threading.Lock()
+
+# bump when the key or the manifest format changes.
+CACHE_FORMAT = 2
+DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+# blobs younger than this are not collected, they may belong to an entry
+# being stored by another process sharing the cache.
+BLOB_GRACE_PERIOD = 600
+
+SOURCE_CODE = """
+function (func)
+    local info = debug.getinfo(func, "S")
+    return info.source, info.linedefined, info.lastlinedefined
+end
+"""
+
+
+@dataclass
+class CacheStats:
+    """Counters of the artifact cache."""
+
+    hits: int = 0
+    misses: int = 0
+    stores: int = 0
+    evictions: int = 0
+    entries: int = 0
+    size: int = 0
+
+
+def get_command_source(task: Task, content: str) -> str:
+    """
+    Get the Lua source of the task command.
+
+    It's the lines of the function in the config, or in the module defining
+    it. It must be called with the Lua runtime of the config.
+    """
+    if get_lua_runtime().eval("type")(task.command) != "function":
+        return ""
+
+    info = get_lua_runtime().eval(SOURCE_CODE)(task.command)
+    source: str = info[0]
+    first_line, last_line = info[1:]
+    if source == CHUNK_NAME:
+        lines = content.splitlines()
+    elif source.startswith("@"):
+        try:
+            lines = Path(source[1:]).read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return source
+    else:
+        return source
+    return "\n".join(lines[first_line - 1 : last_line])
+
+
+def get_command_hash(task: Task, content: str) -> str:
+    """Get the checksum of the task command source, see `get_command_source`."""
+    source = get_command_source(task, content)
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
+
+
+def _get_relative_path(path: Path) -> str:
+    """Get the path relative to the base directory, so checkouts share keys."""
+    try:
+        return path.relative_to(DoshInitializer().base_directory).as_posix()
+    except ValueError:
+        return str(path)
+
+
+class ArtifactCache:
+    """
+    Store task outputs by a key of everything the task depends on.
+
+    The key is made of the input checksums, the Lua source of the command,
+    the parameters and the selected environment variables. Files are stored
+    once per content under `blobs/`, and `entries/` has a manifest per key.
+    Paths in manifests are relative to the base directory, so the cache can
+    be shared by checkouts or machines. Outputs are restored as hard links
+    of read-only blobs, or copies if links are not possible. The least
+    recently used entries are evicted when the total size exceeds
+    `max_size` bytes.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """Initialize the cache in the directory."""
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def stats_path(self) -> Path:
+        """Get the path of the hit and miss counters."""
+        return self.directory / "stats.json"
+
+    def get_blob_path(self, blob: str) -> Path:
+        """Get the path of the stored file."""
+        return self.directory / "blobs" / blob[:2] / blob
+
+    def get_entry_path(self, key: str) -> Path:
+        """Get the path of the manifest of the key."""
+        return self.directory / "entries" / f"{key}.json"
+
+    def get_key(self, task: Task, params: List[str], command_hash: str) -> str:
+        """Get the key of the task run, see `get_command_hash`."""
+        inputs = {
+            _get_relative_path(path): hash_file(path)
+            for path in expand_paths(task.inputs)
+        }
+        data = {
+            "format": CACHE_FORMAT,
+            "task": task.name,
+            "params": params,
+            "command": command_hash,
+            "lua": LUA_IMPLEMENTATION,
+            "platform": [platform.system(), platform.machine()],
+            "inputs": inputs,
+            "outputs": task.outputs,
+            "env": {name: os.getenv(name) for name in sorted(task.cache_env)},
+        }
+        encoded = json.dumps(data, sort_keys=True).encode()
+        return hashlib.sha256(encoded).hexdigest()
+
+    def restore(self, key: str) -> bool:
+        """Restore the outputs of the key, it's a miss if they're not stored."""
+        entry_path = self.get_entry_path(key)
+        try:
+            manifest = json.loads(entry_path.read_text(encoding="utf-8"))
+            files: Dict[str, str] = manifest["files"]
+            for relative_path, blob in files.items():
+                self._restore_file(self.get_blob_path(blob), relative_path)
+        except FileNotFoundError:
+            self._count("misses")
+            return False
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            logger.debug("[ARTIFACT] `%s` can't be restored: %s", key, exc)
+            self._count("misses")
+            return False
+
+        # the modification time of the manifest is the last use.
+        os.utime(entry_path)
+        self._count("hits")
+        return True
+
+    def store(self, key: str, task: Task) -> bool:
+        """Store the outputs of a successful run."""
+        files: Dict[str, str] = {}
+        size = 0
+        for path in expand_paths(task.outputs):
+            relative_path = _get_relative_path(path)
+            if Path(relative_path).is_absolute():
+                logger.debug("[ARTIFACT] `%s` is outside, not cached.", path)
+                return False
+            files[relative_path], file_size = self._store_blob(path)
+            size += file_size
+
+        if not files:
+            return False
+
+        manifest = {"task": task.name, "size": size, "files": files}
+        self._write_json(self.get_entry_path(key), manifest)
+        self._count("stores")
+        self.evict(keep=key)
+        return True
+
+    def prepare_outputs(self, task: Task) -> None:
+        """Replace restored links of the outputs with copies before a run."""
+        for path in expand_paths(task.outputs):
+            file_stat = path.stat()
+            if file_stat.st_nlink > 1 and not file_stat.st_mode & stat.S_IWUSR:
+                mode = stat.S_IMODE(file_stat.st_mode) | stat.S_IWUSR
+                self._copy_file(path, path, mode)
+
+    def evict(self, keep: Optional[str] = None) -> int:
+        """Remove the least recently used entries until the cache fits."""
+        entries = []
+        for entry_path in (self.directory / "entries").glob("*.json"):
+            try:
+                manifest = json.loads(entry_path.read_text(encoding="utf-8"))
+                entries.append((entry_path.stat().st_mtime, entry_path, manifest))
+            except (OSError, ValueError):
+                continue
+
+        total_size = sum(manifest.get("size", 0) for _, _, manifest in entries)
+        evicted = 0
+        blobs: Set[str] = set()
+        for _, entry_path, manifest in sorted(entries, key=lambda e: e[0]):
+            if total_size > self.max_size and entry_path.stem != keep:
+                logger.debug("[ARTIFACT] evict %s", entry_path.stem)
+                entry_path.unlink(missing_ok=True)
+                total_size -= manifest.get("size", 0)
+                evicted += 1
+            else:
+                blobs.update(manifest.get("files", {}).values())
+
+        if evicted:
+            self._collect_blobs(blobs)
+            self._count("evictions", evicted)
+        return evicted
+
+    def get_stats(self) -> CacheStats:
+        """Get the counters, with the number of entries and their size."""
+        stats = self._load_stats()
+        for entry_path in (self.directory / "entries").glob("*.json"):
+            try:
+                manifest = json.loads(entry_path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            stats.entries += 1
+            stats.size += manifest.get("size", 0)
+        return stats
+
+    def _store_blob(self, path: Path) -> Tuple[str, int]:
+        """Store the file by its checksum and executable bit."""
+        mode = path.stat().st_mode
+        is_executable = bool(mode & stat.S_IXUSR)
+        blob = hash_file(path) + ("x" if is_executable else "")
+        blob_path = self.get_blob_path(blob)
+        if blob_path.exists():
+            os.utime(blob_path)
+        else:
+            blob_path.parent.mkdir(parents=True, exist_ok=True)
+            self._copy_file(path, blob_path, 0o555 if is_executable else 0o444)
+        return blob, blob_path.stat().st_size
+
+    def _restore_file(self, blob_path: Path, relative_path: str) -> None:
+        """Link the blob to the output path, or copy it."""
+        path = DoshInitializer().base_directory / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.dosh-tmp")
+        tmp_path.unlink(missing_ok=True)
+        try:
+            os.link(blob_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError:
+            tmp_path.unlink(missing_ok=True)
+            mode = stat.S_IMODE(blob_path.stat().st_mode) | stat.S_IWUSR
+            self._copy_file(blob_path, path, mode)
+
+    @staticmethod
+    def _copy_file(src: Path, dst: Path, mode: int) -> None:
+        """Copy the file atomically with the mode."""
+        with tempfile.NamedTemporaryFile(dir=dst.parent, delete=False) as tmp_file:
+            try:
+                with src.open("rb") as src_file:
+                    shutil.copyfileobj(src_file, tmp_file)
+                os.chmod(tmp_file.name, mode)
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+        os.replace(tmp_file.name, dst)
+
+    def _collect_blobs(self, blobs: Set[str]) -> None:
+        """Remove the blobs that no entry uses."""
+        deadline = time.time() - BLOB_GRACE_PERIOD
+        for blob_path in (self.directory / "blobs").glob("*/*"):
+            if blob_path.name in blobs:
+                continue
+            try:
+                if blob_path.stat().st_mtime < deadline:
+                    blob_path.unlink()
+            except OSError:
+                continue
+
+    def _count(self, name: str, count: int = 1) -> None:
+        """Increase a counter, cache errors are not fatal."""
+        try:
+            with _stats_lock:
+                stats = self._load_stats()
+                setattr(stats, name, getattr(stats, name) + count)
+                counters = asdict(stats)
+                del counters["entries"], counters["size"]
+                self._write_json(self.stats_path, counters)
+        except OSError as exc:
+            logger.debug("Artifact stats couldn't be written: %s", exc)
+
+    def _load_stats(self) -> CacheStats:
+        """Load the counters, broken counters are reset."""
+        try:
+            data = json.loads(self.stats_path.read_text(encoding="utf-8"))
+            return CacheStats(**data)
+        except FileNotFoundError:
+            return CacheStats()
+        except (OSError, ValueError, TypeError) as exc:
+            logger.debug("Artifact stats `%s` are ignored: %s", self.stats_path, exc)
+            return CacheStats()
+
+    @staticmethod
+    def _write_json(path: Path, data: Any) -> None:
+        """Write the JSON file atomically."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            "w", dir=path.parent, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_file.name, path)
+
+
+def get_artifact_cache() -> ArtifactCache:
+    """
+    Get the artifact cache of dosh.
+
+    `DOSH_ARTIFACT_CACHE` sets a folder shared by checkouts or machines, and
+    `DOSH_ARTIFACT_MAX_SIZE` its size limit in bytes.
+    """
+    directory = os.getenv("DOSH_ARTIFACT_CACHE")
+    max_size = os.getenv("DOSH_ARTIFACT_MAX_SIZE")
+    return ArtifactCache(
+        Path(directory).expanduser()
+        if directory
+        else DoshInitializer().cache_directory / "artifacts",
+        int(max_size) if max_size else DEFAULT_MAX_SIZE,
+    )
@@ -0,0 +1,82 @@
+"""Evaluate many configs concurrently and collect their task lists."""
+
+from __future__ import annotations
+
+import concurrent.futures
+import functools
+import os
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from dosh_core.config import ConfigParser
+from dosh_core.logger import get_logger
+
+__all__ = ["ConfigSummary", "evaluate_config", "evaluate_configs"]
+
+logger = get_logger()
+
+
+@dataclass
+class ConfigSummary:
+    """Help texts and task arguments of an evaluated config."""
+
+    config_path: Path
+    description: str = ""
+    epilog: str = ""
+    tasks: List[Dict[str, Any]] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def task_names(self) -> List[str]:
+        """Get names of the tasks."""
+        return [task["name"] for task in self.tasks]
+
+
+def evaluate_config(config_path: Path, use_cache: bool = True) -> ConfigSummary:
+    """
+    Evaluate the config and summarize it without its Lua objects.
+
+    The parser is closed before returning, so its runtime goes back to the
+    pool. Errors of the config are returned in the summary.
+    """
+    try:
+        with ConfigParser.from_file(config_path, use_cache=use_cache) as parser:
+            return ConfigSummary(
+                config_path=config_path,
+                description=parser.description,
+                epilog=parser.epilog,
+                tasks=parser.get_task_metadata(),
+            )
+    except Exception as exc:  # pylint: disable=broad-except
+        logger.debug("Config can't be evaluated: %s: %s", config_path, exc)
+        return ConfigSummary(config_path=config_path, error=str(exc))
+
+
+def evaluate_configs(
+    config_paths: Iterable[Path],
+    jobs: Optional[int] = None,
+    use_processes: bool = False,
+    use_cache: bool = True,
+) -> Iterator[ConfigSummary]:
+    """
+    Evaluate the configs concurrently and yield summaries in the same order.
+
+    Configs run in up to `jobs` threads, each with a Lua runtime of the pool,
+    or in processes if `use_processes` is set, which also isolates configs
+    changing the process state. Only the summaries are kept, so the memory
+    doesn't grow with the number of configs.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    executor: concurrent.futures.Executor
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs, thread_name_prefix="dosh-config"
+        )
+
+    with executor:
+        yield from executor.map(
+            functools.partial(evaluate_config, use_cache=use_cache), config_paths
+        )
@@ -0,0 +1,127 @@
+"""Thin client of the dosh daemon, it only depends on the standard library."""
+
+from __future__ import annotations
+
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from dosh_core import DoshInitializer
+
+__all__ = ["get_socket_path", "receive_message", "run_task", "send_message"]
+
+HEADER = struct.Struct("!I")
+
+# environment variables changing the evaluation of configs.
+CONFIG_ENV_NAMES = ("DOSH_ENV", "SHELL", "LOGNAME", "USER", "LNAME", "USERNAME")
+
+
+def get_socket_path() -> Path:
+    """Get the socket path of the daemon, honoring `DOSH_DAEMON_SOCKET`."""
+    socket_path = os.getenv("DOSH_DAEMON_SOCKET")
+    if socket_path:
+        return Path(socket_path).expanduser()
+    return DoshInitializer().cache_directory / "daemon.sock"
+
+
+def send_message(sock: socket.socket, message: Dict[str, Any]) -> None:
+    """Send the message as JSON with its length."""
+    data = json.dumps(message).encode("utf-8")
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def receive_message(sock: socket.socket) -> Optional[Dict[str, Any]]:
+    """Receive a message, None if the connection is closed."""
+    header = _receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+
+    data = _receive_exactly(sock, HEADER.unpack(header)[0])
+    if data is None:
+        return None
+
+    message: Dict[str, Any] = json.loads(data.decode("utf-8"))
+    return message
+
+
+def _receive_exactly(sock: socket.socket, size: int) -> Optional[bytes]:
+    """Receive the given number of bytes."""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def run_task(
+    config_path: Path,
+    task_name: str,
+    params: List[str],
+    jobs: int = 1,
+    force: bool = False,
+    explain: bool = False,
+    verbosity: int = 0,
+    socket_path: Optional[Path] = None,
+    fds: Sequence[int] = (0, 1, 2),
+) -> Optional[int]:
+    """
+    Run the task in the daemon and return its exit code.
+
+    The daemon uses the current directory, environment variables and the
+    standard streams of the client. None means the daemon is not available
+    or can't run the task for this client, the task should run locally.
+    """
+    if not hasattr(socket, "AF_UNIX") or not hasattr(socket, "send_fds"):
+        return None
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(str(socket_path or get_socket_path()))
+        except OSError:
+            return None
+
+        socket.send_fds(sock, [b"\0"], list(fds))
+        send_message(
+            sock,
+            {
+                "config_path": str(config_path.absolute()),
+                "task_name": task_name,
+                "params": params,
+                "jobs": jobs,
+                "force": force,
+                "explain": explain,
+                "verbosity": verbosity,
+                "cwd": os.getcwd(),
+                "env": dict(os.environ),
+            },
+        )
+
+        pid = None
+        while True:
+            try:
+                message = receive_message(sock)
+            except KeyboardInterrupt:
+                if pid is not None:
+                    os.kill(pid, signal.SIGINT)
+                continue
+
+            if message is None:
+                print("dosh daemon closed the connection.", file=sys.stderr)
+                return 1
+            if "pid" in message:
+                pid = message["pid"]
+            elif "exit_code" in message:
+                exit_code: int = message["exit_code"]
+                return exit_code
+            elif message.get("fallback"):
+                return None
+            else:
+                print(message.get("error"), file=sys.stderr)
+                return 1
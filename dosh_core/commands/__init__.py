@@ -1,32 +1,64 @@
 """Available commands for `dosh.star`."""
 
-from typing import Final
+from logging import DEBUG, ERROR, INFO, WARNING
+from typing import Any, Callable, Dict, Final
 
 from dosh_core.commands import external as cmd
-from dosh_core.logger import get_logger
+from dosh_core.commands.packages import after_installs
+from dosh_core.logger import get_lua_log_function
+from dosh_core.tracing import traced
 
 __all__ = ["COMMANDS"]
 
-logger = get_logger()
-
-
-COMMANDS: Final = {
+COMMANDS: Final[Dict[str, Callable[..., Any]]] = {
     # general purpose
     "clone": cmd.clone,
+    "download": cmd.download,
     "ls": cmd.scan_directory,
     "run": cmd.run,
     "run_url": cmd.run_url,
+    "spawn": cmd.spawn,
+    "wait": cmd.wait,
+    "wait_all": cmd.wait_all,
+    "kill": cmd.kill,
     # package managers
     "apt_install": cmd.apt_install,
     "brew_install": cmd.brew_install,
     "winget_install": cmd.winget_install,
     # file system
+    "chmod": cmd.chmod,
     "copy": cmd.copy,
     "exists": cmd.exists,
     "exists_command": cmd.exists_command,
-    # logging
-    "debug": logger.debug,
-    "info": logger.info,
-    "warning": logger.warning,
-    "error": logger.error,
+    "link": cmd.link,
+    "mkdir": cmd.mkdir,
+    "move": cmd.move,
+    "remove": cmd.remove,
+    "write_file": cmd.write_file,
 }
+
+# installs queued in a task are merged until another command runs, which
+# may use the packages.
+INSTALL_COMMANDS = ("apt_install", "brew_install", "winget_install")
+COMMANDS.update(
+    {
+        name: after_installs(command)
+        for name, command in COMMANDS.items()
+        if name not in INSTALL_COMMANDS
+    }
+)
+
+# calls are recorded as spans when profiling is enabled.
+COMMANDS.update(
+    {name: traced(f"cmd.{name}")(command) for name, command in COMMANDS.items()}
+)
+
+COMMANDS.update(
+    {
+        # logging
+        "debug": get_lua_log_function(DEBUG),
+        "info": get_lua_log_function(INFO),
+        "warning": get_lua_log_function(WARNING),
+        "error": get_lua_log_function(ERROR),
+    }
+)
@@ -2,22 +2,41 @@
 
 from __future__ import annotations
 
+import errno
 import functools
+import hashlib
+import io
+import os
 import platform
-import shutil
+import shlex
+import signal
 import subprocess
+import sys
 from dataclasses import dataclass, field
 from enum import Enum
 from pathlib import Path
-from typing import Any, Callable, Dict, List, TypeVar
+from typing import Any, Callable, Dict, List, Optional, TypeVar, Union
 from urllib.parse import urlparse
 
 from dosh_core import DoshInitializer
-from dosh_core.logger import get_logger
+from dosh_core.commands.resolver import which
+from dosh_core.logger import flush_logs, get_logger
 from dosh_core.lua_runtime import LuaFunction
 
 T = TypeVar("T")
 
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# characters interpreted by the shell, commands with them run in the shell.
+SHELL_CHARACTERS = frozenset("|&;<>()$`\\*?[]{}#~!%\n")
+
+# python ignores these signals, children get the defaults like subprocess.
+RESTORED_SIGNALS = tuple(
+    getattr(signal, name) for name in ("SIGPIPE", "SIGXFSZ") if hasattr(signal, name)
+)
+
+Command = Union[str, List[str]]
+
 logger = get_logger()
 
 
@@ -63,6 +82,13 @@ class Task:
     environments: List[str] = field(default_factory=list)
     required_commands: List[str] = field(default_factory=list)
     required_platforms: List[str] = field(default_factory=list)
+    depends_on: List[str] = field(default_factory=list)
+    inputs: List[str] = field(default_factory=list)
+    outputs: List[str] = field(default_factory=list)
+    hash_inputs: bool = False
+    cache: bool = False
+    cache_env: List[str] = field(default_factory=list)
+    watch: List[str] = field(default_factory=list)
 
     @classmethod
     def from_dict(cls, args: Dict[str, Any]) -> Task:
@@ -78,7 +104,7 @@ def check_command(
     def decorator(func: CommandCallable) -> CommandCallable:
         @functools.wraps(func)
         def wrapper(*args: Any, **kwargs: Any) -> Any:
-            if shutil.which(command_name) is None:
+            if which(command_name) is None:
                 raise CommandException(
                     f"The command `{command_name}` doesn't exist in this system."
                 )
@@ -103,19 +129,141 @@ def normalize_path(file_path: str) -> Path:
     return path
 
 
-def copy_tree(src: Path, dst: Path) -> None:
-    """Copy file or directory to destination."""
-    if src.is_dir():
-        logger.info("COPY DIR: %s -> %s", src, dst)
-        shutil.copytree(src, dst, dirs_exist_ok=True)
+def hash_file(path: Path) -> str:
+    """Get sha256 checksum of the file."""
+    checksum = hashlib.sha256()
+    with path.open("rb") as file:
+        for block in iter(lambda: file.read(1024 * 1024), b""):
+            checksum.update(block)
+    return checksum.hexdigest()
+
+
+def join_args(args: List[str]) -> str:
+    """Join the arguments into a shell command."""
+    if os.name == "nt":
+        return subprocess.list2cmdline(args)
+    return shlex.join(args)
+
+
+def get_command_args(
+    command: Command, shell: Optional[bool] = None
+) -> Optional[List[str]]:
+    """
+    Get the arguments to run the command without the shell.
+
+    Lists are run directly, and strings too if they don't use any shell
+    feature, like pipes, variables, globs or redirections. `shell` forces
+    either way. None is returned for the shell, also if the program doesn't
+    exist, so errors and return codes are the same as the shell's.
+    """
+    if shell:
+        return None
+
+    if isinstance(command, str):
+        if shell is None and SHELL_CHARACTERS.intersection(command):
+            return None
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            return None
+        # `NAME=value program` sets a variable in the shell.
+        if shell is None and args and "=" in args[0]:
+            return None
     else:
-        logger.info("COPY FILE: %s -> %s", src, dst)
-        shutil.copy(src, dst)
+        args = command
+
+    if not args or which(args[0]) is None:
+        return None
+    return args
+
+
+def run_args(args: List[str]) -> Optional[int]:
+    """
+    Run the program and wait for it, None if it's not executable.
+
+    Signals are returned as the shell does, 128 + the signal number.
+    """
+    executable = which(args[0])
+    if executable is None:
+        return None
+    if not hasattr(os, "posix_spawn"):
+        return subprocess.run([executable, *args[1:]]).returncode
+
+    try:
+        # the bytes environment is passed as it is, without decoding it.
+        pid = os.posix_spawn(executable, args, os.environb, setsigdef=RESTORED_SIGNALS)
+    except OSError as exc:
+        # scripts without a shebang are run by the shell.
+        if exc.errno == errno.ENOEXEC:
+            return None
+        raise
+
+    try:
+        _, status = os.waitpid(pid, 0)
+    except BaseException:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        raise
+
+    return_code = os.waitstatus_to_exitcode(status)
+    return 128 - return_code if return_code < 0 else return_code
+
+
+def run_command_and_return_result(
+    command: Command, log_prefix: str = "", shell: Optional[bool] = None
+) -> int:
+    """
+    Run external command and return its return code.
+
+    Plain commands and argument lists are spawned directly, which saves
+    starting the shell for each command. See `get_command_args`.
+    """
+    flush_logs()
+    args = get_command_args(command, shell)
+    return_code = None if args is None else run_args(args)
+    if return_code is None:
+        content = command if isinstance(command, str) else join_args(command)
+        return_code = subprocess.run(content, shell=True).returncode
+    logger.debug("%s Return code: %s".strip(), log_prefix, return_code)
+    return return_code
+
 
+def get_interpreter_args(interpreter: str) -> List[str]:
+    """Split the interpreter command and find its executable."""
+    args = shlex.split(interpreter)
+    if not args:
+        raise CommandException("Interpreter is not specified.")
+
+    executable: Optional[str] = which(args[0])
+    if executable is None and args[0] in ("python", "python3"):
+        executable = sys.executable
+    if executable is None:
+        raise CommandException(f"Interpreter is not found: {args[0]}")
+
+    return [executable, *args[1:]]
+
+
+def run_stream_and_return_result(
+    stream: io.BufferedIOBase, args: List[str], log_prefix: str = ""
+) -> int:
+    """
+    Pipe the stream into stdin of the interpreter and return its result.
+
+    Chunks are written as soon as they are read, so the interpreter starts
+    running before the stream ends.
+    """
+    flush_logs()
+    with subprocess.Popen(args, stdin=subprocess.PIPE) as process:
+        assert process.stdin is not None
+        try:
+            for chunk in iter(lambda: stream.read1(STREAM_CHUNK_SIZE), b""):
+                process.stdin.write(chunk)
+                process.stdin.flush()
+            process.stdin.close()
+        except BrokenPipeError:
+            # the interpreter exited without reading the whole script.
+            pass
+        return_code = process.wait()
 
-def run_command_and_return_result(content: str, log_prefix: str = "") -> int:
-    """Run external command and return result with the captured output."""
-    result = subprocess.run(content, shell=True)
-    return_code = result.returncode
     logger.debug("%s Return code: %s".strip(), log_prefix, return_code)
     return return_code
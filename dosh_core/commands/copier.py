@@ -0,0 +1,168 @@
+"""Incremental file copier, unchanged files are skipped."""
+
+from __future__ import annotations
+
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from dosh_core.commands.base import hash_file
+from dosh_core.logger import get_logger
+
+__all__ = ["CopyStats", "FileCopier", "copy_file_data"]
+
+logger = get_logger()
+
+CHUNK_SIZE = 1024 * 1024
+
+# errors meaning the fast path is not supported for the files.
+_FALLBACK_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.ENOTSUP,
+    errno.EOPNOTSUPP,
+    errno.ETXTBSY,
+    errno.ENOTSOCK,
+}
+
+
+@dataclass
+class CopyStats:
+    """Counters of a copy operation."""
+
+    copied: int = 0
+    skipped: int = 0
+    bytes: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        """Convert the counters to a dictionary."""
+        return asdict(self)
+
+
+class FileCopier:
+    """
+    Copy files like `rsync`, with a thread pool for many files.
+
+    A file is skipped if the destination has the same size and modification
+    time. If `use_hash` is set, files with the same size but a different
+    modification time are compared by their checksums before copying.
+    """
+
+    def __init__(self, jobs: Optional[int] = None, use_hash: bool = False) -> None:
+        """Initialize the copier, `jobs` defaults to the thread pool default."""
+        self.jobs = jobs
+        self.use_hash = use_hash
+        self.stats = CopyStats()
+        self._lock = threading.Lock()
+
+    def copy(self, pairs: List[Tuple[Path, Path]]) -> CopyStats:
+        """Copy the files or directories to their destinations."""
+        files: List[Tuple[Path, Path]] = []
+        for src, dst in pairs:
+            if src.is_dir():
+                logger.info("COPY DIR: %s -> %s", src, dst)
+                files.extend(self._walk(src, dst))
+            else:
+                logger.info("COPY FILE: %s -> %s", src, dst)
+                files.append((src, dst))
+
+        if len(files) < 2 or self.jobs == 1:
+            for src, dst in files:
+                self._copy_file(src, dst)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=self.jobs, thread_name_prefix="dosh-copy"
+            ) as executor:
+                # consume results to raise the first error.
+                list(executor.map(lambda pair: self._copy_file(*pair), files))
+
+        return self.stats
+
+    @staticmethod
+    def _walk(src: Path, dst: Path) -> Iterator[Tuple[Path, Path]]:
+        """Create the directories in the destination and yield the files."""
+        for root, _, file_names in os.walk(src, followlinks=True):
+            relative = Path(root).relative_to(src)
+            (dst / relative).mkdir(parents=True, exist_ok=True)
+            for file_name in file_names:
+                yield Path(root, file_name), dst / relative / file_name
+
+    def _copy_file(self, src: Path, dst: Path) -> None:
+        """Copy the file if the destination is not up to date."""
+        src_stat = src.stat()
+        if self._is_unchanged(src, src_stat, dst):
+            with self._lock:
+                self.stats.skipped += 1
+            return
+
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with src.open("rb") as src_file, dst.open("wb") as dst_file:
+            copy_file_data(src_file, dst_file)
+        shutil.copystat(src, dst)
+
+        with self._lock:
+            self.stats.copied += 1
+            self.stats.bytes += src_stat.st_size
+
+    def _is_unchanged(self, src: Path, src_stat: os.stat_result, dst: Path) -> bool:
+        """Compare the file with its destination."""
+        try:
+            dst_stat = dst.stat()
+        except FileNotFoundError:
+            return False
+
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+            return True
+        if not self.use_hash or hash_file(src) != hash_file(dst):
+            return False
+
+        # the content is the same, keep the modification time for next runs.
+        shutil.copystat(src, dst)
+        return True
+
+
+def copy_file_data(src_file: BinaryIO, dst_file: BinaryIO) -> None:
+    """
+    Copy the file content with the fastest available system call.
+
+    `copy_file_range` lets the file system share or copy blocks in the
+    kernel, `sendfile` copies in the kernel, the last resort is a buffered
+    copy in user space. A system call copying nothing at the start falls
+    back too, procfs, sysfs and some FUSE files report themselves empty.
+    """
+    src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+    offset = 0
+
+    for name in ("copy_file_range", "sendfile"):
+        function = getattr(os, name, None)
+        if function is None:
+            continue
+
+        try:
+            while True:
+                if name == "copy_file_range":
+                    sent = function(src_fd, dst_fd, CHUNK_SIZE)
+                else:
+                    sent = function(dst_fd, src_fd, offset, CHUNK_SIZE)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as exc:
+            if exc.errno not in _FALLBACK_ERRNOS or offset > 0:
+                raise
+        else:
+            if offset > 0:
+                return
+
+    src_file.seek(offset)
+    dst_file.seek(offset)
+    shutil.copyfileobj(src_file, dst_file, CHUNK_SIZE)
@@ -0,0 +1,544 @@
+"""Streaming downloads with resume, ranged segments and pooled connections."""
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import http.client
+import json
+import os
+import re
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urljoin, urlsplit
+
+from dosh_core.commands.base import CommandException, hash_file
+from dosh_core.logger import get_logger
+from dosh_core.tracing import get_tracer
+
+__all__ = ["ConnectionPool", "DownloadRequest", "DownloadResult", "Downloader"]
+
+logger = get_logger()
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+MAX_REDIRECTS = 5
+REDIRECT_CODES = frozenset((301, 302, 303, 307, 308))
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+ConnectionKey = Tuple[str, str, int]
+# start, end (exclusive, None if the size is unknown) and downloaded bytes.
+Segment = List[Optional[int]]
+
+
+class _RestartError(Exception):
+    """The server sent the whole file, the partial file must be dropped."""
+
+
+@dataclass
+class DownloadRequest:
+    """URL and destination of a download, with its expected checksum."""
+
+    url: str
+    destination: Path
+    sha256: Optional[str] = None
+
+
+@dataclass
+class DownloadResult:
+    """Result of a finished download."""
+
+    url: str
+    destination: Path
+    size: int = 0
+    sha256: str = ""
+    segments: int = 1
+    resumed: bool = False
+    skipped: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the result to a dictionary for Lua."""
+        result = asdict(self)
+        result["destination"] = str(self.destination)
+        return result
+
+
+class ConnectionPool:
+    """Keep-alive HTTP connections by scheme, host and port, shared by threads."""
+
+    def __init__(self, timeout: float = 30) -> None:
+        """Initialize the pool, connections are opened on demand."""
+        self.timeout = timeout
+        self._idle: Dict[ConnectionKey, List[http.client.HTTPConnection]] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def open(
+        self, method: str, url: str, headers: Optional[Dict[str, str]] = None
+    ) -> Iterator[http.client.HTTPResponse]:
+        """Send the request and release the connection after the block."""
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise CommandException(f"URL is not valid: {url}")
+
+        default_port = 443 if parts.scheme == "https" else 80
+        key = (parts.scheme, parts.hostname, parts.port or default_port)
+        target = parts.path or "/"
+        if parts.query:
+            target = f"{target}?{parts.query}"
+
+        connection, response = self._send(key, method, target, headers or {})
+        try:
+            yield response
+        except BaseException:
+            connection.close()
+            raise
+
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                self._idle.setdefault(key, []).append(connection)
+        else:
+            connection.close()
+
+    def close(self) -> None:
+        """Close the idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _send(
+        self, key: ConnectionKey, method: str, target: str, headers: Dict[str, str]
+    ) -> Tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Send the request, an idle connection closed by the server is retried."""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                connection = idle.pop() if idle else None
+            is_reused = connection is not None
+            if connection is None:
+                connection = self._connect(key)
+
+            try:
+                request_target = target
+                if getattr(connection, "_dosh_proxy", False):
+                    request_target = f"{key[0]}://{key[1]}:{key[2]}{target}"
+                connection.request(method, request_target, headers=headers)
+                return connection, connection.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionError):
+                connection.close()
+                if not is_reused:
+                    raise
+
+    def _connect(self, key: ConnectionKey) -> http.client.HTTPConnection:
+        """Open a connection, through the proxy of the environment if it's set."""
+        scheme, host, port = key
+        connection_class = (
+            http.client.HTTPSConnection
+            if scheme == "https"
+            else http.client.HTTPConnection
+        )
+        proxy = urllib.request.getproxies().get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return connection_class(host, port, timeout=self.timeout)
+
+        proxy_parts = urlsplit(proxy if "://" in proxy else f"http://{proxy}")
+        proxy_host = proxy_parts.hostname or ""
+        if scheme == "https":
+            connection = connection_class(
+                proxy_host, proxy_parts.port or 443, timeout=self.timeout
+            )
+            connection.set_tunnel(host, port)
+            return connection
+
+        connection = http.client.HTTPConnection(
+            proxy_host, proxy_parts.port or 80, timeout=self.timeout
+        )
+        # plain HTTP requests are sent to the proxy with absolute URLs.
+        setattr(connection, "_dosh_proxy", True)
+        return connection
+
+
+class _StreamHasher:
+    """Hash the file in order while its ranges are written in any order."""
+
+    def __init__(self) -> None:
+        """Start from the beginning of the file."""
+        self.checksum = hashlib.sha256()
+        self.offset = 0
+        self._lock = threading.Lock()
+
+    def feed(self, offset: int, data: memoryview) -> None:
+        """Hash the data if it continues the hashed part."""
+        with self._lock:
+            if offset == self.offset:
+                self.checksum.update(data)
+                self.offset += len(data)
+
+    def catch_up(self, path: Path, end: Optional[int] = None) -> None:
+        """Hash the file from the hashed part up to `end`, from the disk."""
+        with self._lock, path.open("rb") as file:
+            file.seek(self.offset)
+            while end is None or self.offset < end:
+                size = CHUNK_SIZE if end is None else min(CHUNK_SIZE, end - self.offset)
+                data = file.read(size)
+                if not data:
+                    break
+                self.checksum.update(data)
+                self.offset += len(data)
+
+
+class Downloader:
+    """
+    Download files to disk with a fixed-size buffer, hashing while writing.
+
+    A download is written to `<destination>.part` and renamed when it's
+    complete and verified, so a partial file resumes with a Range request.
+    Files of `segments * min_segment_size` bytes or more are downloaded in
+    parallel ranged segments if the server supports ranges, and their
+    progress is kept in `<destination>.part.json` to resume them. Many
+    files are downloaded in up to `jobs` threads with pooled connections.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 4,
+        segments: int = DEFAULT_SEGMENTS,
+        min_segment_size: int = MIN_SEGMENT_SIZE,
+        timeout: float = 30,
+    ) -> None:
+        """Initialize the downloader and its connection pool."""
+        self.jobs = jobs
+        self.segments = segments
+        self.min_segment_size = min_segment_size
+        self.pool = ConnectionPool(timeout)
+
+    def download_all(self, requests: Iterable[DownloadRequest]) -> List[DownloadResult]:
+        """Download the files concurrently, errors are raised after all finish."""
+        with ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="dosh-download"
+        ) as executor:
+            futures = [executor.submit(self.download, request) for request in requests]
+
+        results = []
+        errors = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except (OSError, http.client.HTTPException, CommandException) as exc:
+                errors.append(str(exc))
+        if errors:
+            raise CommandException("\n".join(errors))
+        return results
+
+    def download(self, request: DownloadRequest) -> DownloadResult:
+        """Download a file, it's skipped if it exists with the expected checksum."""
+        destination = request.destination
+        expected = None if request.sha256 is None else request.sha256.lower()
+        if expected and destination.is_file() and hash_file(destination) == expected:
+            logger.debug("[DOWNLOAD] `%s` is up to date.", destination)
+            return DownloadResult(
+                request.url,
+                destination,
+                size=destination.stat().st_size,
+                sha256=expected,
+                skipped=True,
+            )
+
+        part_path = destination.with_name(f"{destination.name}.part")
+        state_path = destination.with_name(f"{destination.name}.part.json")
+        destination.parent.mkdir(parents=True, exist_ok=True)
+
+        logger.info("[DOWNLOAD] %s -> %s", request.url, destination)
+        result = DownloadResult(request.url, destination)
+        try:
+            hasher = self._transfer(result, part_path, state_path)
+        except _RestartError:
+            logger.debug("[DOWNLOAD] `%s` is downloaded again.", request.url)
+            part_path.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            result = DownloadResult(request.url, destination)
+            try:
+                hasher = self._transfer(result, part_path, state_path)
+            except _RestartError as exc:
+                raise CommandException(
+                    f"Download failed for {request.url}: "
+                    "the server ignored the range request"
+                ) from exc
+
+        result.sha256 = hasher.checksum.hexdigest()
+        result.size = part_path.stat().st_size
+        if expected and result.sha256 != expected:
+            part_path.unlink(missing_ok=True)
+            state_path.unlink(missing_ok=True)
+            raise CommandException(
+                f"Checksum mismatch for {request.url}: "
+                f"expected {expected}, got {result.sha256}"
+            )
+
+        os.replace(part_path, destination)
+        state_path.unlink(missing_ok=True)
+        get_tracer().annotate(bytes=result.size)
+        return result
+
+    def _transfer(
+        self, result: DownloadResult, part_path: Path, state_path: Path
+    ) -> _StreamHasher:
+        """Download into the partial file and get its checksum."""
+        state = self._load_state(state_path, result.url)
+        if state is not None and len(state["segments"]) > 1:
+            try:
+                is_allocated = part_path.stat().st_size == state["size"]
+            except FileNotFoundError:
+                is_allocated = False
+            if not is_allocated:
+                # the segments can't be continued without their partial file.
+                logger.debug("[DOWNLOAD] `%s` state is dropped.", state_path)
+                part_path.unlink(missing_ok=True)
+                state_path.unlink(missing_ok=True)
+                state = None
+        if state is None and not part_path.exists() and self.segments > 1:
+            state = self._plan_segments(result.url)
+            if state is not None:
+                with part_path.open("wb") as part_file:
+                    part_file.truncate(state["size"])
+
+        hasher = _StreamHasher()
+        if state is None or len(state["segments"]) == 1:
+            self._download_stream(result, part_path, state_path, state, hasher)
+        else:
+            self._download_segments(result, part_path, state_path, state, hasher)
+        hasher.catch_up(part_path)
+        return hasher
+
+    def _download_stream(
+        self,
+        result: DownloadResult,
+        part_path: Path,
+        state_path: Path,
+        state: Optional[Dict[str, Any]],
+        hasher: _StreamHasher,
+    ) -> None:
+        """Download the file in one request, the partial file is continued."""
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = self._get_resume_headers(state) if offset else {}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        with self._request("GET", result.url, headers) as (url, response):
+            if response.status == 416 and state is not None and state["size"] == offset:
+                result.resumed = True
+                hasher.catch_up(part_path)
+                return
+            if offset and response.status != 206:
+                raise _RestartError()
+
+            self._save_state(state_path, result.url, url, response)
+            result.resumed = bool(offset)
+            if offset:
+                hasher.catch_up(part_path, offset)
+            with part_path.open("ab" if offset else "wb") as part_file:
+                self._write_response(response, part_file, offset, hasher)
+
+    def _download_segments(
+        self,
+        result: DownloadResult,
+        part_path: Path,
+        state_path: Path,
+        state: Dict[str, Any],
+        hasher: _StreamHasher,
+    ) -> None:
+        """Download the unfinished segments in parallel."""
+        segments: List[Segment] = state["segments"]
+        result.segments = len(segments)
+        result.resumed = any(segment[2] for segment in segments)
+        headers = self._get_resume_headers(state)
+        lock = threading.Lock()
+
+        def download_segment(segment: Segment) -> None:
+            start, end, done = segment
+            assert start is not None and end is not None and done is not None
+            if start + done >= end:
+                return
+
+            segment_headers = {**headers, "Range": f"bytes={start + done}-{end - 1}"}
+            with self._request("GET", result.url, segment_headers) as (_, response):
+                match = CONTENT_RANGE.fullmatch(response.getheader("Content-Range", ""))
+                if response.status != 206 or match is None:
+                    raise _RestartError()
+                if int(match.group(1)) != start + done:
+                    raise CommandException(f"Unexpected range for {result.url}")
+
+                with part_path.open("r+b") as part_file:
+                    part_file.seek(start + done)
+
+                    def on_write(size: int) -> None:
+                        with lock:
+                            segment[2] = (segment[2] or 0) + size
+
+                    self._write_response(
+                        response, part_file, start + done, hasher, on_write
+                    )
+
+        try:
+            with ThreadPoolExecutor(
+                max_workers=len(segments), thread_name_prefix="dosh-segment"
+            ) as executor:
+                for future in [executor.submit(download_segment, s) for s in segments]:
+                    future.result()
+        finally:
+            with lock:
+                state["segments"] = [list(segment) for segment in segments]
+            self._write_state(state_path, state)
+
+    def _plan_segments(self, url: str) -> Optional[Dict[str, Any]]:
+        """Split the file into segments if it's large and the server has ranges."""
+        try:
+            with self._request("HEAD", url, {}) as (final_url, response):
+                response.read()
+        except CommandException:
+            # servers rejecting HEAD requests are downloaded with GET.
+            return None
+
+        size = int(response.getheader("Content-Length") or 0)
+        if response.status != 200 or response.getheader("Accept-Ranges") != "bytes":
+            return None
+
+        count = min(self.segments, size // self.min_segment_size)
+        if count < 2:
+            return None
+
+        step = -(-size // count)
+        segments: List[Segment] = [
+            [start, min(start + step, size), 0] for start in range(0, size, step)
+        ]
+        return {
+            "url": url,
+            "final_url": final_url,
+            "size": size,
+            "etag": response.getheader("ETag"),
+            "last_modified": response.getheader("Last-Modified"),
+            "segments": segments,
+        }
+
+    @contextlib.contextmanager
+    def _request(
+        self, method: str, url: str, headers: Dict[str, str]
+    ) -> Iterator[Tuple[str, http.client.HTTPResponse]]:
+        """Send the request following redirects, get the final URL and response."""
+        for _ in range(MAX_REDIRECTS + 1):
+            with self.pool.open(method, url, headers) as response:
+                location = response.getheader("Location")
+                if response.status in REDIRECT_CODES and location:
+                    response.read()
+                    url = urljoin(url, location)
+                    continue
+                if response.status >= 400 and response.status != 416:
+                    raise CommandException(
+                        f"Download failed for {url}: "
+                        f"{response.status} {response.reason}"
+                    )
+                yield url, response
+                return
+        raise CommandException(f"Too many redirects for {url}")
+
+    @staticmethod
+    def _write_response(
+        response: http.client.HTTPResponse,
+        file: BinaryIO,
+        offset: int,
+        hasher: _StreamHasher,
+        on_write: Optional[Callable[[int], None]] = None,
+    ) -> None:
+        """
+        Write the response body with a fixed-size buffer.
+
+        `readinto` doesn't raise if the connection is closed early, so a
+        body shorter than its `Content-Length` is checked at the end.
+        """
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        while True:
+            size = response.readinto(buffer)
+            if not size:
+                break
+            data = buffer[:size]
+            file.write(data)
+            hasher.feed(offset, data)
+            offset += size
+            if on_write is not None:
+                on_write(size)
+        if response.length:
+            raise http.client.IncompleteRead(b"", response.length)
+
+    @staticmethod
+    def _get_resume_headers(state: Optional[Dict[str, Any]]) -> Dict[str, str]:
+        """Get the validator, the server sends the whole file if it changed."""
+        if state is None:
+            return {}
+        validator = state.get("etag") or state.get("last_modified")
+        return {"If-Range": validator} if validator else {}
+
+    @staticmethod
+    def _load_state(state_path: Path, url: str) -> Optional[Dict[str, Any]]:
+        """Load the progress of the partial file of the URL."""
+        try:
+            state: Dict[str, Any] = json.loads(state_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return None
+        return state if state.get("url") == url else None
+
+    def _save_state(
+        self,
+        state_path: Path,
+        url: str,
+        final_url: str,
+        response: http.client.HTTPResponse,
+    ) -> None:
+        """
+        Save the validators of a streamed download to resume it safely.
+
+        The state is loaded by the requested URL, `final_url` is the one
+        after redirects.
+        """
+        size = None
+        match = CONTENT_RANGE.fullmatch(response.getheader("Content-Range", ""))
+        if match is not None and match.group(3) != "*":
+            size = int(match.group(3))
+        elif response.status == 200 and response.getheader("Content-Length"):
+            size = int(response.getheader("Content-Length", "0"))
+
+        self._write_state(
+            state_path,
+            {
+                "url": url,
+                "final_url": final_url,
+                "size": size,
+                "etag": response.getheader("ETag"),
+                "last_modified": response.getheader("Last-Modified"),
+                "segments": [[0, size, 0]],
+            },
+        )
+
+    @staticmethod
+    def _write_state(state_path: Path, state: Dict[str, Any]) -> None:
+        """Write the progress file, errors only prevent resuming."""
+        try:
+            state_path.write_text(json.dumps(state), encoding="utf-8")
+        except OSError as exc:
+            logger.debug("Download state `%s` couldn't be written: %s", state_path, exc)
@@ -3,59 +3,95 @@
 from __future__ import annotations
 
 import os
-import shutil
-import urllib.request
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, Callable, Iterator, List, Optional, Tuple, Union
 
+from dosh_core import DoshInitializer
 from dosh_core.commands.base import (
+    Command,
     CommandException,
     check_command,
-    copy_tree,
+    get_interpreter_args,
     is_url_valid,
+    join_args,
     normalize_path,
     run_command_and_return_result,
+    run_stream_and_return_result,
 )
-from dosh_core.logger import get_logger
-from dosh_core.lua_runtime import LuaTable, lua_runtime
+from dosh_core.commands import files
+from dosh_core.commands.copier import FileCopier
+from dosh_core.commands.output import DEFAULT_MAX_OUTPUT, run_and_capture
+from dosh_core.commands.packages import get_package_installer
+from dosh_core.commands.repositories import CloneRequest, RepositoryCloner
+from dosh_core.commands.resolver import which
+from dosh_core.commands.scanner import IgnoreRules, scan_tree
+from dosh_core.logger import flush_logs, get_logger, log_context
+from dosh_core.lua_runtime import LuaTable, get_lua_runtime
+from dosh_core.tracing import get_tracer
+
+if TYPE_CHECKING:
+    from dosh_core.commands.processes import ProcessEngine, ProcessHandle
+
+# modules importing asyncio and urllib.request are imported by the commands
+# using them, so that dosh starts faster.
 
 logger = get_logger()
 
 
-@check_command("apt")
-def apt_install(packages: List[str]) -> None:
-    """Install packages with apt."""
-    command = "apt install"
+def _to_list(packages: Union[LuaTable, List[str]]) -> List[str]:
+    """Convert the Lua table of packages to a list."""
+    if hasattr(packages, "values"):
+        return list(packages.values())
+    return list(packages)
+
 
-    run(f"{command} {' '.join(packages)}")
+@check_command("apt")
+def apt_install(packages: Union[LuaTable, List[str]]) -> None:
+    """Install packages with apt, installed packages are skipped."""
+    get_package_installer().install("apt", _to_list(packages))
 
 
 @check_command("brew")
-def brew_install(packages: LuaTable, options: Optional[LuaTable] = None) -> None:
-    """Install packages with brew."""
+def brew_install(
+    packages: Union[LuaTable, List[str]], options: Optional[LuaTable] = None
+) -> None:
+    """Install packages with brew, installed packages are skipped."""
     if options is None:
-        options = lua_runtime.table()
+        options = get_lua_runtime().table()
 
-    for tap_path in list((options["taps"] or lua_runtime.table()).values()):
-        run(f"brew tap {tap_path}")
+    installer = get_package_installer()
+    taps = list((options["taps"] or get_lua_runtime().table()).values())
+    if taps:
+        installer.flush()
+        tapped = installer.get_taps()
+        for tap_path in taps:
+            if tap_path not in tapped:
+                run(f"brew tap {tap_path}")
+                tapped.add(tap_path)
 
-    command = "brew install"
+    flags = ("--cask",) if options["cask"] is True else ()
+    installer.install("brew", _to_list(packages), flags)
 
-    if options["cask"] is True:
-        command = f"{command} --cask"
 
-    run(f"{command} {' '.join(list(packages.values()))}")
+@check_command("winget")
+def winget_install(packages: Union[LuaTable, List[str]]) -> None:
+    """Install packages with winget, installed packages are skipped."""
+    get_package_installer().install("winget", _to_list(packages))
 
 
-@check_command("winget")
-def winget_install(packages: List[str]) -> None:
-    """Install packages with winget."""
-    command = "winget install -e --id"
-    run(f"{command} {' '.join(packages)}")
+def copy(src: str, dst: str, opts: Optional[LuaTable] = None) -> LuaTable:
+    """
+    Copy files from source to destination. It works like `cp` command.
+
+    Unchanged files, with the same size and modification time, are skipped.
 
+    Optional parameters:
+        hash: boolean (default: false), compare checksums if only mtime differs
+        jobs: number (default: auto), number of threads copying files
 
-def copy(src: str, dst: str) -> None:
-    """Copy files from source to destination. It works like `cp` command."""
+    Returns a table with `copied`, `skipped` and `bytes` counters.
+    """
+    options = opts or get_lua_runtime().table()
     src_path = normalize_path(src)
     dst_path = normalize_path(dst)
     glob_index = -1
@@ -68,88 +104,562 @@ def copy(src: str, dst: str) -> None:
 
     if glob_index >= 0:
         src_path = normalize_path("/".join(src_splitted[:glob_index]))
-        for path in src_path.glob("/".join(src_splitted[glob_index:])):
-            copy_tree(path, dst_path / path.name)
+        pairs = [
+            (path, dst_path / path.name)
+            for path in src_path.glob("/".join(src_splitted[glob_index:]))
+        ]
     else:
-        copy_tree(src_path, dst_path / src_path.name if dst_path.exists() else dst_path)
+        pairs = [
+            (src_path, dst_path / src_path.name if dst_path.exists() else dst_path)
+        ]
+
+    copier = FileCopier(jobs=options["jobs"], use_hash=bool(options["hash"]))
+    stats = copier.copy(pairs)
+    get_tracer().annotate(**stats.to_dict())
+    logger.debug(
+        "[COPY] %s copied, %s skipped, %s bytes",
+        stats.copied,
+        stats.skipped,
+        stats.bytes,
+    )
+    response: LuaTable = get_lua_runtime().table_from(stats.to_dict())
+    return response
 
 
 @check_command("git")
-def clone(url: str, options: Optional[LuaTable] = None) -> None:
-    """Clone repository from VCS."""
-    if options is None:
-        options = lua_runtime.table()
+def clone(urls: Union[str, LuaTable], options: Optional[LuaTable] = None) -> LuaTable:
+    """
+    Clone repositories from VCS.
 
-    destination = normalize_path(
-        options["destination"] or url.rsplit("/", 1)[-1].rsplit(".git", 1)[0]
-    )
+    `urls` is a repository URL or a list of them. List items can also be
+    tables with `url`, `destination` and `branch` fields.
 
-    if destination.exists():
-        logger.info("[CLONE] the folder `%s` already exists. skipped.", destination)
-    else:
-        command = f"git clone {url} {destination}"
-        run(command)
+    Optional parameters:
+        destination: str (default: repository name), for a single URL
+        branch: str (default: remote HEAD)
+        jobs: number (default: 4), number of concurrent clones
+        depth: number (default: full history)
+        filter: str (default: no filter), partial clone filter like `blob:none`
+        mirror: boolean or str (default: false), keep bare mirrors in the cache
+            directory of dosh or in the given directory to clone faster
+        fetch: boolean (default: false), fetch repositories that exist
+
+    Returns a table of return codes by destination.
+    """
+    if options is None:
+        options = get_lua_runtime().table()
+
+    items = [urls] if isinstance(urls, str) else list(urls.values())
+    requests = []
+    for item in items:
+        if isinstance(item, str):
+            url, destination, branch = item, None, None
+        else:
+            url, destination, branch = item["url"], item["destination"], item["branch"]
+        if isinstance(urls, str):
+            destination = options["destination"]
+
+        requests.append(
+            CloneRequest(
+                url=url,
+                destination=normalize_path(
+                    destination or url.rsplit("/", 1)[-1].rsplit(".git", 1)[0]
+                ),
+                branch=branch or options["branch"],
+            )
+        )
+
+    mirror = options["mirror"]
+    mirror_directory = None
+    if isinstance(mirror, str):
+        mirror_directory = normalize_path(mirror)
+    elif mirror:
+        mirror_directory = DoshInitializer().cache_directory / "git"
+
+    get_package_installer().flush()
+    cloner = RepositoryCloner(
+        jobs=options["jobs"] or 4,
+        depth=options["depth"],
+        filter_spec=options["filter"],
+        mirror_directory=mirror_directory,
+        fetch=bool(options["fetch"]),
+    )
+    return_codes = {
+        str(request.destination): request.return_code
+        for request in cloner.clone_all(requests)
+    }
+    for destination, return_code in return_codes.items():
+        if return_code:
+            logger.error("[CLONE] `%s` failed: %s", destination, return_code)
+
+    response: LuaTable = get_lua_runtime().table_from(return_codes)
+    return response
 
 
-def scan_directory(parent_dir: str = ".", opts: Optional[LuaTable] = None) -> LuaTable:
+def scan_directory(
+    parent_dir: str = ".", opts: Optional[LuaTable] = None
+) -> Union[LuaTable, Callable[..., Optional[str]]]:
     """
     List files and directories.
 
     Optional parameters:
         include_files: boolean (default: true)
         include_dirs: boolean (default: true)
-        excludes: list[str] (default: [])
+        excludes: list[str] (default: []), gitignore-style patterns
+        gitignore: boolean (default: false), also exclude `.gitignore` patterns
+        recursive: boolean (default: false)
+        max_depth: number (default: 1, unlimited if recursive)
+        pattern: str (default: all), glob pattern like `*.py` or `src/**/*.lua`
+        iterate: boolean (default: false), return an iterator for `for` loops
+        sort: boolean (default: true, false if iterate)
     """
     parent = normalize_path(parent_dir)
-    options = opts or lua_runtime.table()
+    options = opts or get_lua_runtime().table()
 
     if not parent.is_dir():
         raise CommandException(f"Not a folder: {parent_dir}")
 
-    files, directories = [], []
+    excludes = list((options["excludes"] or get_lua_runtime().table()).values())
+    gitignore_path = parent / ".gitignore"
+    if options["gitignore"] and gitignore_path.is_file():
+        excludes = gitignore_path.read_text(encoding="utf-8").splitlines() + excludes
+
+    max_depth = options["max_depth"]
+    if max_depth is None and not options["recursive"]:
+        max_depth = 1
+
+    items: Iterator[str] = scan_tree(
+        parent,
+        max_depth=max_depth,
+        pattern=options["pattern"],
+        ignore_rules=IgnoreRules(excludes),
+        include_files=options["include_files"] is not False,
+        include_dirs=options["include_dirs"] is not False,
+    )
+
+    is_sorted = options["sort"]
+    if is_sorted is None:
+        is_sorted = not options["iterate"]
+    if is_sorted:
+        items = iter(sorted(items))
 
-    for item in parent.iterdir():
-        if item.is_dir():
-            directories.append(str(item))
-        elif item.is_file():
-            files.append(str(item))
+    if options["iterate"]:
+        return lambda *_: next(items, None)
 
-    items = []
+    response: LuaTable = get_lua_runtime().table_from(list(items))
+    return response
 
-    if options["include_files"] is not False:
-        items.extend(files)
 
-    if options["include_dirs"] is not False:
-        items.extend(directories)
+def run(
+    command: Union[str, LuaTable], opts: Optional[LuaTable] = None
+) -> Union[int, Tuple[int, str, str]]:
+    """
+    Run a command, a string or a table of arguments like `{"git", "status"}`.
 
-    excludes = list((options["excludes"] or lua_runtime.table()).values())
-    if excludes:
-        items = list(filter(lambda i: i.rsplit(os.sep, 1)[-1] not in excludes, items))
+    Tables and strings without shell features, like pipes, variables, globs
+    or redirections, run without the shell.
 
-    response: LuaTable = lua_runtime.table_from(sorted(items))
+    Optional parameters:
+        capture: boolean (default: false), return the code, stdout and stderr
+        max_output: number (default: 1 MiB), last bytes of each stream to keep
+        on_line: function(line, stream) (default: none), called for each line
+        prefix: str (default: none), print the output lines with the prefix
+        shell: boolean (default: only if it's needed), run in the shell
+
+    The output isn't printed if it's captured or passed to `on_line`, unless
+    `prefix` is given.
+    """
+    get_package_installer().flush()
+    options = opts or get_lua_runtime().table()
+    log_prefix = "[RUN]"
+    args: Command
+    if isinstance(command, str):
+        args = command
+    else:
+        args = [str(arg) for arg in command.values()]
+        command = join_args(args)
+
+    with log_context(command=command):
+        logger.info("%s %s", log_prefix, command)
+
+        if not (options["capture"] or options["on_line"] or options["prefix"]):
+            return run_command_and_return_result(args, log_prefix, options["shell"])
+
+        output = run_and_capture(
+            args,
+            max_output=options["max_output"] or DEFAULT_MAX_OUTPUT,
+            on_line=options["on_line"],
+            prefix=options["prefix"],
+            shell=options["shell"],
+        )
+        logger.debug("%s Return code: %s", log_prefix, output.return_code)
+        if output.truncated:
+            logger.debug("%s Output is truncated to the last bytes.", log_prefix)
+
+        if options["capture"]:
+            return output.return_code, output.stdout, output.stderr
+        return output.return_code
+
+
+def _get_process_engine() -> ProcessEngine:
+    """Get the process engine of dosh."""
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.commands.processes import get_process_engine
+
+    return get_process_engine()
+
+
+def spawn(command: str, opts: Optional[LuaTable] = None) -> ProcessHandle:
+    """
+    Run a shell command in the background and return its handle.
+
+    Optional parameters:
+        timeout: number (default: no timeout), kill the process after seconds
+        cwd: str (default: current working directory)
+        env: table (default: {}), extra environment variables
+        prefix: str (default: none), print the output lines with the prefix
+    """
+    options = opts or get_lua_runtime().table()
+    cwd = None if options["cwd"] is None else normalize_path(options["cwd"])
+    env = None
+    if options["env"] is not None:
+        env = {**os.environ, **{k: str(v) for k, v in options["env"].items()}}
+
+    get_package_installer().flush()
+    with log_context(command=command):
+        logger.info("[SPAWN] %s", command)
+    if options["prefix"] is None:
+        flush_logs()
+    return _get_process_engine().spawn(
+        command,
+        cwd=cwd,
+        env=env,
+        timeout=options["timeout"],
+        prefix=options["prefix"],
+    )
+
+
+def wait(handle: ProcessHandle) -> int:
+    """Wait for the spawned command and return its return code."""
+    return _get_process_engine().wait(handle)
+
+
+def wait_all(handles: LuaTable) -> LuaTable:
+    """Wait for all spawned commands and return their return codes."""
+    engine = _get_process_engine()
+    return_codes = [engine.wait(handle) for handle in handles.values()]
+    response: LuaTable = get_lua_runtime().table_from(return_codes)
     return response
 
 
-def run(command: str) -> int:
-    """Run a shell command using subprocess."""
-    log_prefix = "[RUN]"
-    logger.info("%s %s", log_prefix, command)
-    return run_command_and_return_result(command, log_prefix)
+def kill(handle: ProcessHandle) -> None:
+    """Kill the spawned command with its child processes."""
+    logger.info("[KILL] %s", handle.command)
+    _get_process_engine().cancel(handle)
+
 
+def run_url(url: str, opts: Optional[LuaTable] = None) -> int:
+    """
+    Run a remote shell script directly.
+
+    Optional parameters:
+        sha256: str (default: no pin), expected checksum of the script
+        max_age: number (default: 0), seconds to use the cache without a request
+        offline: boolean (default: DOSH_OFFLINE is set), use only the cache
+        interpreter: str (default: shell), run the script with `sh`, `bash`,
+            `python` or another command reading from stdin
+        stream: boolean (default: false), pipe the response into the
+            interpreter while it's downloaded, without the cache
+    """
+    # pylint: disable-next=import-outside-toplevel
+    import urllib.request
+
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.commands.http_cache import get_http_cache
 
-def run_url(url: str) -> int:
-    """Run a remote shell script directly."""
     if not is_url_valid(url):
         raise CommandException(f"URL is not valid: {url}")
 
-    with urllib.request.urlopen(url) as response:
-        content = response.read().decode("utf-8")
-
+    get_package_installer().flush()
+    options = opts or get_lua_runtime().table()
+    offline = bool(options["offline"] or os.getenv("DOSH_OFFLINE"))
+    interpreter = options["interpreter"]
     log_prefix = "[RUN_URL]"
+
+    if options["stream"]:
+        if options["sha256"] or offline:
+            raise CommandException(
+                "Streamed scripts run before they're downloaded, "
+                "sha256 and offline options can't be used with stream."
+            )
+
+        args = get_interpreter_args(interpreter or "sh")
+        logger.info("%s %s", log_prefix, url)
+        with urllib.request.urlopen(url) as response:
+            return run_stream_and_return_result(response, args, log_prefix)
+
+    script_path = get_http_cache().fetch(
+        url,
+        max_age=options["max_age"] or 0,
+        sha256=options["sha256"],
+        offline=offline,
+    )
+
     logger.info("%s %s", log_prefix, url)
+    if interpreter:
+        args = get_interpreter_args(interpreter)
+        with script_path.open("rb") as script_file:
+            return run_stream_and_return_result(script_file, args, log_prefix)
+
+    content = script_path.read_text(encoding="utf-8")
     return run_command_and_return_result(content, log_prefix)
 
 
+def download(
+    urls: Union[str, LuaTable],
+    destination: Optional[str] = None,
+    opts: Optional[LuaTable] = None,
+) -> LuaTable:
+    """
+    Download files, streaming them to disk while they're hashed.
+
+    `urls` is a URL or a list of them. List items can also be tables with
+    `url`, `destination` and `sha256` fields. For a single URL, the
+    destination is the file path, or a folder ending with `/`. For a list,
+    it's the folder of the files (default: current directory). Partial
+    files are resumed, and large files are downloaded in parallel ranges
+    if the server supports them. Files with the expected checksum are skipped.
+
+    Optional parameters:
+        sha256: str (default: no pin), expected checksum for a single URL
+        jobs: number (default: 4), number of concurrent downloads
+        segments: number (default: 4), parallel ranges of a large file
+        min_segment_size: number (default: 8 MiB), smallest range in bytes
+        timeout: number (default: 30), seconds to wait for the server
+
+    Returns the result of a single URL, or a table of results by destination,
+    with `size`, `sha256`, `resumed` and `skipped` fields.
+    """
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.commands.downloader import DownloadRequest, Downloader
+
+    options = opts or get_lua_runtime().table()
+    items = [urls] if isinstance(urls, str) else list(urls.values())
+    folder = normalize_path(destination or ".")
+    requests = []
+    for item in items:
+        if isinstance(item, str):
+            url, path, sha256 = item, None, None
+        else:
+            url, path, sha256 = item["url"], item["destination"], item["sha256"]
+        if not is_url_valid(url):
+            raise CommandException(f"URL is not valid: {url}")
+
+        name = url.split("?", 1)[0].rstrip("/").rsplit("/", 1)[-1]
+        if isinstance(urls, str):
+            sha256 = options["sha256"]
+            if destination and not destination.endswith(("/", os.sep)):
+                path = destination
+        requests.append(
+            DownloadRequest(
+                url=url,
+                destination=normalize_path(path) if path else folder / name,
+                sha256=sha256,
+            )
+        )
+
+    downloader = Downloader(
+        jobs=options["jobs"] or 4,
+        segments=options["segments"] or 4,
+        min_segment_size=options["min_segment_size"] or 8 * 1024 * 1024,
+        timeout=options["timeout"] or 30,
+    )
+    try:
+        results = downloader.download_all(requests)
+    finally:
+        downloader.pool.close()
+
+    if isinstance(urls, str):
+        response: LuaTable = get_lua_runtime().table_from(results[0].to_dict())
+        return response
+    response = get_lua_runtime().table_from(
+        {str(result.destination): result.to_dict() for result in results},
+        recursive=True,
+    )
+    return response
+
+
+def _to_path(path: str) -> Path:
+    """Normalize the path of a file system command, empty paths are rejected."""
+    # an empty path would be the base directory, like `rm -rf "$UNSET"`.
+    if not path:
+        raise CommandException("Path is empty.")
+    return normalize_path(path)
+
+
+def _to_paths(paths: Union[str, LuaTable]) -> List[Path]:
+    """Normalize a path or a table of paths, glob patterns are expanded."""
+    items = [paths] if isinstance(paths, str) else _to_list(paths)
+    return list(files.expand_globs(_to_path(item) for item in items))
+
+
+def _log_change(name: str, path: Path, details: str = "") -> None:
+    """Log a changed path of a file system command."""
+    logger.info("[%s] %s%s", name, path, details)
+
+
+def mkdir(paths: Union[str, LuaTable], opts: Optional[LuaTable] = None) -> int:
+    """
+    Create folders with their parents, existing folders are skipped.
+
+    Optional parameters:
+        mode: number or str (default: 777 with the umask), like 755, "755"
+            or "go-w", numbers are read as octal digits like in `chmod`
+
+    Returns the number of created folders.
+    """
+    options = opts or get_lua_runtime().table()
+    mode = 0o777
+    if options["mode"] is not None:
+        mode = files.parse_mode(options["mode"], 0o777, is_dir=True)
+
+    created = 0
+    for path in _to_paths(paths):
+        if files.make_directory(path, mode):
+            _log_change("MKDIR", path)
+            created += 1
+    return created
+
+
+def remove(paths: Union[str, LuaTable]) -> int:
+    """
+    Remove files, links and folders with their content, like `rm -rf`.
+
+    Glob patterns like `build/*.o` are expanded, missing paths are skipped.
+    The base directory and the root folder are never removed.
+    Returns the number of removed paths.
+    """
+    protected = {DoshInitializer().base_directory.resolve()}
+    removed = 0
+    for path in _to_paths(paths):
+        if path.resolve() in protected or path.resolve() == Path(path.anchor):
+            raise CommandException(f"Refusing to remove `{path}`.")
+        if files.remove_path(path):
+            _log_change("REMOVE", path)
+            removed += 1
+    return removed
+
+
+def move(src: Union[str, LuaTable], dst: str) -> int:
+    """
+    Move files or folders, like `mv`.
+
+    If the destination is a folder, or `src` is a table, they're moved into
+    the folder. Moving again is a no-op if the source is gone and the
+    destination exists. Returns the number of moved paths.
+    """
+    dst_path = _to_path(dst)
+    src_paths = _to_paths(src)
+    if not isinstance(src, str) or len(src_paths) > 1:
+        files.make_directory(dst_path)
+
+    moved = 0
+    for path in src_paths:
+        if files.move_path(path, dst_path):
+            _log_change("MOVE", path, f" -> {dst_path}")
+            moved += 1
+    return moved
+
+
+def link(
+    target: Union[str, LuaTable], link_path: str, opts: Optional[LuaTable] = None
+) -> int:
+    """
+    Create symbolic links, like `ln -sf`, existing files are replaced.
+
+    If `target` is a table, links are created in the `link_path` folder with
+    the names of the targets. Links pointing to their targets are skipped.
+
+    Optional parameters:
+        hard: boolean (default: false), create hard links
+        relative: boolean (default: false), link to relative target paths
+
+    Returns the number of created links.
+    """
+    options = opts or get_lua_runtime().table()
+    if isinstance(target, str):
+        pairs = [(_to_path(target), _to_path(link_path))]
+    else:
+        folder = _to_path(link_path)
+        pairs = [(path, folder / path.name) for path in _to_paths(target)]
+
+    created = 0
+    for target_path, path in pairs:
+        if files.link_path(
+            target_path,
+            path,
+            hard=bool(options["hard"]),
+            relative=bool(options["relative"]),
+        ):
+            _log_change("LINK", path, f" -> {target_path}")
+            created += 1
+    return created
+
+
+def chmod(
+    paths: Union[str, LuaTable], mode: Union[int, str], opts: Optional[LuaTable] = None
+) -> int:
+    """
+    Change permissions, the mode is like 755, "755", "u+x" or "go-w,a+X".
+
+    Numbers are read as octal digits like in `chmod`, Lua has no octal
+    literals.
+
+    Optional parameters:
+        recursive: boolean (default: false), also change the folder content
+
+    Returns the number of changed paths.
+    """
+    options = opts or get_lua_runtime().table()
+    changed = 0
+    for path in _to_paths(paths):
+        tree = [path]
+        if options["recursive"] and path.is_dir() and not path.is_symlink():
+            for directory, names, file_names in os.walk(path):
+                tree.extend(Path(directory, name) for name in names + file_names)
+
+        for item in tree:
+            # links in the folder are skipped, their targets may be elsewhere.
+            if item != path and item.is_symlink():
+                continue
+            if files.change_mode(item, mode):
+                _log_change("CHMOD", item)
+                changed += 1
+    return changed
+
+
+def write_file(path: str, content: str, opts: Optional[LuaTable] = None) -> bool:
+    """
+    Write the content to the file if its content is different.
+
+    The file is replaced atomically, and its folder is created. Unchanged
+    files are not touched, so tasks using them as inputs stay up to date.
+
+    Optional parameters:
+        mode: number or str (default: 666 with the umask), like 644 or "644",
+            numbers are read as octal digits like in `chmod`
+
+    Returns true if the file is written.
+    """
+    options = opts or get_lua_runtime().table()
+    file_path = _to_path(path)
+    mode = None if options["mode"] is None else files.parse_mode(options["mode"])
+    if not files.write_file(file_path, content, mode):
+        return False
+    _log_change("WRITE", file_path)
+    return True
+
+
 def exists(path: str) -> bool:
     """Check if the path exists in the file system."""
     return Path(path).exists()
@@ -157,4 +667,4 @@ def exists(path: str) -> bool:
 
 def exists_command(command: str) -> bool:
     """Check if the command exists."""
-    return shutil.which(command) is not None
+    return which(command) is not None
@@ -0,0 +1,229 @@
+"""Idempotent file system operations, they change only what's different."""
+
+from __future__ import annotations
+
+import functools
+import os
+import re
+import shutil
+import stat
+import tempfile
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, Union
+
+from dosh_core.commands.base import CommandException
+from dosh_core.logger import get_logger
+
+__all__ = [
+    "change_mode",
+    "expand_globs",
+    "get_umask",
+    "link_path",
+    "make_directory",
+    "move_path",
+    "parse_mode",
+    "remove_path",
+    "write_file",
+]
+
+logger = get_logger()
+
+SYMBOLIC_MODE = re.compile(r"([ugoa]*)([-+=])([rwxX]*)")
+PERMISSION_BITS = {
+    "u": {"r": stat.S_IRUSR, "w": stat.S_IWUSR, "x": stat.S_IXUSR},
+    "g": {"r": stat.S_IRGRP, "w": stat.S_IWGRP, "x": stat.S_IXGRP},
+    "o": {"r": stat.S_IROTH, "w": stat.S_IWOTH, "x": stat.S_IXOTH},
+}
+
+
+@functools.lru_cache(maxsize=None)
+def get_umask() -> int:
+    """Get the umask of the process once, reading it isn't thread-safe."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def expand_globs(paths: Iterable[Path]) -> Iterator[Path]:
+    """Expand the glob patterns, other paths are yielded even if they're missing."""
+    for path in paths:
+        if not any(char in path.as_posix() for char in "*?["):
+            yield path
+            continue
+        anchor = Path(path.anchor)
+        yield from sorted(anchor.glob(str(path.relative_to(anchor))))
+
+
+def make_directory(path: Path, mode: int = 0o777) -> bool:
+    """Create the folder with its parents, like `mkdir -p`."""
+    if path.is_dir():
+        return False
+    path.mkdir(mode=mode, parents=True, exist_ok=True)
+    return True
+
+
+def remove_path(path: Path) -> bool:
+    """Remove the file, link or folder with its content, like `rm -rf`."""
+    if path.is_symlink() or path.is_file():
+        path.unlink()
+    elif path.is_dir():
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        path.unlink()
+    else:
+        return False
+    return True
+
+
+def move_path(src: Path, dst: Path) -> bool:
+    """
+    Move the file or folder, into `dst` if it's a folder, like `mv`.
+
+    It's skipped if the source doesn't exist but the destination does, so
+    running it again is a no-op.
+    """
+    if dst.is_dir() and not dst.is_symlink():
+        dst = dst / src.name
+    if not os.path.lexists(src):
+        if os.path.lexists(dst):
+            return False
+        raise CommandException(f"Source doesn't exist: {src}")
+    if src == dst:
+        return False
+
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    shutil.move(str(src), str(dst))
+    return True
+
+
+def link_path(
+    target: Path, link: Path, hard: bool = False, relative: bool = False
+) -> bool:
+    """
+    Create a link to the target, replacing a file or link at its path.
+
+    It's skipped if the link already points to the target. Folders at the
+    link path are not replaced.
+    """
+    if hard:
+        if link.exists() and link.samefile(target):
+            return False
+    else:
+        link_target = os.path.relpath(target, link.parent) if relative else str(target)
+        if link.is_symlink() and os.readlink(link) == link_target:
+            return False
+
+    if link.is_dir() and not link.is_symlink():
+        raise CommandException(f"A folder exists at the link path: {link}")
+
+    # the link is created next to its path and moved over it, so an existing
+    # file is replaced atomically.
+    link.parent.mkdir(parents=True, exist_ok=True)
+    tmp_link = link.with_name(f".{link.name}.dosh-tmp")
+    if os.path.lexists(tmp_link):
+        tmp_link.unlink()
+    if hard:
+        os.link(target, tmp_link)
+    else:
+        os.symlink(link_target, tmp_link, target_is_directory=target.is_dir())
+    os.replace(tmp_link, link)
+    return True
+
+
+def parse_mode(
+    mode: Union[int, float, str], current: int = 0, is_dir: bool = False
+) -> int:
+    """
+    Get the permission bits of the mode.
+
+    The mode is octal digits like `755`, as a number or a string, or
+    symbolic like `u+x,go-w`. Numbers come from Lua, which has no octal
+    literals, so 755 means `0o755`. `X` adds execute permission only to
+    folders and files that are executable by someone.
+    """
+    if not isinstance(mode, str):
+        if mode != int(mode):
+            raise CommandException(f"Mode is not valid: {mode}")
+        mode = str(int(mode))
+    if re.fullmatch(r"[0-7]{1,4}", mode):
+        return int(mode, 8)
+
+    result = stat.S_IMODE(current)
+    for clause in mode.split(","):
+        match = SYMBOLIC_MODE.fullmatch(clause)
+        if match is None:
+            raise CommandException(f"Mode is not valid: {mode}")
+
+        who, operator, permissions = match.groups()
+        if "X" in permissions:
+            is_executable = is_dir or result & (
+                stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH
+            )
+            permissions = permissions.replace("X", "x" if is_executable else "")
+
+        bits = 0
+        for user in who.replace("a", "ugo") or "ugo":
+            for permission in permissions:
+                bits |= PERMISSION_BITS[user][permission]
+
+        if operator == "+":
+            result |= bits
+        elif operator == "-":
+            result &= ~bits
+        else:
+            cleared = 0
+            for user in who.replace("a", "ugo") or "ugo":
+                cleared |= sum(PERMISSION_BITS[user].values())
+            result = (result & ~cleared) | bits
+    return result
+
+
+def change_mode(path: Path, mode: Union[int, str]) -> bool:
+    """Change the permissions if they're different, links are followed."""
+    current = path.stat().st_mode
+    new_mode = parse_mode(mode, current, stat.S_ISDIR(current))
+    if stat.S_IMODE(current) == new_mode:
+        return False
+    path.chmod(new_mode)
+    return True
+
+
+def write_file(
+    path: Path, content: Union[str, bytes], mode: Optional[int] = None
+) -> bool:
+    """
+    Write the content atomically if the file has a different content.
+
+    Unchanged files keep their modification times, so tasks with the file
+    as an input stay up to date.
+    """
+    data = content.encode("utf-8") if isinstance(content, str) else content
+    try:
+        file_stat = path.stat()
+        if file_stat.st_size == len(data) and path.read_bytes() == data:
+            if mode is None or stat.S_IMODE(file_stat.st_mode) == mode:
+                return False
+            path.chmod(mode)
+            return True
+    except OSError:
+        pass
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=f".{path.name}.", delete=False
+    ) as tmp_file:
+        try:
+            tmp_file.write(data)
+            if mode is not None:
+                os.chmod(tmp_file.name, mode)
+            elif path.exists():
+                shutil.copymode(path, tmp_file.name)
+            else:
+                # temporary files are private, new files get the umask.
+                os.chmod(tmp_file.name, 0o666 & ~get_umask())
+        except BaseException:
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+            raise
+    os.replace(tmp_file.name, path)
+    return True
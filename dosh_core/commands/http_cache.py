@@ -0,0 +1,241 @@
+"""Content-addressed HTTP cache for remote scripts."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import IO, Dict, Optional, Tuple
+
+from dosh_core import DoshInitializer
+from dosh_core.commands.base import CommandException
+from dosh_core.logger import get_logger
+from dosh_core.tracing import get_tracer
+
+__all__ = ["CacheRecord", "HttpCache", "get_http_cache"]
+
+logger = get_logger()
+
+_index_lock = threading.Lock()
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+
+
+@dataclass
+class CacheRecord:
+    """Cached response of a URL."""
+
+    sha256: str
+    size: int
+    fetched_at: float
+    last_used: float
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+
+class HttpCache:
+    """
+    Cache responses by their checksums, revalidate them with the server.
+
+    Responses are stored once per content under `blobs/`, and `index.json`
+    maps URLs to them. The least recently used blobs are evicted when the
+    total size exceeds `max_size` bytes.
+    """
+
+    def __init__(self, directory: Path, max_size: int = DEFAULT_MAX_SIZE) -> None:
+        """Initialize the cache in the directory."""
+        self.directory = directory
+        self.max_size = max_size
+
+    @property
+    def index_path(self) -> Path:
+        """Get the path of the URL index."""
+        return self.directory / "index.json"
+
+    def get_blob_path(self, sha256: str) -> Path:
+        """Get the path of the cached content."""
+        return self.directory / "blobs" / sha256
+
+    def fetch(
+        self,
+        url: str,
+        max_age: float = 0,
+        sha256: Optional[str] = None,
+        offline: bool = False,
+    ) -> Path:
+        """
+        Get the cached content of the URL, download it if it's needed.
+
+        A cached response younger than `max_age` seconds, or one matching the
+        `sha256` pin, is used without a request. Otherwise it's revalidated
+        with ETag and Last-Modified headers. `offline` never sends a request.
+        """
+        with _index_lock:
+            index = self._load_index()
+
+        record = index.get(url)
+        sha256 = None if sha256 is None else sha256.lower()
+        if sha256 is not None and self.get_blob_path(sha256).exists():
+            record = self._get_pinned_record(record, sha256)
+        elif record is not None and not self.get_blob_path(record.sha256).exists():
+            record = None
+
+        is_fresh = record is not None and (
+            record.sha256 == sha256 or time.time() - record.fetched_at < max_age
+        )
+
+        if offline:
+            if record is None:
+                raise CommandException(f"URL is not cached for offline mode: {url}")
+        elif not is_fresh:
+            is_pinned = record is not None and sha256 not in (None, record.sha256)
+            record = self._download(url, None if is_pinned else record, sha256)
+
+        assert record is not None
+        if sha256 is not None and record.sha256 != sha256:
+            raise CommandException(
+                f"Checksum mismatch for {url}: expected {sha256}, got {record.sha256}"
+            )
+
+        record.last_used = time.time()
+        self._save_record(url, record)
+        return self.get_blob_path(record.sha256)
+
+    def _download(
+        self, url: str, record: Optional[CacheRecord], sha256: Optional[str] = None
+    ) -> CacheRecord:
+        """Download the URL or revalidate the cached record."""
+        request = urllib.request.Request(url)
+        if record is not None and record.etag:
+            request.add_header("If-None-Match", record.etag)
+        if record is not None and record.last_modified:
+            request.add_header("If-Modified-Since", record.last_modified)
+
+        try:
+            with urllib.request.urlopen(request) as response:
+                sha256, size = self._store_blob(url, response, sha256)
+                headers = response.headers
+        except urllib.error.HTTPError as exc:
+            if exc.code != 304 or record is None:
+                raise
+            record.fetched_at = time.time()
+            return record
+
+        get_tracer().annotate(bytes=size)
+        now = time.time()
+        return CacheRecord(
+            sha256=sha256,
+            size=size,
+            fetched_at=now,
+            last_used=now,
+            etag=headers.get("ETag"),
+            last_modified=headers.get("Last-Modified"),
+        )
+
+    def _store_blob(
+        self, url: str, response: IO[bytes], expected: Optional[str] = None
+    ) -> Tuple[str, int]:
+        """
+        Write the response body into the blob store while hashing it.
+
+        The body is stored only if it matches the `expected` checksum, blobs
+        that are not indexed would never be evicted.
+        """
+        blob_dir = self.directory / "blobs"
+        blob_dir.mkdir(parents=True, exist_ok=True)
+        checksum = hashlib.sha256()
+        size = 0
+
+        with tempfile.NamedTemporaryFile(dir=blob_dir, delete=False) as tmp_file:
+            try:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    checksum.update(chunk)
+                    tmp_file.write(chunk)
+                    size += len(chunk)
+            except BaseException:
+                tmp_file.close()
+                os.unlink(tmp_file.name)
+                raise
+
+        sha256 = checksum.hexdigest()
+        if expected is not None and sha256 != expected:
+            os.unlink(tmp_file.name)
+            raise CommandException(
+                f"Checksum mismatch for {url}: expected {expected}, got {sha256}"
+            )
+        os.replace(tmp_file.name, self.get_blob_path(sha256))
+        return sha256, size
+
+    def _get_pinned_record(
+        self, record: Optional[CacheRecord], sha256: str
+    ) -> CacheRecord:
+        """Use the pinned blob for the URL, it may come from another URL."""
+        if record is not None and record.sha256 == sha256:
+            return record
+
+        now = time.time()
+        size = self.get_blob_path(sha256).stat().st_size
+        return CacheRecord(sha256=sha256, size=size, fetched_at=now, last_used=now)
+
+    def _save_record(self, url: str, record: CacheRecord) -> None:
+        """Update the index and evict the least recently used blobs."""
+        with _index_lock:
+            index = self._load_index()
+            index[url] = record
+            self._evict(index, keep=record.sha256)
+            self._save_index(index)
+
+    def _evict(self, index: Dict[str, CacheRecord], keep: str) -> None:
+        """Remove the least recently used blobs until the cache fits."""
+        blobs: Dict[str, CacheRecord] = {}
+        for record in index.values():
+            current = blobs.get(record.sha256)
+            if current is None or current.last_used < record.last_used:
+                blobs[record.sha256] = record
+
+        total_size = sum(record.size for record in blobs.values())
+        for record in sorted(blobs.values(), key=lambda r: r.last_used):
+            if total_size <= self.max_size:
+                break
+            if record.sha256 == keep:
+                continue
+
+            logger.debug("[HTTP_CACHE] evict %s", record.sha256)
+            self.get_blob_path(record.sha256).unlink(missing_ok=True)
+            for url in [u for u, r in index.items() if r.sha256 == record.sha256]:
+                del index[url]
+            total_size -= record.size
+
+    def _load_index(self) -> Dict[str, CacheRecord]:
+        """Load the URL index, a broken index is ignored."""
+        try:
+            data = json.loads(self.index_path.read_text(encoding="utf-8"))
+            return {url: CacheRecord(**record) for url, record in data.items()}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, TypeError) as exc:
+            logger.debug("HTTP cache index `%s` is ignored: %s", self.index_path, exc)
+            return {}
+
+    def _save_index(self, index: Dict[str, CacheRecord]) -> None:
+        """Write the URL index atomically."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data = {url: asdict(record) for url, record in index.items()}
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self.directory, suffix=".tmp", delete=False, encoding="utf-8"
+        ) as tmp_file:
+            json.dump(data, tmp_file)
+        os.replace(tmp_file.name, self.index_path)
+
+
+def get_http_cache() -> HttpCache:
+    """Get the HTTP cache in the cache directory of dosh."""
+    return HttpCache(DoshInitializer().cache_directory / "http")
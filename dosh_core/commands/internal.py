@@ -5,6 +5,7 @@ from pathlib import Path
 from typing import List, Optional
 
 from dosh_core.commands.base import Task
+from dosh_core.completion import DOSH_COMMANDS, DOSH_OPTIONS
 from dosh_core.logger import get_logger
 
 logger = get_logger()
@@ -88,20 +89,13 @@ def generate_help(
         )
 
     # DOSH COMMANDS
-    lines.extend(
-        [
-            "",
-            "Dosh commands:",
-            "  > help                 print this output",
-            "  > init                 initialize a new config in current working directory",
-            "  > version              print version of DOSH",
-            "",
-            "  -c, --config PATH      specify config path (default: dosh.lua)",
-            "  -d, --directory PATH   change the working directory",
-            "  -v|vv|vvv, --verbose   increase the verbosity of messages:",
-            "                         1 - default, 2 - detailed, 3 - debug",
-        ]
-    )
+    lines.extend(["", "Dosh commands:"])
+    lines.extend(f"  > {usage.ljust(20)} {desc}" for usage, desc in DOSH_COMMANDS)
+    lines.append("")
+    for usage, desc in DOSH_OPTIONS:
+        desc_first, *desc_list = desc.split("\n")
+        lines.append(f"  {usage.ljust(22)} {desc_first}")
+        lines.extend(f"{' ' * 25}{line}" for line in desc_list)
 
     # EPILOG
     if epilog:
@@ -0,0 +1,199 @@
+"""Output capture and prefixed output of concurrent commands."""
+
+from __future__ import annotations
+
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import IO, Callable, Deque, List, Optional, Tuple
+
+from dosh_core.commands.base import Command, get_command_args, join_args
+
+__all__ = [
+    "CommandOutput",
+    "OutputMultiplexer",
+    "RingBuffer",
+    "get_output_multiplexer",
+    "run_and_capture",
+]
+
+__MULTIPLEXER: Optional[OutputMultiplexer] = None
+
+DEFAULT_MAX_OUTPUT = 1024 * 1024
+MAX_LINE_LENGTH = 64 * 1024
+
+LineCallback = Callable[[str, str], object]
+
+
+class RingBuffer:
+    """Keep the last `max_size` bytes written to the buffer."""
+
+    def __init__(self, max_size: int = DEFAULT_MAX_OUTPUT) -> None:
+        """Initialize an empty buffer."""
+        self.max_size = max_size
+        self.size = 0
+        self.truncated = False
+        self._chunks: Deque[bytes] = deque()
+
+    def write(self, data: bytes) -> None:
+        """Append the data, the oldest bytes are dropped if it's full."""
+        self._chunks.append(data)
+        self.size += len(data)
+        while self.size > self.max_size:
+            self.truncated = True
+            overflow = self.size - self.max_size
+            chunk = self._chunks.popleft()
+            if len(chunk) > overflow:
+                self._chunks.appendleft(chunk[overflow:])
+                self.size -= overflow
+            else:
+                self.size -= len(chunk)
+
+    def getvalue(self) -> bytes:
+        """Get the kept bytes."""
+        return b"".join(self._chunks)
+
+
+class OutputMultiplexer:
+    """Write output lines of commands with their prefixes, line by line."""
+
+    def __init__(
+        self, stdout: Optional[IO[str]] = None, stderr: Optional[IO[str]] = None
+    ) -> None:
+        """Initialize the multiplexer, it writes to sys streams by default."""
+        self._stdout = stdout
+        self._stderr = stderr
+        self._lock = threading.Lock()
+
+    def write_line(self, prefix: str, line: str, is_stderr: bool = False) -> None:
+        """Write the line with the prefix, lines of commands are not mixed."""
+        stream = (
+            (self._stderr or sys.stderr) if is_stderr else (self._stdout or sys.stdout)
+        )
+        with self._lock:
+            stream.write(f"[{prefix}] {line.rstrip(chr(13) + chr(10))}\n")
+            stream.flush()
+
+
+@dataclass
+class CommandOutput:
+    """Return code and the captured output of a command."""
+
+    return_code: int
+    stdout: str
+    stderr: str
+    truncated: bool = False
+
+
+def run_and_capture(
+    command: Command,
+    max_output: int = DEFAULT_MAX_OUTPUT,
+    on_line: Optional[LineCallback] = None,
+    prefix: Optional[str] = None,
+    shell: Optional[bool] = None,
+) -> CommandOutput:
+    """
+    Run the command and capture the last `max_output` bytes of output.
+
+    Lines are passed to `on_line` with the stream name, `stdout` or
+    `stderr`, in the calling thread while the command is running. If
+    `prefix` is given, lines are also written by the output multiplexer.
+    Plain commands run without the shell, see `get_command_args`.
+    """
+    args = get_command_args(command, shell)
+    if args is None and not isinstance(command, str):
+        command = join_args(command)
+    buffers = {"stdout": RingBuffer(max_output), "stderr": RingBuffer(max_output)}
+    lines: queue.Queue[Optional[Tuple[str, bytes]]] = queue.Queue(maxsize=1024)
+    multiplexer = get_output_multiplexer()
+
+    def read(name: str, stream: IO[bytes]) -> None:
+        try:
+            for line in iter(lambda: stream.readline(MAX_LINE_LENGTH), b""):
+                buffers[name].write(line)
+                if prefix is not None:
+                    multiplexer.write_line(
+                        prefix, _decode(line), is_stderr=name == "stderr"
+                    )
+                if on_line is not None:
+                    lines.put((name, line))
+        finally:
+            lines.put(None)
+
+    with subprocess.Popen(
+        command if args is None else args,
+        shell=args is None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        start_new_session=sys.platform != "win32",
+    ) as process:
+        assert process.stdout is not None and process.stderr is not None
+        readers: List[threading.Thread] = [
+            threading.Thread(target=read, args=(name, stream), daemon=True)
+            for name, stream in (("stdout", process.stdout), ("stderr", process.stderr))
+        ]
+        for reader in readers:
+            reader.start()
+
+        finished = 0
+        try:
+            while finished < len(readers):
+                item = lines.get()
+                if item is None:
+                    finished += 1
+                elif on_line is not None:
+                    on_line(_decode(item[1]).rstrip("\r\n"), item[0])
+            return_code = process.wait()
+        except BaseException:
+            _kill_process_group(process)
+            raise
+        finally:
+            # unblock the readers waiting for the queue.
+            while finished < len(readers):
+                if lines.get() is None:
+                    finished += 1
+            for reader in readers:
+                reader.join()
+
+    return CommandOutput(
+        return_code=return_code,
+        stdout=_decode(buffers["stdout"].getvalue()),
+        stderr=_decode(buffers["stderr"].getvalue()),
+        truncated=buffers["stdout"].truncated or buffers["stderr"].truncated,
+    )
+
+
+def _kill_process_group(process: subprocess.Popen[bytes]) -> None:
+    """Kill the command with the children it started, it has its own session."""
+    if sys.platform == "win32":
+        subprocess.run(
+            ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+            capture_output=True,
+            check=False,
+        )
+        return
+
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _decode(data: bytes) -> str:
+    """Decode the command output, invalid bytes are replaced."""
+    return data.decode("utf-8", errors="replace")
+
+
+def get_output_multiplexer() -> OutputMultiplexer:
+    """Get the output multiplexer of dosh."""
+    global __MULTIPLEXER  # pylint: disable=global-statement
+
+    if __MULTIPLEXER is None:
+        __MULTIPLEXER = OutputMultiplexer()
+
+    return __MULTIPLEXER
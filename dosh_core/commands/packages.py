@@ -0,0 +1,296 @@
+"""Batched package installation, installed packages are skipped."""
+
+from __future__ import annotations
+
+import abc
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import tempfile
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, TypeVar
+
+from dosh_core.commands.base import CommandException, run_command_and_return_result
+from dosh_core.commands.resolver import which
+from dosh_core.logger import get_logger
+
+__all__ = [
+    "AptManager",
+    "BrewManager",
+    "PackageInstaller",
+    "PackageManager",
+    "WingetManager",
+    "after_installs",
+    "get_package_installer",
+]
+
+logger = get_logger()
+
+__INSTALLER: Optional[PackageInstaller] = None
+
+PendingKey = Tuple[str, Tuple[str, ...]]
+T = TypeVar("T")
+
+
+class PackageManager(abc.ABC):
+    """Query and install packages of a package manager."""
+
+    name = ""
+    install_command = ""
+
+    @abc.abstractmethod
+    def get_installed(self) -> Set[str]:
+        """Get names of all installed packages."""
+
+    def normalize(self, package: str) -> str:
+        """Get the name of the package as it's listed in installed packages."""
+        return package
+
+    def get_names(self, package: str) -> List[str]:
+        """Get the names the package is listed by once it's installed."""
+        return [self.normalize(package)]
+
+    def get_commands(self, packages: List[str], flags: Tuple[str, ...]) -> List[str]:
+        """Get the commands installing the packages, one merged command."""
+        return [" ".join([self.install_command, *flags, *packages])]
+
+    def _query(self, args: List[str]) -> str:
+        """Run the query command, an error means nothing is known as installed."""
+        executable = which(args[0])
+        if executable is None:
+            return ""
+
+        result = subprocess.run(
+            [executable, *args[1:]], capture_output=True, text=True, check=False
+        )
+        if result.returncode != 0:
+            logger.debug("[%s] `%s` failed: %s", self.name, args[0], result.stderr)
+            return ""
+        return result.stdout
+
+
+class AptManager(PackageManager):
+    """Debian packages, installed ones are listed by `dpkg-query`."""
+
+    name = "apt"
+    install_command = "apt install"
+
+    def get_installed(self) -> Set[str]:
+        """Get names of the packages in the installed state, with their versions."""
+        output = self._query(
+            [
+                "dpkg-query",
+                "-W",
+                "-f",
+                "${Package}\t${db:Status-Abbrev}\t${Version}\n",
+            ]
+        )
+        installed = set()
+        for line in output.splitlines():
+            package, _, status = line.partition("\t")
+            status, _, version = status.partition("\t")
+            if status.startswith("ii"):
+                name = package.split(":", 1)[0]
+                installed.add(name)
+                if version:
+                    installed.add(f"{name}={version}")
+        return installed
+
+    def normalize(self, package: str) -> str:
+        """Drop the architecture, a pinned version must be the installed one."""
+        package, is_pinned, version = package.partition("=")
+        name = package.split(":", 1)[0]
+        return f"{name}={version}" if is_pinned else name
+
+    def get_names(self, package: str) -> List[str]:
+        """Get the name with and without the pinned version."""
+        name = self.normalize(package)
+        return list(dict.fromkeys([name, name.split("=", 1)[0]]))
+
+
+class BrewManager(PackageManager):
+    """Homebrew formulae and casks."""
+
+    name = "brew"
+    install_command = "brew install"
+
+    def get_installed(self) -> Set[str]:
+        """Get names of the installed formulae and casks."""
+        output = self._query(["brew", "list", "--versions"])
+        output += self._query(["brew", "list", "--cask", "--versions"])
+        return {line.split()[0] for line in output.splitlines() if line.strip()}
+
+    def get_taps(self) -> Set[str]:
+        """Get names of the tapped repositories."""
+        return {line.strip() for line in self._query(["brew", "tap"]).splitlines()}
+
+    def normalize(self, package: str) -> str:
+        """Drop the tap of the package."""
+        return package.rsplit("/", 1)[-1]
+
+
+class WingetManager(PackageManager):
+    """Windows packages, installed ones are listed by `winget export`."""
+
+    name = "winget"
+    install_command = "winget install -e --id"
+
+    def get_installed(self) -> Set[str]:
+        """Get identifiers of the installed packages."""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            export_path = os.path.join(tmp_dir, "packages.json")
+            self._query(["winget", "export", "-o", export_path])
+            try:
+                with open(export_path, encoding="utf-8") as export_file:
+                    data = json.load(export_file)
+            except (OSError, ValueError):
+                return set()
+
+        return {
+            package["PackageIdentifier"].lower()
+            for source in data.get("Sources", [])
+            for package in source.get("Packages", [])
+        }
+
+    def normalize(self, package: str) -> str:
+        """Package identifiers are case insensitive."""
+        return package.lower()
+
+    def get_commands(self, packages: List[str], flags: Tuple[str, ...]) -> List[str]:
+        """Get one command per package, `--id` takes a single identifier."""
+        return [
+            " ".join([self.install_command, *flags, package]) for package in packages
+        ]
+
+
+class PackageInstaller:
+    """
+    Install packages that are not installed yet.
+
+    Installed packages are queried once per package manager and remembered
+    for the rest of the run. In a batch, back-to-back installs are queued
+    and merged into one command per package manager, if the package manager
+    can install many packages at once. The queue is flushed
+    when the batch ends, and before any other command runs, see
+    `after_installs`. A failed install raises `CommandException`.
+    """
+
+    def __init__(self) -> None:
+        """Initialize the installer with empty snapshots."""
+        self.managers: Dict[str, PackageManager] = {
+            manager.name: manager
+            for manager in (AptManager(), BrewManager(), WingetManager())
+        }
+        self._lock = threading.RLock()
+        self._installed: Dict[str, Set[str]] = {}
+        self._local = threading.local()
+
+    def _get_pending(self) -> Dict[PendingKey, List[str]]:
+        """Get the queued packages of the current thread."""
+        if not hasattr(self._local, "pending"):
+            self._local.pending = {}
+            self._local.depth = 0
+        pending: Dict[PendingKey, List[str]] = self._local.pending
+        return pending
+
+    def install(
+        self, manager_name: str, packages: List[str], flags: Tuple[str, ...] = ()
+    ) -> None:
+        """Install or queue the packages that are missing."""
+        manager = self.managers[manager_name]
+        installed = self.get_installed(manager_name)
+        queued = self._get_pending().setdefault((manager_name, flags), [])
+        for package in packages:
+            name = manager.normalize(package)
+            if name in installed:
+                logger.debug("[%s] `%s` is already installed.", manager_name, name)
+            elif package not in queued:
+                queued.append(package)
+
+        if not self._local.depth:
+            self.flush()
+
+    def get_installed(self, manager_name: str) -> Set[str]:
+        """Get the snapshot of the installed packages."""
+        with self._lock:
+            if manager_name not in self._installed:
+                manager = self.managers[manager_name]
+                self._installed[manager_name] = manager.get_installed()
+            return self._installed[manager_name]
+
+    def flush(self) -> None:
+        """Run the queued installs, see `PackageManager.get_commands`."""
+        pending = self._get_pending()
+        while pending:
+            key = next(iter(pending))
+            (manager_name, flags), packages = key, pending.pop(key)
+            if not packages:
+                continue
+
+            manager = self.managers[manager_name]
+            for command in manager.get_commands(packages, flags):
+                logger.info("[RUN] %s", command)
+                return_code = run_command_and_return_result(command, "[RUN]")
+                if return_code != 0:
+                    pending.clear()
+                    raise CommandException(
+                        f"`{command}` failed with exit code {return_code}."
+                    )
+            with self._lock:
+                installed = self.get_installed(manager_name)
+                for package in packages:
+                    installed.update(manager.get_names(package))
+
+    def get_taps(self) -> Set[str]:
+        """Get the snapshot of the tapped brew repositories."""
+        with self._lock:
+            if "brew:taps" not in self._installed:
+                manager = self.managers["brew"]
+                assert isinstance(manager, BrewManager)
+                self._installed["brew:taps"] = manager.get_taps()
+            return self._installed["brew:taps"]
+
+    @contextlib.contextmanager
+    def batch(self) -> Iterator[None]:
+        """Merge the installs until the outermost batch ends."""
+        pending = self._get_pending()
+        self._local.depth += 1
+        try:
+            yield
+        except BaseException:
+            if self._local.depth == 1:
+                pending.clear()
+            raise
+        finally:
+            self._local.depth -= 1
+
+        if not self._local.depth:
+            self.flush()
+
+    def invalidate(self) -> None:
+        """Forget the installed packages, they're queried again."""
+        with self._lock:
+            self._installed.clear()
+
+
+def get_package_installer() -> PackageInstaller:
+    """Get the package installer of dosh."""
+    global __INSTALLER  # pylint: disable=global-statement
+
+    if __INSTALLER is None:
+        __INSTALLER = PackageInstaller()
+
+    return __INSTALLER
+
+
+def after_installs(func: Callable[..., T]) -> Callable[..., T]:
+    """Run the queued installs before the command, it may need the packages."""
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> T:
+        get_package_installer().flush()
+        return func(*args, **kwargs)
+
+    return wrapper
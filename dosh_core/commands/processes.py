@@ -0,0 +1,292 @@
+"""Non-blocking process handles backed by a single asyncio event loop."""
+
+from __future__ import annotations
+
+import asyncio
+import atexit
+import os
+import signal
+import subprocess
+import sys
+import threading
+from concurrent.futures import Future, wait
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from dosh_core.commands.output import MAX_LINE_LENGTH, get_output_multiplexer
+from dosh_core.logger import get_logger
+
+__all__ = ["ProcessEngine", "ProcessHandle", "get_process_engine"]
+
+logger = get_logger()
+
+__ENGINE: Optional[ProcessEngine] = None
+
+KILL_GRACE_PERIOD = 3.0
+
+
+class ProcessHandle:
+    """Handle of a spawned process."""
+
+    def __init__(
+        self,
+        command: str,
+        timeout: Optional[float] = None,
+        prefix: Optional[str] = None,
+    ) -> None:
+        """Initialize the handle, the process is started by the engine."""
+        self.command = command
+        self.timeout = timeout
+        self.prefix = prefix
+        self.timed_out = False
+        self.cancelled = False
+        self.future: Future[int] = Future()
+        self._process: Optional[asyncio.subprocess.Process] = None
+
+    @property
+    def pid(self) -> Optional[int]:
+        """Get the process id if it's started."""
+        return None if self._process is None else self._process.pid
+
+    @property
+    def done(self) -> bool:
+        """Check if the process is finished."""
+        return self.future.done()
+
+    @property
+    def returncode(self) -> Optional[int]:
+        """Get the return code if the process is finished."""
+        return self.future.result() if self.future.done() else None
+
+
+class ProcessEngine:
+    """Run shell commands concurrently on a background event loop."""
+
+    def __init__(self) -> None:
+        """Initialize the engine, the event loop starts on the first spawn."""
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+        self._handles: List[ProcessHandle] = []
+
+    def spawn(
+        self,
+        command: str,
+        cwd: Optional[Path] = None,
+        env: Optional[Dict[str, str]] = None,
+        timeout: Optional[float] = None,
+        prefix: Optional[str] = None,
+    ) -> ProcessHandle:
+        """
+        Start the command and return its handle immediately.
+
+        If `prefix` is given, output lines are written with the prefix by
+        the output multiplexer.
+        """
+        handle = ProcessHandle(command, timeout, prefix)
+        loop = self._get_loop()
+        with self._lock:
+            self._handles.append(handle)
+
+        coroutine = self._run(handle, cwd, env)
+        task_future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+        task_future.add_done_callback(lambda f: self._finish(handle, f))
+        return handle
+
+    def wait(self, handle: ProcessHandle) -> int:
+        """Wait for the process and return its return code."""
+        try:
+            return handle.future.result()
+        except KeyboardInterrupt:
+            self.cancel_all()
+            raise
+
+    def cancel(self, handle: ProcessHandle) -> None:
+        """Kill the process group of the handle."""
+        if handle.done or self._loop is None:
+            return
+
+        handle.cancelled = True
+        self._loop.call_soon_threadsafe(self._kill, handle)
+
+    def cancel_all(self) -> None:
+        """Kill all running processes."""
+        with self._lock:
+            handles = list(self._handles)
+
+        for handle in handles:
+            self.cancel(handle)
+
+    def terminate_all(self, timeout: float = KILL_GRACE_PERIOD) -> None:
+        """
+        Terminate all running processes and wait for them, before exiting.
+
+        Process groups are signalled from the calling thread, the event loop
+        may not get a chance to run anymore. Processes still running after
+        `timeout` seconds are killed.
+        """
+        if sys.platform == "win32":
+            self.cancel_all()
+            return
+
+        with self._lock:
+            handles = [handle for handle in self._handles if not handle.done]
+        for handle in handles:
+            handle.cancelled = True
+            if handle.pid is not None:
+                self._signal_group(handle.pid, signal.SIGTERM)
+
+        wait([handle.future for handle in handles], timeout=timeout)
+        for handle in handles:
+            if not handle.done and handle.pid is not None:
+                self._signal_group(handle.pid, signal.SIGKILL)
+
+    def reset_after_fork(self) -> None:
+        """Forget the event loop of the parent process, its thread isn't here."""
+        self._loop = None
+        self._lock = threading.Lock()
+        self._handles = []
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """Start the event loop in a daemon thread once."""
+        with self._lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(
+                    target=loop.run_forever, name="dosh-processes", daemon=True
+                )
+                thread.start()
+                atexit.register(self.terminate_all)
+                self._loop = loop
+            return self._loop
+
+    async def _run(
+        self,
+        handle: ProcessHandle,
+        cwd: Optional[Path],
+        env: Optional[Dict[str, str]],
+    ) -> int:
+        """Run the process in its own process group and apply the timeout."""
+        kwargs: Dict[str, Any] = {}
+        if sys.platform == "win32":
+            kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        else:
+            kwargs["start_new_session"] = True
+
+        if handle.prefix is not None:
+            kwargs["stdout"] = kwargs["stderr"] = asyncio.subprocess.PIPE
+
+        process = await asyncio.create_subprocess_shell(
+            handle.command, cwd=cwd, env=env, **kwargs
+        )
+        handle._process = process
+
+        if handle.cancelled:
+            self._kill(handle)
+
+        pumps = [
+            asyncio.ensure_future(self._pump(handle.prefix, stream, is_stderr))
+            for stream, is_stderr in ((process.stdout, False), (process.stderr, True))
+            if handle.prefix is not None and stream is not None
+        ]
+
+        try:
+            return_code = await asyncio.wait_for(process.wait(), handle.timeout)
+            await asyncio.gather(*pumps)
+            return return_code
+        except asyncio.TimeoutError:
+            handle.timed_out = True
+            logger.error(
+                "[SPAWN] `%s` timed out after %s seconds.",
+                handle.command,
+                handle.timeout,
+            )
+            self._kill(handle)
+            return await process.wait()
+        finally:
+            await self._stop_pumps(pumps)
+
+    @staticmethod
+    async def _stop_pumps(pumps: List[asyncio.Task[None]]) -> None:
+        """
+        Write the remaining output before the handle is done.
+
+        Pumps still running after the grace period, or when the run itself
+        is cancelled, are cancelled instead of being left pending.
+        """
+        if not pumps:
+            return
+        _, pending = await asyncio.wait(pumps, timeout=KILL_GRACE_PERIOD)
+        for pump in pending:
+            pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
+
+    @staticmethod
+    async def _pump(prefix: str, stream: asyncio.StreamReader, is_stderr: bool) -> None:
+        """Write the output lines of the process with its prefix."""
+        multiplexer = get_output_multiplexer()
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # the line is longer than the stream limit.
+                line = await stream.read(MAX_LINE_LENGTH)
+            if not line:
+                break
+            multiplexer.write_line(
+                prefix, line.decode("utf-8", errors="replace"), is_stderr
+            )
+
+    def _kill(self, handle: ProcessHandle) -> None:
+        """Terminate the whole process group, kill it after a grace period."""
+        process = handle._process
+        if process is None or process.returncode is not None:
+            return
+
+        if sys.platform == "win32":
+            subprocess.run(
+                ["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                capture_output=True,
+                check=False,
+            )
+            return
+
+        self._signal_group(process.pid, signal.SIGTERM)
+        assert self._loop is not None
+        self._loop.call_later(
+            KILL_GRACE_PERIOD, self._signal_group, process.pid, signal.SIGKILL
+        )
+
+    @staticmethod
+    def _signal_group(pid: int, sig: int) -> None:
+        """Send the signal to the process group, it may be gone already."""
+        try:
+            os.killpg(pid, sig)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+    def _finish(self, handle: ProcessHandle, task_future: Future[int]) -> None:
+        """Pass the result of the process to its handle."""
+        with self._lock:
+            self._handles.remove(handle)
+
+        exc = task_future.exception()
+        if exc is None:
+            return_code = task_future.result()
+            logger.debug("[SPAWN] Return code: %s (%s)", return_code, handle.command)
+            handle.future.set_result(return_code)
+        else:
+            handle.future.set_exception(exc)
+
+
+def get_process_engine() -> ProcessEngine:
+    """Get the process engine of dosh."""
+    global __ENGINE  # pylint: disable=global-statement
+
+    if __ENGINE is None:
+        engine = ProcessEngine()
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=engine.reset_after_fork)
+
+        __ENGINE = engine
+
+    return __ENGINE
@@ -0,0 +1,135 @@
+"""Concurrent git clones with an optional local mirror cache."""
+
+from __future__ import annotations
+
+import hashlib
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from dosh_core.logger import flush_logs, get_logger
+
+__all__ = ["CloneRequest", "RepositoryCloner"]
+
+logger = get_logger()
+
+_mirror_locks: Dict[Path, threading.Lock] = {}
+_mirror_locks_lock = threading.Lock()
+
+
+@dataclass
+class CloneRequest:
+    """A repository to clone and its destination."""
+
+    url: str
+    destination: Path
+    branch: Optional[str] = None
+    return_code: Optional[int] = field(default=None, compare=False)
+
+
+class RepositoryCloner:
+    """
+    Clone repositories concurrently.
+
+    If `mirror_directory` is given, a bare mirror of each repository is kept
+    there and new clones borrow its objects with `--reference`, then
+    `--dissociate` makes them independent from the mirror.
+    """
+
+    def __init__(
+        self,
+        jobs: int = 4,
+        depth: Optional[int] = None,
+        filter_spec: Optional[str] = None,
+        mirror_directory: Optional[Path] = None,
+        fetch: bool = False,
+    ) -> None:
+        """Initialize the cloner with the clone options."""
+        self.jobs = max(jobs, 1)
+        self.depth = depth
+        self.filter_spec = filter_spec
+        self.mirror_directory = mirror_directory
+        self.fetch = fetch
+
+    def clone_all(self, requests: List[CloneRequest]) -> List[CloneRequest]:
+        """Clone the repositories and set their return codes."""
+        if self.jobs == 1 or len(requests) < 2:
+            for request in requests:
+                self.clone(request)
+        else:
+            with ThreadPoolExecutor(
+                max_workers=self.jobs, thread_name_prefix="dosh-clone"
+            ) as executor:
+                list(executor.map(self.clone, requests))
+        return requests
+
+    def clone(self, request: CloneRequest) -> None:
+        """Clone the repository, an existing one is fetched or skipped."""
+        if request.destination.exists():
+            if self.fetch:
+                request.return_code = self._git(
+                    ["-C", str(request.destination), "fetch", "--prune", "--quiet"]
+                )
+            else:
+                logger.info(
+                    "[CLONE] the folder `%s` already exists. skipped.",
+                    request.destination,
+                )
+                request.return_code = 0
+            return
+
+        args = ["clone", "--quiet"]
+        if self.depth:
+            args.extend(["--depth", str(self.depth)])
+        if self.filter_spec:
+            args.extend(["--filter", self.filter_spec])
+        if request.branch:
+            args.extend(["--branch", request.branch])
+
+        mirror = self._update_mirror(request.url)
+        if mirror is not None:
+            args.extend(["--reference", str(mirror), "--dissociate"])
+
+        args.extend([request.url, str(request.destination)])
+        request.return_code = self._git(args)
+
+    def get_mirror_path(self, url: str) -> Path:
+        """Get the path of the bare mirror for the repository."""
+        assert self.mirror_directory is not None
+        name = url.rstrip("/").rsplit("/", 1)[-1].rsplit(".git", 1)[0]
+        checksum = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        return self.mirror_directory / f"{name}-{checksum}.git"
+
+    def _update_mirror(self, url: str) -> Optional[Path]:
+        """Create or fetch the mirror, None if it's not usable."""
+        if self.mirror_directory is None:
+            return None
+
+        mirror = self.get_mirror_path(url)
+        with _mirror_locks_lock:
+            lock = _mirror_locks.setdefault(mirror, threading.Lock())
+
+        with lock:
+            if mirror.exists():
+                args = ["-C", str(mirror), "fetch", "--prune", "--quiet"]
+            else:
+                mirror.parent.mkdir(parents=True, exist_ok=True)
+                args = ["clone", "--mirror", "--quiet", url, str(mirror)]
+
+            if self._git(args) != 0:
+                logger.warning("[CLONE] mirror of `%s` is not used.", url)
+                return None
+
+        return mirror
+
+    @staticmethod
+    def _git(args: List[str]) -> int:
+        """Run git with the arguments and return its return code."""
+        logger.info("[CLONE] git %s", " ".join(args))
+        flush_logs()
+        result = subprocess.run(["git", *args], check=False)
+        logger.debug("[CLONE] Return code: %s", result.returncode)
+        return result.returncode
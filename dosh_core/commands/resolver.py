@@ -0,0 +1,253 @@
+"""Memoized command resolution for the directories in PATH."""
+
+from __future__ import annotations
+
+import atexit
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from dosh_core import DoshInitializer
+from dosh_core.logger import get_logger
+
+__all__ = ["CommandResolver", "get_command_resolver", "which"]
+
+logger = get_logger()
+
+__RESOLVER: Optional[CommandResolver] = None
+
+PathKey = Tuple[str, str]
+
+
+@dataclass(frozen=True)
+class _DirectoryIndex:
+    """Entry names of a directory in PATH at a modification time."""
+
+    mtime_ns: Optional[int]
+    names: Optional[FrozenSet[str]] = None
+
+
+class CommandResolver:
+    """
+    Resolve commands like `shutil.which` and remember the results.
+
+    The results are cached per PATH and PATHEXT values, and they are dropped
+    when the modification time of a directory in PATH changes. Directories
+    are checked at most once in `revalidate_interval` seconds, but always
+    before a command is reported as missing, so new commands are found.
+    """
+
+    def __init__(
+        self, revalidate_interval: float = 1.0, cache_path: Optional[Path] = None
+    ) -> None:
+        """Initialize the resolver, load the persistent cache if it's given."""
+        self.revalidate_interval = revalidate_interval
+        self.cache_path = cache_path
+        self._lock = threading.RLock()
+        self._directories: Dict[str, _DirectoryIndex] = {}
+        self._results: Dict[PathKey, Dict[str, Optional[str]]] = {}
+        self._validated_at: Dict[PathKey, float] = {}
+        self._is_dirty = False
+
+        if cache_path is not None:
+            self._load()
+            atexit.register(self.save)
+
+    def which(self, command: str) -> Optional[str]:
+        """Get the full path of the command, None if it doesn't exist."""
+        if os.path.dirname(command):
+            return shutil.which(command)
+
+        key = self._get_key()
+        with self._lock:
+            self._validate(key)
+            result = self._resolve(key, command)
+            # the command may be installed since the directories were checked.
+            if result is None and self._validate(key, force=True):
+                result = self._resolve(key, command)
+            return result
+
+    def resolve_all(self, commands: Iterable[str]) -> Dict[str, Optional[str]]:
+        """Resolve many commands at once, PATH is checked only one time."""
+        with self._lock:
+            return {command: self.which(command) for command in sorted(set(commands))}
+
+    def clear(self) -> None:
+        """Forget all resolved commands."""
+        with self._lock:
+            self._directories.clear()
+            self._results.clear()
+            self._validated_at.clear()
+
+    def save(self) -> None:
+        """Write the resolved commands to the persistent cache."""
+        if self.cache_path is None or not self._is_dirty:
+            return
+
+        with self._lock:
+            data = {
+                "\0".join(key): {
+                    "directories": {
+                        directory: self._directories[directory].mtime_ns
+                        for directory in self._get_directories(key)
+                        if directory in self._directories
+                    },
+                    "commands": results,
+                }
+                for key, results in self._results.items()
+            }
+
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w",
+                dir=self.cache_path.parent,
+                suffix=".tmp",
+                delete=False,
+                encoding="utf-8",
+            ) as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_file.name, self.cache_path)
+            self._is_dirty = False
+        except OSError as exc:
+            logger.debug(
+                "Command cache `%s` couldn't be written: %s", self.cache_path, exc
+            )
+
+    @staticmethod
+    def _get_key() -> PathKey:
+        """Get the current PATH and PATHEXT values."""
+        return (os.environ.get("PATH", os.defpath), os.environ.get("PATHEXT", ""))
+
+    @staticmethod
+    def _get_directories(key: PathKey) -> List[str]:
+        """Get unique directories of PATH in order."""
+        directories = [d for d in key[0].split(os.pathsep) if d]
+        return list(dict.fromkeys(directories))
+
+    @staticmethod
+    def _get_mtime(directory: str) -> Optional[int]:
+        """Get modification time of the directory, None if it's missing."""
+        try:
+            return os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def _get_index(self, directory: str) -> _DirectoryIndex:
+        """List the directory once, until its modification time changes."""
+        index = self._directories.get(directory)
+        if index is None or index.names is None:
+            mtime_ns = self._get_mtime(directory)
+            try:
+                names = os.listdir(directory) if mtime_ns is not None else []
+            except OSError:
+                names = []
+            if sys.platform == "win32":
+                names = [name.lower() for name in names]
+            index = _DirectoryIndex(mtime_ns, frozenset(names))
+            self._directories[directory] = index
+        return index
+
+    def _resolve(self, key: PathKey, command: str) -> Optional[str]:
+        """Get the result of the command, it's looked up if it's not known."""
+        results = self._results.setdefault(key, {})
+        if command not in results:
+            results[command] = self._lookup(key, command)
+            self._is_dirty = True
+        return results[command]
+
+    def _validate(self, key: PathKey, force: bool = False) -> bool:
+        """Drop the results of PATH if one of its directories has changed."""
+        now = time.monotonic()
+        validated_at = self._validated_at.get(key, -self.revalidate_interval)
+        if not force and now - validated_at < self.revalidate_interval:
+            return False
+
+        is_changed = False
+        for directory in self._get_directories(key):
+            index = self._directories.get(directory)
+            if index is not None and index.mtime_ns != self._get_mtime(directory):
+                del self._directories[directory]
+                is_changed = True
+
+        if is_changed:
+            self._results.pop(key, None)
+
+        self._validated_at[key] = now
+        return is_changed
+
+    def _lookup(self, key: PathKey, command: str) -> Optional[str]:
+        """Find the command in the directories of PATH."""
+        names = [command]
+        if sys.platform == "win32":
+            extensions = [ext.lower() for ext in key[1].split(os.pathsep) if ext]
+            if not any(command.lower().endswith(ext) for ext in extensions):
+                names = [command + ext for ext in extensions]
+            names = [name.lower() for name in names]
+
+        for directory in self._get_directories(key):
+            index = self._get_index(directory)
+            for name in names:
+                if index.names is None or name not in index.names:
+                    continue
+
+                path = os.path.join(directory, name)
+                if os.access(path, os.F_OK | os.X_OK) and not os.path.isdir(path):
+                    return path
+
+        return None
+
+    def _load(self) -> None:
+        """Load the results that are still valid from the persistent cache."""
+        assert self.cache_path is not None
+        try:
+            data = json.loads(self.cache_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as exc:
+            logger.debug("Command cache `%s` is ignored: %s", self.cache_path, exc)
+            return
+
+        key = self._get_key()
+        entry = data.get("\0".join(key)) if isinstance(data, dict) else None
+        if not entry:
+            return
+
+        directories = entry["directories"]
+        for directory, mtime_ns in directories.items():
+            if mtime_ns != self._get_mtime(directory):
+                return
+
+        for directory, mtime_ns in directories.items():
+            self._directories[directory] = _DirectoryIndex(mtime_ns)
+        self._results[key] = dict(entry["commands"])
+        self._validated_at[key] = time.monotonic()
+
+
+def get_command_resolver() -> CommandResolver:
+    """
+    Get the command resolver of dosh.
+
+    Resolved commands are kept between runs if `DOSH_COMMAND_CACHE` is set.
+    """
+    global __RESOLVER  # pylint: disable=global-statement
+
+    if __RESOLVER is None:
+        cache_path = None
+        if os.getenv("DOSH_COMMAND_CACHE"):
+            cache_path = DoshInitializer().cache_directory / "commands.json"
+        __RESOLVER = CommandResolver(cache_path=cache_path)
+
+    return __RESOLVER
+
+
+def which(command: str) -> Optional[str]:
+    """Get the full path of the command, None if it doesn't exist."""
+    return get_command_resolver().which(command)
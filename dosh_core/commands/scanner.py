@@ -0,0 +1,159 @@
+"""Directory scanner with glob patterns and gitignore-style excludes."""
+
+from __future__ import annotations
+
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Pattern
+
+__all__ = ["IgnoreRules", "compile_glob", "scan_tree"]
+
+
+def compile_glob(pattern: str) -> Pattern[str]:
+    """
+    Convert the glob pattern to a regular expression for relative paths.
+
+    `*` and `?` don't match `/`, `**` matches any number of directories.
+    """
+    result = ""
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if pattern.startswith("**/", index):
+            result += "(?:.*/)?"
+            index += 3
+            continue
+        if pattern.startswith("**", index):
+            result += ".*"
+            index += 2
+            continue
+
+        if char == "*":
+            result += "[^/]*"
+        elif char == "?":
+            result += "[^/]"
+        elif char == "[" and "]" in pattern[index + 2 :]:
+            end = pattern.index("]", index + 2)
+            group = pattern[index + 1 : end]
+            if group.startswith("!"):
+                group = "^" + group[1:]
+            result += f"[{group.replace(chr(92), chr(92) * 2)}]"
+            index = end
+        else:
+            result += re.escape(char)
+        index += 1
+
+    return re.compile(f"{result}\\Z")
+
+
+@dataclass(frozen=True)
+class _IgnoreRule:
+    """A parsed line of gitignore-style excludes."""
+
+    regex: Pattern[str]
+    is_negated: bool
+    is_anchored: bool
+    is_dir_only: bool
+
+
+class IgnoreRules:
+    """
+    Match relative paths against gitignore-style patterns.
+
+    A pattern without a slash matches names at any level, otherwise it's
+    relative to the scanned directory. A trailing slash matches only
+    directories, and `!` includes a path excluded by a previous pattern.
+    """
+
+    def __init__(self, patterns: Iterable[str]) -> None:
+        """Parse the patterns, empty lines and comments are skipped."""
+        self.rules: List[_IgnoreRule] = []
+        for line in patterns:
+            pattern = line.strip()
+            if not pattern or pattern.startswith("#"):
+                continue
+
+            is_negated = pattern.startswith("!")
+            pattern = pattern.lstrip("!")
+            is_dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            is_anchored = "/" in pattern
+            self.rules.append(
+                _IgnoreRule(
+                    compile_glob(pattern.lstrip("/")),
+                    is_negated,
+                    is_anchored,
+                    is_dir_only,
+                )
+            )
+
+    def __bool__(self) -> bool:
+        """Check if there's any rule."""
+        return bool(self.rules)
+
+    def is_ignored(self, relative_path: str, is_dir: bool) -> bool:
+        """Check the path relative to the scanned directory, the last rule wins."""
+        name = relative_path.rsplit("/", 1)[-1]
+        is_ignored = False
+        for rule in self.rules:
+            if rule.is_dir_only and not is_dir:
+                continue
+            if rule.regex.match(relative_path if rule.is_anchored else name):
+                is_ignored = not rule.is_negated
+        return is_ignored
+
+
+def scan_tree(
+    parent: Path,
+    max_depth: Optional[int] = 1,
+    pattern: Optional[str] = None,
+    ignore_rules: Optional[IgnoreRules] = None,
+    include_files: bool = True,
+    include_dirs: bool = True,
+) -> Iterator[str]:
+    """
+    Yield paths in the directory lazily, in the order of the file system.
+
+    Directories are walked until `max_depth`, None means no limit. Symbolic
+    links to directories are listed but not followed.
+    """
+    regex = None if pattern is None else compile_glob(pattern)
+    match_path = pattern is not None and "/" in pattern
+    stack = [(str(parent), "", 1)]
+
+    while stack:
+        directory, prefix, depth = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            continue
+
+        subdirectories = []
+        with entries:
+            for entry in entries:
+                relative_path = prefix + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                    is_file = not is_dir and entry.is_file()
+                except OSError:
+                    continue
+
+                if ignore_rules and ignore_rules.is_ignored(relative_path, is_dir):
+                    continue
+
+                if (include_dirs and is_dir or include_files and is_file) and (
+                    regex is None
+                    or regex.match(relative_path if match_path else entry.name)
+                ):
+                    yield entry.path
+
+                if (
+                    is_dir
+                    and (max_depth is None or depth < max_depth)
+                    and not entry.is_symlink()
+                ):
+                    subdirectories.append((entry.path, relative_path + "/", depth + 1))
+
+        stack.extend(reversed(subdirectories))
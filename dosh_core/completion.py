@@ -0,0 +1,202 @@
+"""Task index for shell completion, it's read without evaluating the config."""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Dict, Final, Iterable, List, Optional, Tuple
+
+__all__ = [
+    "DOSH_COMMANDS",
+    "DOSH_OPTIONS",
+    "TaskIndex",
+    "complete",
+    "main",
+]
+
+# this module is imported by completion scripts on each key press, so it
+# doesn't import the Lua runtime or the commands.
+
+INDEX_FORMAT = 1
+
+DOSH_COMMANDS: Final[List[Tuple[str, str]]] = [
+    ("help", "print this output"),
+    ("init", "initialize a new config in current working directory"),
+    ("version", "print version of DOSH"),
+    ("watch TASK", "run the task again when its files change"),
+]
+
+DOSH_OPTIONS: Final[List[Tuple[str, str]]] = [
+    ("-c, --config PATH", "specify config path (default: dosh.lua)"),
+    ("-d, --directory PATH", "change the working directory"),
+    ("-j, --jobs N", "run up to N task dependencies in parallel"),
+    ("-f, --force", "run tasks even if they are up to date"),
+    ("--explain", "print why each task runs or is skipped"),
+    ("--profile [PATH]", "print the slowest steps, save a Chrome trace"),
+    ("--log-json PATH", "also write messages as JSON lines to PATH"),
+    (
+        "-v|vv|vvv, --verbose",
+        "increase the verbosity of messages:\n1 - default, 2 - detailed, 3 - debug",
+    ),
+]
+
+
+def _get_stamp(path: Path) -> Optional[List[int]]:
+    """Get the modification time and size of the file."""
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _get_flags(usage: str) -> Iterable[str]:
+    """Get the flags of an option usage, like `-v`, `-vv` and `--verbose`."""
+    for part in usage.split(", "):
+        flag = part.split()[0]
+        if "|" in flag:
+            first, *others = flag.split("|")
+            yield first
+            yield from (f"-{other}" for other in others)
+        else:
+            yield flag
+
+
+class TaskIndex:
+    """
+    Names and help texts of the tasks, stored next to the config.
+
+    The index is written when the config is parsed, and it's valid while
+    the config and its modules have the same modification times and sizes.
+    """
+
+    def __init__(self, config_path: Path) -> None:
+        """Set the index path for the config."""
+        self.config_path = config_path.absolute()
+        self.path = config_path.parent / ".dosh" / "tasks.json"
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        """Load the index, None if it's missing or stale."""
+        try:
+            with self.path.open(encoding="utf-8") as index_file:
+                data: Dict[str, Any] = json.load(index_file)
+        except (OSError, ValueError):
+            return None
+
+        if (
+            data.get("format") != INDEX_FORMAT
+            or data.get("config_path") != str(self.config_path)
+            or data.get("config") != _get_stamp(self.config_path)
+        ):
+            return None
+        for path, stamp in data.get("modules", {}).items():
+            if _get_stamp(Path(path)) != stamp:
+                return None
+        return data
+
+    def update(
+        self, tasks: List[Dict[str, Any]], module_paths: List[Path], platform: str
+    ) -> None:
+        """Write the index if it's stale, index errors are not fatal."""
+        if self.load() is not None:
+            return
+
+        import tempfile  # pylint: disable=import-outside-toplevel
+
+        data = {
+            "format": INDEX_FORMAT,
+            "config_path": str(self.config_path),
+            "config": _get_stamp(self.config_path),
+            "modules": {str(path): _get_stamp(path) for path in module_paths},
+            "platform": platform,
+            "tasks": [
+                {
+                    "name": task["name"],
+                    "description": task["description"].split("\n")[0],
+                    "platforms": task["required_platforms"],
+                    "environments": task["environments"],
+                }
+                for task in tasks
+            ],
+        }
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path.parent, suffix=".tmp", delete=False, encoding="utf-8"
+            ) as tmp_file:
+                json.dump(data, tmp_file)
+            os.replace(tmp_file.name, self.path)
+        except OSError:
+            pass
+
+
+def complete(
+    prefix: str = "", config_path: Optional[Path] = None
+) -> List[Tuple[str, str]]:
+    """
+    Get the task names, dosh commands and options starting with the prefix.
+
+    Candidates are pairs of a name and its description. Tasks come from the
+    task index, tasks not available on this platform or in `DOSH_ENV` are
+    left out. If the index is stale, only dosh commands are completed.
+    """
+    if prefix.startswith("-"):
+        return [
+            (flag, description.split("\n")[0])
+            for usage, description in DOSH_OPTIONS
+            for flag in _get_flags(usage)
+            if flag.startswith(prefix)
+        ]
+
+    candidates = []
+    data = TaskIndex(config_path or Path("dosh.lua")).load()
+    if data is not None:
+        dosh_env = os.getenv("DOSH_ENV") or ""
+        for task in data["tasks"]:
+            if task["platforms"] and data["platform"] not in task["platforms"]:
+                continue
+            if task["environments"] and dosh_env not in task["environments"]:
+                continue
+            candidates.append((task["name"], task["description"]))
+
+    candidates.extend(
+        (usage.split()[0], description) for usage, description in DOSH_COMMANDS
+    )
+    return [(name, desc) for name, desc in candidates if name.startswith(prefix)]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """
+    Print the completion candidates, one per line.
+
+    Usage: `python -m dosh_core.completion [-c PATH] [--descriptions] [PREFIX]`.
+    `--descriptions` prints descriptions after a tab, for zsh and fish. The
+    arguments are parsed by hand, argparse is slow to import on each key press.
+    """
+    args = list(sys.argv[1:] if argv is None else argv)
+    config_path = Path("dosh.lua")
+    with_descriptions = False
+    prefix = ""
+    while args:
+        arg = args.pop(0)
+        if arg in ("-c", "--config") and args:
+            config_path = Path(args.pop(0))
+        elif arg == "--descriptions":
+            with_descriptions = True
+        elif arg == "--":
+            prefix = args.pop(0) if args else ""
+        else:
+            prefix = arg
+
+    for name, description in complete(prefix, config_path):
+        if with_descriptions and description:
+            sys.stdout.write(f"{name}\t{description}\n")
+        else:
+            sys.stdout.write(f"{name}\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,29 +1,120 @@
 """DOSH config parser."""
 
-import shutil
+from __future__ import annotations
+
+import functools
+import threading
 from dataclasses import fields
-from typing import Any, Dict, List
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
+from dosh_core import DoshInitializer
+from dosh_core.artifacts import get_artifact_cache, get_command_hash
 from dosh_core.commands import COMMANDS
-from dosh_core.commands.base import OperatingSystem, Task
+from dosh_core.commands.base import CommandException, OperatingSystem, Task
+from dosh_core.commands.packages import get_package_installer
+from dosh_core.commands.resolver import get_command_resolver
+from dosh_core.completion import TaskIndex
+from dosh_core.config_cache import CacheEntry, ConfigCache
 from dosh_core.environments import DOSH_ENV, ENVIRONMENTS
-from dosh_core.logger import get_logger
-from dosh_core.lua_runtime import get_lua_environment
+from dosh_core.fingerprints import FingerprintStore
+from dosh_core.logger import get_logger, log_context
+from dosh_core.lua_modules import ModuleLoader
+from dosh_core.lua_runtime import (
+    LuaRuntime,
+    compile_lua_chunk,
+    get_lua_environment,
+    get_lua_runtime_pool,
+    use_lua_runtime,
+)
+from dosh_core.scheduler import TaskDependencyError, TaskScheduler
+from dosh_core.tracing import get_tracer
 
 logger = get_logger()
 
+# commands that only query the system, worker copies of the config run them
+# while they're evaluated, so they define the same tasks.
+QUERY_COMMANDS = frozenset(("exists", "exists_command", "ls"))
+
 
 class ConfigParser:
-    """Dosh configuration parser."""
+    """
+    Dosh configuration parser.
 
-    tasks: List[Task] = []
-    _vars: Dict[str, str] = {}
+    Each parser evaluates its config in its own Lua runtime, taken from the
+    runtime pool unless a runtime is given. `close` resets the runtime and
+    returns it to the pool, so many configs can be parsed in one process.
 
-    def __init__(self, content: str) -> None:
+    A Lua runtime runs one call at a time, so dependencies running in
+    parallel use worker copies of the config, one per thread. A worker
+    copy is evaluated with `is_worker`, its top-level `cmd` calls other
+    than the `QUERY_COMMANDS` are skipped, so they run only once.
+    """
+
+    def __init__(
+        self,
+        content: str,
+        chunk: Optional[bytes] = None,
+        runtime: Optional[LuaRuntime] = None,
+        is_worker: bool = False,
+    ) -> None:
         """Parse config first."""
-        commands = COMMANDS.copy()
-        commands["add_task"] = self.add_task
-        self._vars = get_lua_environment(content, ENVIRONMENTS, commands)
+        self.tasks: List[Task] = []
+        self.config_path = DoshInitializer().config_path
+        self._content = content
+        self._chunk = chunk
+        self._runtime = runtime
+        self._owns_runtime = False
+        self._vars: Dict[str, str] = {}
+        self._is_evaluated = False
+        self._is_evaluating = False
+        self._is_worker = is_worker
+        self._workers = threading.local()
+        self._workers_lock = threading.Lock()
+        self._worker_parsers: List[ConfigParser] = []
+        self._modules: Dict[Path, Tuple[int, int]] = {}
+        self._command_hashes: Dict[str, str] = {}
+        self._evaluate()
+
+    def __enter__(self) -> ConfigParser:
+        """Use the parser in a `with` block, it's closed at the end."""
+        return self
+
+    def __exit__(self, *_: Any) -> None:
+        """Close the parser."""
+        self.close()
+
+    @classmethod
+    def from_file(cls, config_path: Path, use_cache: bool = True) -> ConfigParser:
+        """
+        Parse the config file.
+
+        The config is evaluated only when a task runs if its task list can be
+        restored from the config cache.
+        """
+        content = config_path.read_text(encoding="utf-8")
+        if not use_cache:
+            parser = cls(content)
+            parser.config_path = config_path
+            parser._update_task_index()
+            return parser
+
+        cache = ConfigCache(content)
+        entry = cache.load()
+
+        if entry is None:
+            with get_tracer().span("compile config", "lua"):
+                chunk = compile_lua_chunk(content)
+            parser = cls(content, chunk=chunk)
+            cache.save(parser._to_cache_entry())
+        else:
+            logger.debug("Config is loaded from the cache: %s", cache.path)
+            parser = cls.__new__(cls)
+            parser._restore(content, entry)
+
+        parser.config_path = config_path
+        parser._update_task_index()
+        return parser
 
     @property
     def description(self) -> str:
@@ -35,17 +126,130 @@ class ConfigParser:
         """Get help epilog."""
         return self._vars["HELP_EPILOG"]
 
-    def run_task(self, task_name: str, params: List[str]) -> None:
-        """Find and run tasks with parameters."""
-        task = None
-        for current_task in self.tasks:
-            if current_task.name == task_name:
-                task = current_task
-                break
+    @property
+    def module_paths(self) -> List[Path]:
+        """Get paths of the modules loaded by the config."""
+        return list(self._modules)
+
+    def run_task(
+        self,
+        task_name: str,
+        params: List[str],
+        jobs: int = 1,
+        force: bool = False,
+        explain: bool = False,
+    ) -> bool:
+        """
+        Find and run tasks with parameters.
 
+        Dependencies of the task run first, once each, and up to `jobs` of
+        them run concurrently. Concurrent dependencies run in worker copies
+        of the config, so Lua globals set by a task are not visible to the
+        tasks of other threads. Tasks with inputs or outputs are skipped if
+        they are up to date, unless `force` is set. Outputs of tasks with
+        `cache` are restored from the artifact cache if the same inputs
+        were built before. `explain` prints why each task runs or is skipped.
+        """
+        task = self._find_task(task_name)
         if task is None:
-            return
+            return False
+
+        if task.depends_on:
+            scheduler = TaskScheduler(self.tasks, jobs=jobs)
+            try:
+                dependencies = scheduler.resolve(task.name)
+            except TaskDependencyError as exc:
+                logger.error(str(exc))
+                return False
+
+            if jobs > 1 and self._chunk is None:
+                # worker copies are evaluated from the bytecode compiled once.
+                with use_lua_runtime(self._get_runtime()):
+                    self._chunk = compile_lua_chunk(self._content)
+
+            runner = functools.partial(
+                self._run_dependency if jobs <= 1 else self._run_in_worker,
+                force=force,
+                explain=explain,
+            )
+            if not scheduler.run(dependencies, runner):
+                logger.error("The task `%s` is cancelled.", task.name)
+                return False
+
+        return self._run_single(task, params, force, explain)
+
+    def close(self) -> None:
+        """
+        Release the tasks and the Lua runtime of the config.
+
+        Help texts are kept, but tasks can't run after the parser is closed.
+        """
+        self._vars = {
+            "HELP_DESCRIPTION": self.description,
+            "HELP_EPILOG": self.epilog,
+        }
+        self.tasks = []
+        self._is_evaluated = False
+        for parser in self._worker_parsers:
+            parser.close()
+        self._worker_parsers.clear()
+        if self._runtime is not None and self._owns_runtime:
+            get_lua_runtime_pool().release(self._runtime)
+        self._runtime = None
+        self._owns_runtime = False
+
+    def get_task_metadata(self) -> List[Dict[str, Any]]:
+        """Get the arguments of the tasks without their commands."""
+        return [
+            {f.name: getattr(task, f.name) for f in fields(Task) if f.name != "command"}
+            for task in self.tasks
+        ]
+
+    def _update_task_index(self) -> None:
+        """Write the task index of shell completion if it's stale."""
+        TaskIndex(self.config_path).update(
+            self.get_task_metadata(),
+            self.module_paths,
+            OperatingSystem.get_current().value,
+        )
+
+    def check_required_commands(self) -> Dict[str, List[str]]:
+        """Resolve required commands of all tasks and get the missing ones."""
+        resolved = get_command_resolver().resolve_all(
+            command for task in self.tasks for command in task.required_commands
+        )
+        missing = {}
+        for task in self.tasks:
+            commands = [c for c in task.required_commands if resolved[c] is None]
+            if commands:
+                missing[task.name] = commands
+        return missing
+
+    def add_task(self, args: Dict[str, Any]) -> None:
+        """Parse and add task to task list."""
+        # python objects written back into the lua table can be handed out
+        # to later lua calls by mistake, so the arguments are copied first.
+        task_args = dict(args.items())
+        for field in filter(lambda field: field.type.startswith("List"), fields(Task)):
+            val = task_args.get(field.name)
+            task_args[field.name] = [] if val is None else list(val.values())
 
+        task = Task.from_dict(task_args)
+        if task.cache and not task.outputs:
+            logger.warning("The task `%s` has no outputs to cache.", task.name)
+        self.tasks.append(task)
+
+    def _find_task(self, task_name: str) -> Optional[Task]:
+        """Find the task by its name."""
+        for task in self.tasks:
+            if task.name == task_name:
+                return task
+        return None
+
+    def _run_single(
+        self, task: Task, params: List[str], force: bool = False, explain: bool = False
+    ) -> bool:
+        """Check the requirements of the task and run its command."""
         os_type = OperatingSystem.get_current().value
         if task.required_platforms and os_type not in task.required_platforms:
             logger.error(
@@ -54,7 +258,7 @@ class ConfigParser:
                 ", ".join(task.required_platforms),
                 os_type,
             )
-            return
+            return False
 
         if task.environments and DOSH_ENV not in task.environments:
             logger.error(
@@ -63,24 +267,184 @@ class ConfigParser:
                 ", ".join(task.environments),
                 DOSH_ENV,
             )
-            return
+            return False
 
+        resolved = get_command_resolver().resolve_all(task.required_commands)
         for command in task.required_commands:
-            if shutil.which(command) is None:
+            if resolved[command] is None:
                 logger.error("The command `%s` doesn't exist.", command)
-                return
+                return False
+
+        log = logger.warning if explain else logger.info
+        command_hash = self._get_command_hash(task)
+        fingerprints = FingerprintStore(self.config_path)
+        reasons = (
+            ["forced"] if force else fingerprints.check(task, params, command_hash)
+        )
+        if not reasons:
+            log("[TASK] `%s` is up to date, skipped.", task.name)
+            return True
+
+        runtime = self._get_runtime()
+        artifacts = get_artifact_cache() if task.cache and task.outputs else None
+        cache_key = None
+        if artifacts is not None:
+            cache_key = artifacts.get_key(task, params, command_hash)
+            if not force and artifacts.restore(cache_key):
+                log("[TASK] `%s` is restored from the artifact cache.", task.name)
+                fingerprints.update(task, params, command_hash)
+                return True
+            artifacts.prepare_outputs(task)
+
+        if explain or task.inputs or task.outputs:
+            log("[TASK] `%s` runs: %s", task.name, "; ".join(reasons))
 
         try:
-            task.command(*params)
+            with get_tracer().span(f"task {task.name}", "task"):
+                with log_context(task=task.name), use_lua_runtime(runtime):
+                    with get_package_installer().batch():
+                        task.command(*params)
         except KeyboardInterrupt:
             print("\r", end="")
             logger.error("keyboard interrupt...")
+            return False
+        except CommandException as exc:
+            # the queued installs of the task failed when the batch ended.
+            logger.error("The task `%s` failed: %s", task.name, exc)
+            return False
 
-    def add_task(self, args: Dict[str, Any]) -> None:
-        """Parse and add task to task list."""
-        for field in filter(lambda field: field.type.startswith("List"), fields(Task)):
-            val = args[field.name]
-            args[field.name] = [] if val is None else list(val.values())
+        if artifacts is not None and cache_key is not None:
+            artifacts.store(cache_key, task)
+        fingerprints.update(task, params, command_hash)
+        return True
 
-        task = Task.from_dict(args)
-        self.tasks.append(task)
+    def _run_dependency(
+        self, task_name: str, force: bool = False, explain: bool = False
+    ) -> bool:
+        """Run a dependency task without parameters."""
+        task = self._find_task(task_name)
+        return task is not None and self._run_single(task, [], force, explain)
+
+    def _run_in_worker(
+        self, task_name: str, force: bool = False, explain: bool = False
+    ) -> bool:
+        """Run a dependency task in the config copy of the worker thread."""
+        parser: Optional[ConfigParser] = getattr(self._workers, "parser", None)
+        if parser is None:
+            parser = ConfigParser(self._content, chunk=self._chunk, is_worker=True)
+            parser.config_path = self.config_path
+            self._workers.parser = parser
+            with self._workers_lock:
+                self._worker_parsers.append(parser)
+        return parser._run_dependency(task_name, force, explain)
+
+    def _evaluate(self) -> None:
+        """Evaluate the config content in the Lua runtime."""
+        self.tasks = []
+        runtime = self._get_runtime()
+        envs = ENVIRONMENTS.copy()
+        commands = COMMANDS.copy()
+        if self._is_worker:
+            for name, command in commands.items():
+                if name not in QUERY_COMMANDS:
+                    commands[name] = self._skip_while_evaluating(name, command)
+        loader = ModuleLoader(runtime, envs, commands)
+        commands["add_task"] = self.add_task
+        commands["include"] = loader.include
+        self._is_evaluating = True
+        try:
+            with get_tracer().span("evaluate config", "lua"), use_lua_runtime(runtime):
+                loader.install()
+                self._vars = get_lua_environment(
+                    self._content, envs, commands, chunk=self._chunk
+                )
+        finally:
+            self._is_evaluating = False
+        self._modules = loader.modules
+        self._is_evaluated = True
+
+    def _skip_while_evaluating(
+        self, name: str, command: Callable[..., Any]
+    ) -> Callable[..., Any]:
+        """Skip the command at the top level of a worker copy of the config."""
+
+        @functools.wraps(command)
+        def wrapper(*args: Any) -> Any:
+            if self._is_evaluating:
+                logger.debug("`cmd.%s` is skipped in the worker copy.", name)
+                return None
+            return command(*args)
+
+        return wrapper
+
+    def _restore(self, content: str, entry: CacheEntry) -> None:
+        """Restore the parser from the cache without evaluating the config."""
+        self.config_path = DoshInitializer().config_path
+        self._content = content
+        self._chunk = entry.chunk
+        self._runtime = None
+        self._owns_runtime = False
+        self._is_evaluated = False
+        self._is_evaluating = False
+        self._is_worker = False
+        self._workers = threading.local()
+        self._workers_lock = threading.Lock()
+        self._worker_parsers = []
+        self._modules = {
+            Path(path): (stamp[0], stamp[1]) for path, stamp in entry.modules.items()
+        }
+        self._command_hashes = dict(entry.commands)
+        self._vars = {
+            "HELP_DESCRIPTION": entry.description,
+            "HELP_EPILOG": entry.epilog,
+        }
+        self.tasks = [
+            Task.from_dict(
+                {**args, "command": functools.partial(self._run_deferred, args["name"])}
+            )
+            for args in entry.tasks
+        ]
+
+    def _run_deferred(self, task_name: str, *params: Any) -> None:
+        """Evaluate the config and run the actual command of a cached task."""
+        if not self._is_evaluated:
+            self._evaluate()
+
+        task = self._find_task(task_name)
+        if task is not None:
+            task.command(*params)
+
+    def _to_cache_entry(self) -> CacheEntry:
+        """Create a cache entry of the parsed config."""
+        return CacheEntry(
+            description=self.description,
+            epilog=self.epilog,
+            chunk=self._chunk or compile_lua_chunk(self._content),
+            tasks=self.get_task_metadata(),
+            modules={str(path): list(stamp) for path, stamp in self._modules.items()},
+            commands={task.name: self._get_command_hash(task) for task in self.tasks},
+        )
+
+    def _get_command_hash(self, task: Task) -> str:
+        """
+        Get the checksum of the task command source.
+
+        Restored tasks use the checksum of the parse that wrote the config
+        cache, their deferred commands have no Lua source.
+        """
+        command_hash = self._command_hashes.get(task.name)
+        if command_hash is None:
+            if not self._is_evaluated:
+                self._evaluate()
+            task = self._find_task(task.name) or task
+            with use_lua_runtime(self._get_runtime()):
+                command_hash = get_command_hash(task, self._content)
+            self._command_hashes[task.name] = command_hash
+        return command_hash
+
+    def _get_runtime(self) -> LuaRuntime:
+        """Get the runtime of the config, it's acquired from the pool first."""
+        if self._runtime is None:
+            self._runtime = get_lua_runtime_pool().acquire()
+            self._owns_runtime = True
+        return self._runtime
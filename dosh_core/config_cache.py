@@ -0,0 +1,128 @@
+"""On-disk cache of parsed dosh configurations."""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from dosh_core import DoshInitializer, get_version
+from dosh_core.environments import ENVIRONMENTS
+from dosh_core.logger import get_logger
+from dosh_core.lua_runtime import LUA_IMPLEMENTATION
+
+__all__ = ["CacheEntry", "ConfigCache"]
+
+logger = get_logger()
+
+CACHE_FORMAT = 3
+
+
+@dataclass
+class CacheEntry:
+    """
+    Task metadata and compiled Lua chunk of a parsed config.
+
+    `commands` has the checksums of the task command sources, the commands
+    of restored tasks are not Lua functions until the config is evaluated.
+    """
+
+    description: str
+    epilog: str
+    chunk: bytes
+    tasks: List[Dict[str, Any]] = field(default_factory=list)
+    modules: Dict[str, List[int]] = field(default_factory=dict)
+    commands: Dict[str, str] = field(default_factory=dict)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Convert the entry to a JSON-serializable dictionary."""
+        return {
+            "format": CACHE_FORMAT,
+            "description": self.description,
+            "epilog": self.epilog,
+            "chunk": self.chunk.hex(),
+            "tasks": self.tasks,
+            "modules": self.modules,
+            "commands": self.commands,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> CacheEntry:
+        """Create an entry from its dictionary form."""
+        if data.get("format") != CACHE_FORMAT:
+            raise ValueError("unsupported cache format")
+
+        return cls(
+            description=data["description"],
+            epilog=data["epilog"],
+            chunk=bytes.fromhex(data["chunk"]),
+            tasks=data["tasks"],
+            modules=data["modules"],
+            commands=data["commands"],
+        )
+
+    def has_changed_modules(self) -> bool:
+        """Check if any module included by the config has changed."""
+        for path, stamp in self.modules.items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return True
+            if [stat.st_mtime_ns, stat.st_size] != stamp:
+                return True
+        return False
+
+
+class ConfigCache:
+    """Config cache keyed by content, dosh version and environment values."""
+
+    def __init__(self, content: str, cache_directory: Optional[Path] = None) -> None:
+        """Compute the cache key of the config content."""
+        initializer = DoshInitializer()
+        self.directory = (cache_directory or initializer.cache_directory) / "config"
+        key_data = {
+            "content": hashlib.sha256(content.encode("utf-8")).hexdigest(),
+            "version": get_version(),
+            "lua": LUA_IMPLEMENTATION,
+            "base_directory": str(initializer.base_directory),
+            "environments": dict(ENVIRONMENTS),
+        }
+        key_json = json.dumps(key_data, sort_keys=True, default=str)
+        self.key = hashlib.sha256(key_json.encode("utf-8")).hexdigest()
+
+    @property
+    def path(self) -> Path:
+        """Get the file path of the cache entry."""
+        return self.directory / f"{self.key}.json"
+
+    def load(self) -> Optional[CacheEntry]:
+        """Load the cache entry, return None if it's missing or broken."""
+        try:
+            with self.path.open(encoding="utf-8") as cache_file:
+                entry = CacheEntry.from_dict(json.load(cache_file))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as exc:
+            logger.debug("Config cache `%s` is ignored: %s", self.path, exc)
+            return None
+
+        if entry.has_changed_modules():
+            logger.debug("Config cache `%s` is ignored: modules changed", self.path)
+            return None
+        return entry
+
+    def save(self, entry: CacheEntry) -> None:
+        """Write the cache entry atomically, cache errors are not fatal."""
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.directory, suffix=".tmp", delete=False, encoding="utf-8"
+            ) as tmp_file:
+                json.dump(entry.to_dict(), tmp_file)
+            os.replace(tmp_file.name, self.path)
+        except OSError as exc:
+            logger.debug("Config cache `%s` couldn't be written: %s", self.path, exc)
@@ -0,0 +1,208 @@
+"""Dosh daemon keeping parsed configs warm to run tasks without startup cost."""
+
+from __future__ import annotations
+
+import argparse
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from dosh_core.client import (
+    CONFIG_ENV_NAMES,
+    get_socket_path,
+    receive_message,
+    send_message,
+)
+from dosh_core.config import ConfigParser
+from dosh_core.logger import flush_logs, get_logger, set_verbosity
+
+__all__ = ["DoshServer"]
+
+logger = get_logger()
+
+ConfigStamp = Tuple[int, int]
+
+
+class DoshServer:
+    """
+    Serve task runs over a Unix socket.
+
+    Configs are parsed once and parsed again only when their files change.
+    Each task runs in a forked process with the directory, environment
+    variables and standard streams of the client, so tasks don't share
+    state and the warm Lua runtime of the server stays clean.
+    """
+
+    def __init__(self, socket_path: Optional[Path] = None) -> None:
+        """Initialize the server, it starts listening in `serve_forever`."""
+        self.socket_path = socket_path or get_socket_path()
+        self.parsers: Dict[Path, Tuple[ConfigStamp, ConfigParser]] = {}
+        self._config_env = {name: os.getenv(name) for name in CONFIG_ENV_NAMES}
+        self._socket: Optional[socket.socket] = None
+        self._is_running = False
+
+    def serve_forever(self) -> None:
+        """Accept connections until the server is shut down."""
+        self.socket_path.parent.mkdir(parents=True, exist_ok=True)
+        self.socket_path.unlink(missing_ok=True)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(str(self.socket_path))
+        self._socket.listen()
+        self._is_running = True
+        logger.info("dosh daemon is listening on %s", self.socket_path)
+
+        try:
+            while self._is_running:
+                try:
+                    connection, _ = self._socket.accept()
+                except OSError:
+                    break
+                self._handle(connection)
+        finally:
+            self._socket.close()
+            self.socket_path.unlink(missing_ok=True)
+
+    def shutdown(self) -> None:
+        """Stop accepting connections."""
+        self._is_running = False
+        if self._socket is not None:
+            self._socket.shutdown(socket.SHUT_RDWR)
+
+    def get_parser(self, config_path: Path) -> ConfigParser:
+        """Get the parsed config, it's parsed again if the file has changed."""
+        stat = config_path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self.parsers.get(config_path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        logger.debug("dosh daemon parses %s", config_path)
+        parser = ConfigParser.from_file(config_path, use_cache=False)
+        self.parsers[config_path] = (stamp, parser)
+        if cached is not None:
+            cached[1].close()
+        return parser
+
+    def _handle(self, connection: socket.socket) -> None:
+        """Receive the request and run it in a child process."""
+        fds: List[int] = []
+        try:
+            _, fds, _, _ = socket.recv_fds(connection, 1, 3)
+            request = receive_message(connection)
+            if request is None or len(fds) != 3:
+                raise ValueError("The request is not complete.")
+
+            env = request["env"]
+            if any(env.get(name) != value for name, value in self._config_env.items()):
+                send_message(
+                    connection,
+                    {"error": "The environment doesn't match.", "fallback": True},
+                )
+                return
+
+            os.chdir(request["cwd"])
+            parser = self.get_parser(Path(request["config_path"]))
+        except Exception as exc:  # pylint: disable=broad-except
+            self._reply_error(connection, exc)
+            self._close(connection, fds)
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self._run_child(parser, request, fds)
+
+        self._close(None, fds)
+        send_message(connection, {"pid": pid})
+        threading.Thread(
+            target=self._wait_child, args=(connection, pid), daemon=True
+        ).start()
+
+    def _run_child(
+        self, parser: ConfigParser, request: Dict[str, Any], fds: List[int]
+    ) -> None:
+        """Run the task with the client's context and exit."""
+        exit_code = 1
+        try:
+            if self._socket is not None:
+                self._socket.close()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+            for target, fd in enumerate(fds):
+                os.dup2(fd, target)
+                os.close(fd)
+
+            os.environ.clear()
+            os.environ.update(request["env"])
+            set_verbosity(request["verbosity"])
+
+            is_successful = parser.run_task(
+                request["task_name"],
+                request["params"],
+                jobs=request["jobs"],
+                force=request["force"],
+                explain=request["explain"],
+            )
+            exit_code = 0 if is_successful else 1
+        except BaseException:  # pylint: disable=broad-except
+            traceback.print_exc()
+        finally:
+            flush_logs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(exit_code)
+
+    @staticmethod
+    def _wait_child(connection: socket.socket, pid: int) -> None:
+        """Send the exit code of the child process to the client."""
+        _, status = os.waitpid(pid, 0)
+        try:
+            send_message(connection, {"exit_code": os.waitstatus_to_exitcode(status)})
+        except OSError:
+            pass
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _reply_error(connection: socket.socket, exc: Exception) -> None:
+        """Send the error to the client."""
+        logger.debug("dosh daemon request failed: %s", exc)
+        try:
+            send_message(connection, {"error": str(exc)})
+        except OSError:
+            pass
+
+    @staticmethod
+    def _close(connection: Optional[socket.socket], fds: List[int]) -> None:
+        """Close the connection and the received file descriptors."""
+        for fd in fds:
+            os.close(fd)
+        if connection is not None:
+            connection.close()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Start the dosh daemon."""
+    arg_parser = argparse.ArgumentParser(description="dosh daemon")
+    arg_parser.add_argument("--socket", type=Path, help="path of the Unix socket")
+    arg_parser.add_argument("-v", "--verbose", action="count", default=2)
+    args = arg_parser.parse_args(argv)
+
+    set_verbosity(args.verbose)
+    server = DoshServer(args.socket)
+    signal.signal(signal.SIGTERM, lambda *_: server.shutdown())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,28 +2,127 @@
 
 from __future__ import annotations
 
-import getpass
+import functools
 import os
-from typing import Final
+from typing import Any, Callable, Dict, Final
 
 from dosh_core.commands.base import OperatingSystem
 
-__all__ = ["ENVIRONMENTS"]
+__all__ = ["ENVIRONMENTS", "LazyEnvironments"]
 
-SHELL: Final = os.getenv("SHELL") or ""
-CURRENT_OS: Final = OperatingSystem.get_current()
 DOSH_ENV: Final = os.getenv("DOSH_ENV") or ""
-ENVIRONMENTS: Final = {
-    "USER": getpass.getuser(),
-    "HELP_DESCRIPTION": "dosh - shell-independent task manager",
-    "HELP_EPILOG": "",
-    "DOSH_ENV": DOSH_ENV,
-    # shell type
-    "IS_ZSH": SHELL.endswith("zsh"),
-    "IS_BASH": SHELL.endswith("bash"),
-    "IS_PWSH": SHELL.endswith("pwsh"),
-    # os type
-    "IS_MACOS": CURRENT_OS == OperatingSystem.MACOS,
-    "IS_LINUX": CURRENT_OS == OperatingSystem.LINUX,
-    "IS_WINDOWS": CURRENT_OS == OperatingSystem.WINDOWS,
-}
+
+# they're computed by `__getattr__` when they're accessed first.
+SHELL: str
+CURRENT_OS: OperatingSystem
+
+
+def __getattr__(name: str) -> Any:
+    """Compute `SHELL` and `CURRENT_OS` on the first access."""
+    if name == "SHELL":
+        return _get_shell()
+    if name == "CURRENT_OS":
+        return _get_current_os()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class LazyEnvironments(Dict[str, Any]):
+    """
+    Environment variables computed on their first access.
+
+    Lua reads the table through lupa's item lookup, so `__missing__` works
+    like an `__index` metamethod and only the values used by the config are
+    computed.
+    """
+
+    def __init__(self, factories: Dict[str, Callable[[], Any]]) -> None:
+        """Keep the factories of the values."""
+        super().__init__()
+        self.factories = factories
+
+    def __missing__(self, key: str) -> Any:
+        """Compute the value and remember it."""
+        value = self.factories[key]()
+        self[key] = value
+        return value
+
+    def __iter__(self) -> Any:
+        """Iterate over all keys, including the ones not computed yet."""
+        return iter(self.keys())
+
+    def __len__(self) -> int:
+        """Count all keys."""
+        return len(self.keys())
+
+    def __contains__(self, key: object) -> bool:
+        """Check if the key is computed or it can be computed."""
+        return super().__contains__(key) or key in self.factories
+
+    def keys(self) -> Any:
+        """Get all keys."""
+        return list(dict.fromkeys([*self.factories, *super().keys()]))
+
+    def items(self) -> Any:
+        """Get all items, every value is computed."""
+        return [(key, self[key]) for key in self.keys()]
+
+    def values(self) -> Any:
+        """Get all values, every value is computed."""
+        return [self[key] for key in self.keys()]
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """Get the value, or the default if the key is unknown."""
+        return self[key] if key in self else default
+
+    def copy(self) -> LazyEnvironments:
+        """Copy the environments, computed values are shared."""
+        environments = LazyEnvironments(self.factories)
+        environments.update(dict.items(self))
+        return environments
+
+
+def _get_user() -> str:
+    """Get the name of the current user."""
+    import getpass  # pylint: disable=import-outside-toplevel
+
+    return getpass.getuser()
+
+
+@functools.lru_cache(maxsize=None)
+def _get_shell() -> str:
+    """Get the shell of the user."""
+    return os.getenv("SHELL") or ""
+
+
+@functools.lru_cache(maxsize=None)
+def _get_current_os() -> OperatingSystem:
+    """Get the current operating system type."""
+    return OperatingSystem.get_current()
+
+
+def _is_shell(name: str) -> Callable[[], bool]:
+    """Check the shell type."""
+    return lambda: _get_shell().endswith(name)
+
+
+def _is_os(os_type: OperatingSystem) -> Callable[[], bool]:
+    """Check the operating system type."""
+    return lambda: _get_current_os() == os_type
+
+
+ENVIRONMENTS: Final = LazyEnvironments(
+    {
+        "USER": _get_user,
+        "HELP_DESCRIPTION": lambda: "dosh - shell-independent task manager",
+        "HELP_EPILOG": lambda: "",
+        "DOSH_ENV": lambda: DOSH_ENV,
+        # shell type
+        "IS_ZSH": _is_shell("zsh"),
+        "IS_BASH": _is_shell("bash"),
+        "IS_PWSH": _is_shell("pwsh"),
+        # os type
+        "IS_MACOS": _is_os(OperatingSystem.MACOS),
+        "IS_LINUX": _is_os(OperatingSystem.LINUX),
+        "IS_WINDOWS": _is_os(OperatingSystem.WINDOWS),
+    }
+)
@@ -0,0 +1,188 @@
+"""Up-to-date checks of tasks by their input and output fingerprints."""
+
+from __future__ import annotations
+
+import json
+import os
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+from dosh_core.commands.base import Task, hash_file, normalize_path
+from dosh_core.logger import get_logger
+
+__all__ = ["FingerprintStore", "expand_paths", "hash_file"]
+
+logger = get_logger()
+
+FileState = List[Any]
+
+_store_lock = threading.Lock()
+
+
+def expand_paths(patterns: List[str]) -> Iterator[Path]:
+    """Find files matching the glob patterns, directories are walked through."""
+    for pattern in patterns:
+        path = normalize_path(pattern)
+        if any(char in pattern for char in "*?["):
+            anchor = Path(path.anchor)
+            matches = sorted(anchor.glob(str(path.relative_to(anchor))))
+        else:
+            matches = [path] if path.exists() else []
+
+        for match in matches:
+            if match.is_dir():
+                yield from sorted(p for p in match.rglob("*") if p.is_file())
+            elif match.is_file():
+                yield match
+
+
+def _get_file_states(patterns: List[str]) -> Dict[str, FileState]:
+    """Get modification time and size of the files."""
+    states: Dict[str, FileState] = {}
+    for path in expand_paths(patterns):
+        stat = path.stat()
+        states[str(path)] = [stat.st_mtime_ns, stat.st_size, None]
+    return states
+
+
+class FingerprintStore:
+    """Fingerprints of the last successful task runs, stored next to the config."""
+
+    def __init__(self, config_path: Path) -> None:
+        """Set the store path for the config."""
+        self.path = config_path.parent / ".dosh" / "fingerprints.json"
+
+    def check(self, task: Task, params: List[str], command_hash: str = "") -> List[str]:
+        """
+        Get the reasons to run the task, it's up to date if there's none.
+
+        `command_hash` is the checksum of the task command source, see
+        `get_command_hash`, so editing the task runs it again.
+        """
+        if not task.inputs and not task.outputs:
+            return ["the task has no inputs or outputs"]
+
+        record = self._load().get(task.name)
+        if record is None:
+            return ["no previous successful run"]
+
+        reasons = []
+        if record.get("command") != command_hash:
+            reasons.append("command changed")
+        if record["params"] != params:
+            reasons.append("parameters changed")
+
+        inputs = _get_file_states(task.inputs)
+        rehashed: Dict[str, FileState] = {}
+        reasons.extend(
+            self._compare(record["inputs"], inputs, "input", task.hash_inputs, rehashed)
+        )
+
+        missing = [
+            f"output missing: {pattern}"
+            for pattern in task.outputs
+            if next(expand_paths([pattern]), None) is None
+        ]
+        if missing:
+            reasons.extend(missing)
+        else:
+            outputs = _get_file_states(task.outputs)
+            reasons.extend(self._compare(record["outputs"], outputs, "output", False))
+
+        if not reasons and rehashed:
+            # the content is the same, don't hash the files again next time.
+            self._refresh_inputs(task.name, rehashed)
+        return reasons
+
+    def update(self, task: Task, params: List[str], command_hash: str = "") -> None:
+        """Record the fingerprint of a successful task run."""
+        if not task.inputs and not task.outputs:
+            return
+
+        inputs = _get_file_states(task.inputs)
+        if task.hash_inputs:
+            for path, state in inputs.items():
+                state[2] = hash_file(Path(path))
+
+        record = {
+            "command": command_hash,
+            "params": params,
+            "inputs": inputs,
+            "outputs": _get_file_states(task.outputs),
+        }
+
+        with _store_lock:
+            records = self._load()
+            records[task.name] = record
+            self._save(records)
+
+    def _refresh_inputs(self, task_name: str, inputs: Dict[str, FileState]) -> None:
+        """Store the new modification times of inputs with the same content."""
+        with _store_lock:
+            records = self._load()
+            record = records.get(task_name)
+            if record is None:
+                return
+            record["inputs"].update(inputs)
+            self._save(records)
+
+    @staticmethod
+    def _compare(
+        previous: Dict[str, FileState],
+        current: Dict[str, FileState],
+        kind: str,
+        use_hash: bool,
+        rehashed: Optional[Dict[str, FileState]] = None,
+    ) -> List[str]:
+        """
+        Compare file states and explain the differences.
+
+        Files with the same content hash but a new modification time are put
+        in `rehashed`.
+        """
+        reasons = []
+        for path in sorted(previous.keys() - current.keys()):
+            reasons.append(f"{kind} removed: {path}")
+
+        for path, state in sorted(current.items()):
+            old_state: Optional[FileState] = previous.get(path)
+            if old_state is None:
+                reasons.append(f"{kind} added: {path}")
+            elif old_state[:2] != state[:2]:
+                if use_hash and old_state[2] is not None:
+                    state[2] = hash_file(Path(path))
+                    if state[2] == old_state[2]:
+                        if rehashed is not None:
+                            rehashed[path] = state
+                        continue
+                reasons.append(f"{kind} changed: {path}")
+
+        return reasons
+
+    def _load(self) -> Dict[str, Any]:
+        """Load all fingerprints, a broken store is ignored."""
+        try:
+            with self.path.open(encoding="utf-8") as store_file:
+                records: Dict[str, Any] = json.load(store_file)
+                return records
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as exc:
+            logger.debug("Fingerprint store `%s` is ignored: %s", self.path, exc)
+            return {}
+
+    def _save(self, records: Dict[str, Any]) -> None:
+        """Write all fingerprints atomically."""
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                "w", dir=self.path.parent, suffix=".tmp", delete=False, encoding="utf-8"
+            ) as tmp_file:
+                json.dump(records, tmp_file)
+            os.replace(tmp_file.name, self.path)
+        except OSError as exc:
+            logger.warning(
+                "Fingerprint store `%s` couldn't be written: %s", self.path, exc
+            )
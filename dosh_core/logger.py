@@ -1,31 +1,277 @@
 """Logging support."""
 
-from logging import DEBUG, ERROR, INFO, WARNING, Logger
-from typing import Optional
+from __future__ import annotations
 
-import colorlog
+import contextlib
+import contextvars
+import copy
+import json
+import os
+import queue
+import threading
+from logging import (
+    DEBUG,
+    ERROR,
+    INFO,
+    WARNING,
+    FileHandler,
+    Filter,
+    Formatter,
+    Handler,
+    Logger,
+    LogRecord,
+    StreamHandler,
+    getLogger,
+)
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
+
+__all__ = [
+    "JsonLinesFormatter",
+    "LogWriter",
+    "add_json_sink",
+    "flush_logs",
+    "get_log_writer",
+    "get_logger",
+    "get_lua_log_function",
+    "log_context",
+    "set_verbosity",
+]
 
 __LOGGER: Optional[Logger] = None
+__WRITER: Optional[LogWriter] = None
+
+LOG_FORMAT = "%(log_color)s%(name)s => %(message)s"
+
+_EXCEPTION_FORMATTER = Formatter()
+
+_context: contextvars.ContextVar[Dict[str, Any]] = contextvars.ContextVar(
+    "dosh_log_context", default={}
+)
+
+
+class LazyColoredFormatter(Formatter):
+    """Colored formatter of colorlog, colorlog is imported on the first log."""
+
+    def __init__(self, fmt: str) -> None:
+        """Keep the format until the formatter is needed."""
+        super().__init__()
+        self._fmt_string = fmt
+        self._formatter: Optional[Formatter] = None
+
+    def format(self, record: LogRecord) -> str:
+        """Format the record with the colored formatter."""
+        if self._formatter is None:
+            import colorlog  # pylint: disable=import-outside-toplevel
+
+            self._formatter = colorlog.ColoredFormatter(self._fmt_string)
+        return self._formatter.format(record)
+
+
+class JsonLinesFormatter(Formatter):
+    """Format records as JSON objects with their context fields."""
+
+    def format(self, record: LogRecord) -> str:
+        """Format the record as a single line."""
+        data: Dict[str, Any] = {
+            "time": record.created,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        if record.exc_text:
+            data["exception"] = record.exc_text
+        return json.dumps(data, default=str)
+
+
+class ContextFilter(Filter):
+    """Attach the context fields of the calling task to the records."""
+
+    def filter(self, record: LogRecord) -> bool:
+        """Copy the context, the record is written in another thread."""
+        record.context = _context.get()
+        return True
+
+
+class LogWriter(Handler):
+    """
+    Queue records and write them in a background thread.
+
+    The message is merged with its arguments in the logging thread, because
+    arguments can be Lua objects, but coloring, JSON encoding and writing to
+    a slow terminal or a pipe happen in the writer thread.
+    """
+
+    def __init__(self, handlers: Optional[List[Handler]] = None) -> None:
+        """Initialize the writer, the thread starts with the first record."""
+        super().__init__()
+        self.handlers: List[Handler] = handlers or []
+        self._queue: queue.SimpleQueue[Union[LogRecord, threading.Event, None]] = (
+            queue.SimpleQueue()
+        )
+        self._thread: Optional[threading.Thread] = None
+        self._thread_lock = threading.Lock()
+
+    def emit(self, record: LogRecord) -> None:
+        """Queue a copy of the record, other handlers get the original one."""
+        try:
+            prepared = copy.copy(record)
+            prepared.msg = record.getMessage()
+            prepared.args = None
+            if record.exc_info:
+                prepared.exc_text = _EXCEPTION_FORMATTER.formatException(
+                    record.exc_info
+                )
+                prepared.exc_info = None
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+            return
+
+        self._start()
+        self._queue.put(prepared)
+
+    def flush(self) -> None:
+        """Wait until the queued records are written."""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return
+        if thread is threading.current_thread():
+            return
+
+        event = threading.Event()
+        self._queue.put(event)
+        event.wait()
+
+    def close(self) -> None:
+        """Write the queued records and stop the thread."""
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join()
+        self._thread = None
+        super().close()
+
+    def reset_after_fork(self) -> None:
+        """Forget the thread of the parent process, a new one starts if needed."""
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._queue = queue.SimpleQueue()
+
+    def _start(self) -> None:
+        """Start the writer thread if it's not running."""
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._write, name="dosh-log-writer", daemon=True
+                )
+                self._thread.start()
+
+    def _write(self) -> None:
+        """Write the queued records until the writer is closed."""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if isinstance(item, threading.Event):
+                item.set()
+                continue
+
+            for handler in list(self.handlers):
+                if item.levelno >= handler.level:
+                    handler.handle(item)
+
+
+@contextlib.contextmanager
+def log_context(**fields: Any) -> Iterator[None]:
+    """Add the fields to the records logged in the block, like the task name."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def get_log_writer() -> LogWriter:
+    """Get the background log writer of dosh."""
+    global __WRITER  # pylint: disable=global-statement
+
+    if __WRITER is None:
+        handler = StreamHandler()
+        handler.setFormatter(LazyColoredFormatter(LOG_FORMAT))
+
+        writer = LogWriter([handler])
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=writer.reset_after_fork)
+
+        __WRITER = writer
+
+    return __WRITER
 
 
 def get_logger() -> Logger:
-    """Get logger of dosh."""
+    """Get logger of dosh, `DOSH_LOG_JSON` adds a JSON-lines sink."""
     global __LOGGER  # pylint: disable=global-statement
 
     if __LOGGER is None:
-        handler = colorlog.StreamHandler()
-        handler.setFormatter(
-            colorlog.ColoredFormatter("%(log_color)s%(name)s => %(message)s")
-        )
+        writer = get_log_writer()
+        writer.addFilter(ContextFilter())
 
-        logger = colorlog.getLogger("DOSH")
-        logger.addHandler(handler)
+        logger = getLogger("DOSH")
+        logger.addHandler(writer)
+
+        json_path = os.getenv("DOSH_LOG_JSON")
+        if json_path:
+            add_json_sink(Path(json_path))
 
         __LOGGER = logger
 
     return __LOGGER
 
 
+def add_json_sink(path: Path, level: int = DEBUG) -> Handler:
+    """
+    Append the records to the file as JSON lines.
+
+    The sink gets the records enabled by the verbosity of the logger, and
+    `level` filters them further.
+    """
+    handler = FileHandler(path, encoding="utf-8")
+    handler.setFormatter(JsonLinesFormatter())
+    handler.setLevel(level)
+    get_log_writer().handlers.append(handler)
+    return handler
+
+
+def flush_logs() -> None:
+    """Write the queued records, before a command writes to the terminal."""
+    get_log_writer().flush()
+
+
+def get_lua_log_function(level: int) -> Callable[..., None]:
+    """
+    Get the logging function for Lua configs.
+
+    If the level is disabled, the message isn't formatted. The message can
+    be a function, like `cmd.debug(function () return dump(t) end)`, which
+    is called only if the level is enabled.
+    """
+    logger = get_logger()
+
+    def log(message: Any, *args: Any) -> None:
+        if not logger.isEnabledFor(level):
+            return
+        if not isinstance(message, str) and callable(message):
+            from lupa import lua_type  # pylint: disable=import-outside-toplevel
+
+            if lua_type(message) in (None, "function"):
+                message = message()
+        logger.log(level, message, *args)
+
+    return log
+
+
 def set_verbosity(verbosity: int = 0) -> None:
     """Set verbosity level for logger."""
     if verbosity >= 3:
@@ -0,0 +1,224 @@
+"""Shared Lua modules of configs, loaded by `cmd.include` and `require`."""
+
+from __future__ import annotations
+
+import functools
+import hashlib
+import os
+import struct
+import tempfile
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from dosh_core import DoshInitializer, get_version
+from dosh_core.commands.base import CommandException
+from dosh_core.logger import get_logger
+from dosh_core.lua_runtime import LUA_IMPLEMENTATION, LuaRuntime, compile_lua_source
+
+__all__ = ["ModuleCache", "ModuleLoader", "get_module_cache"]
+
+__MODULE_CACHE: Optional[ModuleCache] = None
+
+logger = get_logger()
+
+ModuleStamp = Tuple[int, int]
+
+# modification time and size of the source, stored before the bytecode.
+HEADER = struct.Struct("!qq")
+
+# the searcher asks the loader of the current config, it's kept in the
+# registry because `package.searchers` outlives configs in pooled runtimes.
+INSTALL_CODE = """
+function (find)
+    local registry = debug.getregistry()
+    registry["dosh.loader"] = find
+    if not registry["dosh.searcher"] then
+        registry["dosh.searcher"] = true
+        table.insert(package.searchers, 2, function (name)
+            local find_module = debug.getregistry()["dosh.loader"]
+            if find_module == nil then
+                return "\\n\\tno dosh module loader"
+            end
+            local loader, path = find_module(name)
+            if path == nil then
+                return loader
+            end
+            -- `require` accepts only Lua functions as loaders.
+            return function (...) return loader(...) end, path
+        end)
+    end
+end
+"""
+
+LOAD_CODE = "function (code, name) return assert(load(code, name, 'b'))() end"
+
+
+def get_stamp(path: Path) -> ModuleStamp:
+    """Get the modification time and size of the file."""
+    stat = path.stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _wrap_module(content: str) -> str:
+    """Wrap the module content with a function getting `env` and `cmd`."""
+    return f"return function (env, cmd, ...) {content}\nend"
+
+
+class ModuleCache:
+    """
+    Bytecode of modules by path and modification time.
+
+    Compiled modules are kept in memory and on disk, so a module is
+    compiled again only when its file changes.
+    """
+
+    def __init__(self, directory: Optional[Path] = None) -> None:
+        """Initialize the cache, it's in the dosh cache by default."""
+        self._directory = directory
+        self._chunks: Dict[Path, Tuple[ModuleStamp, bytes]] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self) -> Path:
+        """Get the folder of the bytecode files."""
+        return self._directory or DoshInitializer().cache_directory / "lua"
+
+    def get_chunk(self, path: Path, stamp: ModuleStamp, runtime: LuaRuntime) -> bytes:
+        """Get the bytecode of the module, it's compiled if it's not cached."""
+        with self._lock:
+            cached = self._chunks.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        chunk = self._read(path, stamp)
+        if chunk is None:
+            logger.debug("[MODULE] compile %s", path)
+            source = _wrap_module(path.read_text(encoding="utf-8"))
+            chunk = compile_lua_source(source, f"@{path}", runtime)
+            self._write(path, stamp, chunk)
+
+        with self._lock:
+            self._chunks[path] = (stamp, chunk)
+        return chunk
+
+    def clear(self) -> None:
+        """Forget the modules kept in memory, the files stay."""
+        with self._lock:
+            self._chunks.clear()
+
+    def get_cache_path(self, path: Path) -> Path:
+        """Get the file path of the cached bytecode."""
+        key = f"{get_version()}:{LUA_IMPLEMENTATION}:{path}"
+        return self.directory / f"{hashlib.sha256(key.encode()).hexdigest()}.luac"
+
+    def _read(self, path: Path, stamp: ModuleStamp) -> Optional[bytes]:
+        """Read the bytecode if it's compiled from the same file."""
+        try:
+            data = self.get_cache_path(path).read_bytes()
+        except OSError:
+            return None
+        if len(data) < HEADER.size or HEADER.unpack_from(data) != stamp:
+            return None
+        return data[HEADER.size :]
+
+    def _write(self, path: Path, stamp: ModuleStamp, chunk: bytes) -> None:
+        """Write the bytecode atomically, cache errors are not fatal."""
+        cache_path = self.get_cache_path(path)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with tempfile.NamedTemporaryFile(
+                dir=self.directory, suffix=".tmp", delete=False
+            ) as tmp_file:
+                tmp_file.write(HEADER.pack(*stamp) + chunk)
+            os.replace(tmp_file.name, cache_path)
+        except OSError as exc:
+            logger.debug("Module cache `%s` couldn't be written: %s", cache_path, exc)
+
+
+class ModuleLoader:
+    """
+    Load modules of a config evaluation, each module runs once.
+
+    Modules get `env` and `cmd` of the config like the config itself. Paths
+    of `cmd.include` are relative to the base directory, and `require` looks
+    for `name/of/module.lua` or `name/of/module/init.lua` in the base
+    directory and in the folders of `DOSH_LUA_PATH`.
+    """
+
+    def __init__(
+        self,
+        runtime: LuaRuntime,
+        env: Dict[str, Any],
+        commands: Dict[str, Any],
+        cache: Optional[ModuleCache] = None,
+    ) -> None:
+        """Initialize the loader of the runtime."""
+        base_directory = DoshInitializer().base_directory
+        extra_roots = (os.getenv("DOSH_LUA_PATH") or "").split(os.pathsep)
+        self.roots: List[Path] = [
+            base_directory,
+            *[base_directory / root for root in extra_roots if root],
+        ]
+        self.modules: Dict[Path, ModuleStamp] = {}
+        self._runtime = runtime
+        self._env = env
+        self._commands = commands
+        self._cache = cache or get_module_cache()
+        self._values: Dict[Path, Any] = {}
+        self._load_chunk: Optional[Callable[..., Any]] = None
+
+    def install(self) -> None:
+        """Add the `require` searcher of the loader to the runtime."""
+        self._runtime.eval(INSTALL_CODE)(self.find)
+
+    def include(self, path: str) -> Any:
+        """Run the module file once and return its result."""
+        module_path = self.roots[0] / Path(path).expanduser()
+        if not module_path.is_file() and module_path.suffix != ".lua":
+            module_path = module_path.with_name(f"{module_path.name}.lua")
+        if not module_path.is_file():
+            raise CommandException(f"Module file doesn't exist: {path}")
+        return self.load(module_path.resolve())
+
+    def find(self, name: str) -> Union[str, Tuple[Callable[..., Any], str]]:
+        """Find the module for `require`, the error is a string of tried paths."""
+        relative = Path(*name.split("."))
+        tried = []
+        for root in self.roots:
+            for candidate in (
+                root / relative.with_name(f"{relative.name}.lua"),
+                root / relative / "init.lua",
+            ):
+                if candidate.is_file():
+                    module_path = candidate.resolve()
+                    return functools.partial(self.load, module_path), str(module_path)
+                tried.append(f"\n\tno file '{candidate}'")
+        return "".join(tried)
+
+    def load(self, module_path: Path, *args: Any) -> Any:
+        """Run the module with the arguments if it hasn't run yet."""
+        if module_path in self._values:
+            return self._values[module_path]
+
+        stamp = get_stamp(module_path)
+        chunk = self._cache.get_chunk(module_path, stamp, self._runtime)
+        if self._load_chunk is None:
+            self._load_chunk = self._runtime.eval(LOAD_CODE)
+
+        self.modules[module_path] = stamp
+        value = self._load_chunk(chunk, f"@{module_path}")(
+            self._env, self._commands, *args
+        )
+        self._values[module_path] = value
+        return value
+
+
+def get_module_cache() -> ModuleCache:
+    """Get the module cache of dosh."""
+    global __MODULE_CACHE  # pylint: disable=global-statement
+
+    if __MODULE_CACHE is None:
+        __MODULE_CACHE = ModuleCache()
+
+    return __MODULE_CACHE
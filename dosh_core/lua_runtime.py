@@ -1,19 +1,225 @@
 """Lua runtime for parsing configuration files."""
 
-from typing import Any, Callable, Dict, Union
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Union
 
 from lupa import LuaRuntime
 
+__all__ = [
+    "LUA_IMPLEMENTATION",
+    "LuaFunction",
+    "LuaRuntime",
+    "LuaRuntimePool",
+    "LuaTable",
+    "compile_lua_chunk",
+    "compile_lua_source",
+    "create_lua_runtime",
+    "get_default_lua_runtime",
+    "get_lua_environment",
+    "get_lua_runtime",
+    "get_lua_runtime_pool",
+    "lua_runtime",
+    "reset_lua_runtime",
+    "use_lua_runtime",
+]
+
 LuaFunction = Callable[..., None]
 LuaTable = Dict[Union[str, int], Any]
-lua_runtime = LuaRuntime(unpack_returned_tuples=True)
+
+CHUNK_NAME = "=dosh.lua"
+
+# the module of the Lua implementation, like `lupa.lua54`.
+LUA_IMPLEMENTATION = LuaRuntime.__module__
+
+_local = threading.local()
+_default_lock = threading.Lock()
+_default_runtime: Optional[LuaRuntime] = None
+_pool_lock = threading.Lock()
+_pool: Optional["LuaRuntimePool"] = None
+
+# names of globals and modules of a new runtime, the others are removed in
+# `reset_lua_runtime`.
+SNAPSHOT_CODE = """
+function ()
+    local snapshot = { globals = {}, modules = {} }
+    for name in pairs(_G) do snapshot.globals[name] = true end
+    for name in pairs(package.loaded) do snapshot.modules[name] = true end
+    debug.getregistry()["dosh.snapshot"] = snapshot
+end
+"""
+
+RESET_CODE = """
+function ()
+    local snapshot = debug.getregistry()["dosh.snapshot"]
+    for name in pairs(_G) do
+        if not snapshot.globals[name] then _G[name] = nil end
+    end
+    for name in pairs(package.loaded) do
+        if not snapshot.modules[name] then package.loaded[name] = nil end
+    end
+    debug.getregistry()["dosh.loader"] = nil
+    collectgarbage("collect")
+    return collectgarbage("count")
+end
+"""
+
+# it's created by `__getattr__` when it's accessed first.
+lua_runtime: LuaRuntime
+
+
+def __getattr__(name: str) -> Any:
+    """Create the default `lua_runtime` on the first access."""
+    if name == "lua_runtime":
+        return get_default_lua_runtime()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def create_lua_runtime() -> LuaRuntime:
+    """Create a new Lua runtime, it can run in parallel with the others."""
+    runtime = LuaRuntime(unpack_returned_tuples=True)
+    runtime.eval(SNAPSHOT_CODE)()
+    return runtime
+
+
+def reset_lua_runtime(runtime: LuaRuntime) -> int:
+    """
+    Remove the globals and modules added since the runtime is created.
+
+    Values referenced only by the removed globals are collected, and the
+    memory used by the runtime is returned in bytes. Changes in the
+    standard library tables, like a new `string` function, are kept.
+    """
+    memory_kb: float = runtime.eval(RESET_CODE)()
+    return int(memory_kb * 1024)
+
+
+class LuaRuntimePool:
+    """
+    Reuse Lua runtimes between configs.
+
+    Released runtimes are reset and kept for the next config, unless the
+    pool is full or they use more than `max_memory` bytes after the reset.
+    """
+
+    def __init__(
+        self, max_size: Optional[int] = None, max_memory: int = 8 * 1024 * 1024
+    ) -> None:
+        """Initialize an empty pool, it keeps a runtime per CPU by default."""
+        self.max_size = max_size or os.cpu_count() or 1
+        self.max_memory = max_memory
+        self._idle: List[LuaRuntime] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Count the idle runtimes."""
+        return len(self._idle)
+
+    def acquire(self) -> LuaRuntime:
+        """Get an idle runtime or a new one."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return create_lua_runtime()
+
+    def release(self, runtime: LuaRuntime) -> None:
+        """Reset the runtime and keep it for the next config if it fits."""
+        if reset_lua_runtime(runtime) > self.max_memory:
+            return
+        with self._lock:
+            if len(self._idle) < self.max_size:
+                self._idle.append(runtime)
+
+    @contextmanager
+    def runtime(self) -> Iterator[LuaRuntime]:
+        """Acquire a runtime and release it after the block."""
+        runtime = self.acquire()
+        try:
+            yield runtime
+        finally:
+            self.release(runtime)
+
+
+def get_default_lua_runtime() -> LuaRuntime:
+    """Get the default Lua runtime, it's created when it's needed first."""
+    global _default_runtime  # pylint: disable=global-statement
+
+    with _default_lock:
+        if _default_runtime is None:
+            _default_runtime = create_lua_runtime()
+        return _default_runtime
+
+
+def get_lua_runtime_pool() -> LuaRuntimePool:
+    """Get the runtime pool of config parsers."""
+    global _pool  # pylint: disable=global-statement
+
+    with _pool_lock:
+        if _pool is None:
+            _pool = LuaRuntimePool()
+        return _pool
+
+
+def get_lua_runtime() -> LuaRuntime:
+    """Get the Lua runtime that is active in the current thread."""
+    runtime: Optional[LuaRuntime] = getattr(_local, "runtime", None)
+    return runtime or get_default_lua_runtime()
+
+
+@contextmanager
+def use_lua_runtime(runtime: LuaRuntime) -> Iterator[LuaRuntime]:
+    """Activate the Lua runtime in the current thread for the commands."""
+    previous = getattr(_local, "runtime", None)
+    _local.runtime = runtime
+    try:
+        yield runtime
+    finally:
+        _local.runtime = previous
+
+
+def _wrap_content(content: str) -> str:
+    """Wrap the config content with a function that returns its environment."""
+    return f"return function (env, cmd) {content} return env end"
+
+
+def compile_lua_chunk(content: str) -> bytes:
+    """Compile the config content and return its Lua bytecode."""
+    return compile_lua_source(_wrap_content(content), CHUNK_NAME)
+
+
+def compile_lua_source(
+    source: str, chunk_name: str, runtime: Optional[LuaRuntime] = None
+) -> bytes:
+    """Compile the Lua source and return its bytecode."""
+    # lupa decodes every string returned from Lua, so the bytecode is passed
+    # through as a hex string.
+    dump_func = (runtime or get_lua_runtime()).eval(
+        """
+        function (code, name)
+            local func = assert(load(code, name, "t"))
+            return (string.dump(func):gsub(".", function (char)
+                return string.format("%02x", char:byte())
+            end))
+        end
+        """
+    )
+    return bytes.fromhex(dump_func(source, chunk_name))
 
 
 def get_lua_environment(
-    content: str, envs: Dict[str, Any], commands: Dict[str, Any]
+    content: str,
+    envs: Dict[str, Any],
+    commands: Dict[str, Any],
+    chunk: Optional[bytes] = None,
 ) -> Dict[str, Any]:
-    """Get lua environment variables."""
-    lua_code = f"function (env, cmd) {content} return env end"
-    lua_func = lua_runtime.eval(lua_code)
+    """Get lua environment variables, using the compiled chunk if it's given."""
+    load_func = get_lua_runtime().eval(
+        "function (code, name, mode) return assert(load(code, name, mode))() end"
+    )
+    if chunk is None:
+        lua_func = load_func(_wrap_content(content), CHUNK_NAME, "t")
+    else:
+        lua_func = load_func(chunk, CHUNK_NAME, "b")
     result: Dict[str, Any] = lua_func(envs, commands)
     return result
@@ -0,0 +1,115 @@
+"""Dependency graph scheduler for dosh tasks."""
+
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Set
+
+from dosh_core.commands.base import Task
+from dosh_core.logger import get_logger
+
+__all__ = ["TaskDependencyError", "TaskScheduler"]
+
+logger = get_logger()
+
+TaskRunner = Callable[[str], bool]
+
+
+class TaskDependencyError(Exception):
+    """Task dependency graph is not valid."""
+
+
+class TaskScheduler:
+    """Run dependencies of a task, independent ones concurrently."""
+
+    def __init__(self, tasks: List[Task], jobs: int = 1) -> None:
+        """Index tasks by their names."""
+        self.tasks: Dict[str, Task] = {}
+        for task in tasks:
+            self.tasks.setdefault(task.name, task)
+        self.jobs = max(jobs, 1)
+
+    def resolve(self, task_name: str) -> List[str]:
+        """Get all dependencies of the task in topological order."""
+        ordered: List[str] = []
+        visited: Set[str] = set()
+        path: List[str] = []
+
+        def visit(name: str) -> None:
+            if name in path:
+                cycle = path[path.index(name) :] + [name]
+                raise TaskDependencyError(
+                    f"Circular task dependency: {' -> '.join(cycle)}"
+                )
+
+            if name in visited:
+                return
+
+            path.append(name)
+            for dependency in self.tasks[name].depends_on:
+                if dependency not in self.tasks:
+                    raise TaskDependencyError(
+                        f"The task `{name}` depends on an unknown task `{dependency}`."
+                    )
+                visit(dependency)
+            path.pop()
+
+            visited.add(name)
+            ordered.append(name)
+
+        visit(task_name)
+        return ordered[:-1]
+
+    def run(self, task_names: List[str], runner: TaskRunner) -> bool:
+        """
+        Run the tasks once each, respecting their dependencies.
+
+        Tasks are run with up to `jobs` worker threads. The first failure
+        cancels the tasks waiting to start, the running ones are awaited.
+        """
+        if self.jobs == 1:
+            return all(self._run(runner, name) for name in task_names)
+
+        names = set(task_names)
+        pending = {
+            name: set(self.tasks[name].depends_on) & names for name in task_names
+        }
+        completed: Set[str] = set()
+        running: Dict[Future[bool], str] = {}
+        failed = False
+
+        with ThreadPoolExecutor(
+            max_workers=self.jobs, thread_name_prefix="dosh-task"
+        ) as executor:
+            while pending or running:
+                if not failed:
+                    for name in [n for n, d in pending.items() if d <= completed]:
+                        del pending[name]
+                        running[executor.submit(self._run, runner, name)] = name
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    if future.cancelled():
+                        continue
+
+                    if future.result():
+                        completed.add(name)
+                    elif not failed:
+                        failed = True
+                        for sibling in running:
+                            sibling.cancel()
+
+        return not failed
+
+    @staticmethod
+    def _run(runner: TaskRunner, task_name: str) -> bool:
+        """Run the task and report errors as a failure."""
+        try:
+            return runner(task_name)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("The task `%s` failed: %s", task_name, exc)
+            return False
@@ -0,0 +1,203 @@
+"""Timing spans of tasks and commands, exported as Chrome trace events."""
+
+from __future__ import annotations
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+)
+
+try:
+    import resource
+except ImportError:  # pragma: no cover, not available on windows.
+    resource = None  # type: ignore[assignment]
+
+__all__ = ["Span", "Tracer", "get_tracer", "traced"]
+
+__TRACER: Optional[Tracer] = None
+
+T = TypeVar("T")
+
+_NULL_CONTEXT = contextlib.nullcontext()
+
+
+def _get_children_cpu_time() -> float:
+    """Get CPU time of the finished child processes in seconds."""
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+@dataclass
+class Span:
+    """A timed step, like a task or a command."""
+
+    name: str
+    category: str
+    thread_id: int
+    start_ns: int
+    duration_ns: int = 0
+    cpu_ns: int = 0
+    children_cpu: float = 0.0
+    args: Dict[str, Any] = field(default_factory=dict)
+
+    def to_trace_event(self, origin_ns: int) -> Dict[str, Any]:
+        """Convert the span to a complete event of the Chrome trace format."""
+        return {
+            "name": self.name,
+            "cat": self.category,
+            "ph": "X",
+            "pid": os.getpid(),
+            "tid": self.thread_id,
+            "ts": (self.start_ns - origin_ns) / 1000,
+            "dur": self.duration_ns / 1000,
+            "args": {
+                "cpu_ms": self.cpu_ns / 1e6,
+                "children_cpu_ms": self.children_cpu * 1000,
+                **self.args,
+            },
+        }
+
+
+class Tracer:
+    """
+    Record nested spans of a dosh run.
+
+    Spans are recorded only when the tracer is enabled, otherwise `span`
+    returns a shared no-op context manager.
+    """
+
+    def __init__(self, enabled: bool = False) -> None:
+        """Initialize the tracer."""
+        self.enabled = enabled
+        self.spans: List[Span] = []
+        self._origin_ns = time.perf_counter_ns()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_ids: Dict[int, int] = {}
+
+    def enable(self) -> None:
+        """Start recording spans."""
+        self.enabled = True
+
+    def span(
+        self, name: str, category: str = "dosh", **args: Any
+    ) -> ContextManager[Any]:
+        """Time the block as a span, it's a no-op if the tracer is disabled."""
+        if not self.enabled:
+            return _NULL_CONTEXT
+        return self._record(name, category, args)
+
+    def annotate(self, **args: Any) -> None:
+        """Add arguments like moved bytes to the innermost span of the thread."""
+        stack: List[Span] = getattr(self._local, "stack", [])
+        if self.enabled and stack:
+            span = stack[-1]
+            for key, value in args.items():
+                if isinstance(value, (int, float)) and key in span.args:
+                    span.args[key] += value
+                else:
+                    span.args[key] = value
+
+    @contextlib.contextmanager
+    def _record(self, name: str, category: str, args: Dict[str, Any]) -> Iterator[Span]:
+        """Record the span with its timings."""
+        span = Span(
+            name, category, self._get_thread_id(), time.perf_counter_ns(), args=args
+        )
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        self._local.stack.append(span)
+        cpu_start = time.thread_time_ns()
+        children_start = _get_children_cpu_time()
+        try:
+            yield span
+        finally:
+            span.duration_ns = time.perf_counter_ns() - span.start_ns
+            span.cpu_ns = time.thread_time_ns() - cpu_start
+            span.children_cpu = _get_children_cpu_time() - children_start
+            self._local.stack.pop()
+            with self._lock:
+                self.spans.append(span)
+
+    def _get_thread_id(self) -> int:
+        """Get a small number for the current thread."""
+        ident = threading.get_ident()
+        with self._lock:
+            return self._thread_ids.setdefault(ident, len(self._thread_ids) + 1)
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        """Get the spans in the Chrome trace event format, for Perfetto."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.start_ns)
+        return {
+            "traceEvents": [span.to_trace_event(self._origin_ns) for span in spans],
+            "displayTimeUnit": "ms",
+        }
+
+    def export_chrome_trace(self, path: Path) -> None:
+        """Write the spans as a Chrome trace file."""
+        path.write_text(json.dumps(self.to_chrome_trace()), encoding="utf-8")
+
+    def format_summary(self, limit: int = 10) -> str:
+        """Format the slowest spans as a table."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda span: span.duration_ns, reverse=True)
+
+        name_len = max([len(span.name) for span in spans[:limit]] + [4])
+        lines = [
+            f"{'STEP'.ljust(name_len)}  {'WALL ms':>10}  {'CPU ms':>10}  "
+            f"{'CHILD ms':>10}  {'BYTES':>12}"
+        ]
+        for span in spans[:limit]:
+            moved = span.args.get("bytes")
+            lines.append(
+                f"{span.name.ljust(name_len)}  {span.duration_ns / 1e6:>10.1f}  "
+                f"{span.cpu_ns / 1e6:>10.1f}  {span.children_cpu * 1000:>10.1f}  "
+                f"{'-' if moved is None else moved:>12}"
+            )
+        return "\n".join(lines)
+
+
+def get_tracer() -> Tracer:
+    """Get the tracer of dosh, it's enabled if `DOSH_PROFILE` is set."""
+    global __TRACER  # pylint: disable=global-statement
+
+    if __TRACER is None:
+        __TRACER = Tracer(enabled=bool(os.getenv("DOSH_PROFILE")))
+
+    return __TRACER
+
+
+def traced(
+    name: str, category: str = "command"
+) -> Callable[[Callable[..., T]], Callable[..., T]]:
+    """Record each call of the function as a span."""
+
+    def decorator(func: Callable[..., T]) -> Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> T:
+            tracer = get_tracer()
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
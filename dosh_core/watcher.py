@@ -0,0 +1,563 @@
+"""Watch mode, running a task again when its files change."""
+
+from __future__ import annotations
+
+import abc
+import ctypes
+import ctypes.util
+import os
+import re
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Pattern, Set, Tuple
+
+from dosh_core.commands.base import normalize_path
+from dosh_core.commands.scanner import compile_glob
+from dosh_core.config import ConfigParser
+from dosh_core.logger import flush_logs, get_logger
+
+__all__ = [
+    "InotifyWatcher",
+    "PollingWatcher",
+    "TaskWatcher",
+    "WatchTarget",
+    "Watcher",
+    "create_watcher",
+]
+
+logger = get_logger()
+
+# inotify constants of linux/inotify.h
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+# seconds to check the running task and the stop request.
+TICK = 0.1
+# seconds to wait for a cancelled task before it's killed.
+CANCEL_TIMEOUT = 2.0
+
+# folders written by each run, watching them would trigger runs forever.
+IGNORED_DIRECTORIES = frozenset((".dosh",))
+
+FileStamp = Tuple[int, int]
+
+
+@dataclass(frozen=True)
+class WatchTarget:
+    """A folder to watch and the pattern of relative paths in it."""
+
+    root: Path
+    regex: Optional[Pattern[str]] = None
+    recursive: bool = True
+
+    @classmethod
+    def from_pattern(cls, pattern: str) -> WatchTarget:
+        """Parse a path or glob pattern, relative to the base directory."""
+        path = normalize_path(pattern)
+        for index, part in enumerate(path.parts):
+            if any(char in part for char in "*?["):
+                rest = "/".join(path.parts[index:])
+                return cls(Path(*path.parts[:index]), compile_glob(rest), "/" in rest)
+
+        if path.is_dir():
+            return cls(path)
+        return cls(path.parent, re.compile(f"{re.escape(path.name)}\\Z"), False)
+
+    def matches(self, path: Path) -> bool:
+        """Check if the path is watched by the target."""
+        try:
+            relative = path.relative_to(self.root).as_posix()
+        except ValueError:
+            return False
+        if not self.recursive and "/" in relative:
+            return False
+        if IGNORED_DIRECTORIES.intersection(relative.split("/")[:-1]):
+            return False
+        return self.regex is None or bool(self.regex.match(relative))
+
+
+class Watcher(abc.ABC):
+    """Wait for changes of the files matching the patterns."""
+
+    def __init__(self, patterns: List[str]) -> None:
+        """Parse the patterns."""
+        self.patterns = patterns
+        self.targets = [WatchTarget.from_pattern(pattern) for pattern in patterns]
+
+    def __enter__(self) -> Watcher:
+        """Use the watcher in a `with` block."""
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        """Close the watcher."""
+        self.close()
+
+    def matches(self, path: Path) -> bool:
+        """Check if any target watches the path."""
+        return any(target.matches(path) for target in self.targets)
+
+    @abc.abstractmethod
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        """Wait for changes, an empty set means the timeout is reached."""
+
+    def close(self) -> None:
+        """Release the resources of the watcher."""
+
+
+class PollingWatcher(Watcher):
+    """Compare modification times and sizes of the files periodically."""
+
+    def __init__(self, patterns: List[str], interval: float = 0.25) -> None:
+        """Take the first snapshot of the files."""
+        super().__init__(patterns)
+        self.interval = interval
+        self._snapshot = self._take_snapshot()
+
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        """Check the files until they change or the timeout is reached."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            snapshot = self._take_snapshot()
+            changes = {
+                path
+                for path in snapshot.keys() | self._snapshot.keys()
+                if snapshot.get(path) != self._snapshot.get(path)
+            }
+            self._snapshot = snapshot
+            if changes:
+                return changes
+
+            if deadline is None:
+                time.sleep(self.interval)
+                continue
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return set()
+            time.sleep(min(self.interval, remaining))
+
+    def _take_snapshot(self) -> Dict[Path, FileStamp]:
+        """Get modification times and sizes of the watched files."""
+        snapshot: Dict[Path, FileStamp] = {}
+        for target in self.targets:
+            for directory, subdirectories, file_names in os.walk(target.root):
+                subdirectories[:] = [
+                    name for name in subdirectories if name not in IGNORED_DIRECTORIES
+                ]
+                for file_name in file_names:
+                    path = Path(directory, file_name)
+                    if not target.matches(path):
+                        continue
+                    try:
+                        stat = path.stat()
+                    except OSError:
+                        continue
+                    snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+                if not target.recursive:
+                    break
+        return snapshot
+
+
+def _get_libc() -> Optional[ctypes.CDLL]:
+    """Get the C library if it supports inotify."""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, "inotify_init1") else None
+
+
+class InotifyWatcher(Watcher):
+    """Get changes from inotify of Linux, folders are watched recursively."""
+
+    def __init__(self, patterns: List[str]) -> None:
+        """Start watching the folders of the targets."""
+        super().__init__(patterns)
+        libc = _get_libc()
+        if libc is None:
+            raise OSError("inotify is not available.")
+
+        self._libc = libc
+        self._fd: int = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._directories: Dict[int, Path] = {}
+        for target in self.targets:
+            self._add_tree(target.root, target.recursive)
+
+    def wait(self, timeout: Optional[float] = None) -> Set[Path]:
+        """Read events until there are changes or the timeout is reached."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.monotonic(), 0)
+            readable, _, _ = select.select([self._fd], [], [], remaining)
+            if not readable:
+                return set()
+
+            changes = self._read_events()
+            if changes:
+                return changes
+
+    def close(self) -> None:
+        """Close the inotify instance."""
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+    def _add_tree(self, root: Path, recursive: bool) -> None:
+        """Watch the folder, and its sub folders if it's recursive."""
+        if not root.is_dir():
+            logger.warning("[WATCH] `%s` doesn't exist, it's not watched.", root)
+            return
+
+        for directory, subdirectories, _ in os.walk(root):
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), WATCH_MASK
+            )
+            if wd >= 0:
+                self._directories[wd] = Path(directory)
+            if not recursive:
+                subdirectories.clear()
+            subdirectories[:] = [
+                name for name in subdirectories if name not in IGNORED_DIRECTORIES
+            ]
+
+    def _read_events(self) -> Set[Path]:
+        """Read the pending events and get the watched paths of them."""
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changes: Set[Path] = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changes.update(target.root for target in self.targets)
+                continue
+            if mask & IN_IGNORED:
+                self._directories.pop(wd, None)
+                continue
+
+            directory = self._directories.get(wd)
+            if directory is None or not name:
+                continue
+
+            path = directory / name
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and name not in IGNORED_DIRECTORIES:
+                    self._add_new_directory(path)
+                continue
+            if self.matches(path):
+                changes.add(path)
+        return changes
+
+    def _add_new_directory(self, path: Path) -> None:
+        """Watch a new folder in a recursive target."""
+        for target in self.targets:
+            if target.recursive and path.is_relative_to(target.root):
+                self._add_tree(path, recursive=True)
+                return
+
+
+def create_watcher(patterns: List[str], use_polling: bool = False) -> Watcher:
+    """Create an inotify watcher if it's available, or a polling one."""
+    if not use_polling:
+        try:
+            return InotifyWatcher(patterns)
+        except OSError as exc:
+            logger.debug("[WATCH] inotify is not used: %s", exc)
+    return PollingWatcher(patterns)
+
+
+def _ignore_signal(*_: object) -> None:
+    """Let the wakeup file descriptor handle the signal."""
+
+
+def _cancel_on_signal(read_fd: int) -> None:
+    """
+    Wait for SIGTERM in a thread of the run, then stop the run.
+
+    Lua code runs without the GIL, so the thread stops the run even if a
+    handler in the main thread can't run yet. The processes spawned in own
+    sessions are terminated first, then the process group of the run is
+    killed, so the task doesn't continue.
+    """
+    while os.read(read_fd, 1) != bytes([signal.SIGTERM]):
+        pass
+    _terminate_processes()
+    flush_logs()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.killpg(0, signal.SIGKILL)
+
+
+def _terminate_processes() -> None:
+    """Terminate the processes spawned by the run, they're in own sessions."""
+    # pylint: disable-next=import-outside-toplevel
+    from dosh_core.commands.processes import get_process_engine
+
+    # the run is killed after the cancel timeout, cleanup must finish before.
+    get_process_engine().terminate_all(CANCEL_TIMEOUT / 2)
+
+
+class TaskWatcher:
+    """
+    Run the task, and run it again when its watched files change.
+
+    The task watches the paths in its `watch` field, or its `inputs`. Bursts
+    of changes are merged until there's no change for `debounce` seconds.
+    The config is evaluated once and again only if the config file or one
+    of its modules changes. Each run is forked from the watcher, so a newer
+    change cancels the running task with its processes, including the ones
+    started by `cmd.spawn` in their own sessions. Without `fork`, runs are
+    not cancelled, the task runs again after the current run.
+    """
+
+    def __init__(
+        self,
+        config_path: Path,
+        task_name: str,
+        params: Optional[List[str]] = None,
+        debounce: float = 0.2,
+        force: bool = False,
+        jobs: int = 1,
+        use_polling: bool = False,
+        use_fork: Optional[bool] = None,
+    ) -> None:
+        """Initialize the watcher, it starts in `run`."""
+        self.config_path = config_path.absolute()
+        self.task_name = task_name
+        self.params = params or []
+        self.debounce = debounce
+        self.force = force
+        self.jobs = jobs
+        self.use_polling = use_polling
+        self.use_fork = hasattr(os, "fork") if use_fork is None else use_fork
+        self.runs = 0
+        self._parser: Optional[ConfigParser] = None
+        self._watcher: Optional[Watcher] = None
+        self._config_paths: Set[Path] = set()
+        self._child: Optional[int] = None
+        self._stop = threading.Event()
+
+    def run(self, max_runs: Optional[int] = None) -> None:
+        """Watch until `stop` is called, or the task has run `max_runs` times."""
+        is_loaded = self._load_config()
+        if is_loaded:
+            self._start_run()
+
+        try:
+            while not self._stop.is_set():
+                self._reap_child()
+                if max_runs is not None and self.runs >= max_runs:
+                    if self._child is None:
+                        break
+                    self._wait_changes()
+                    continue
+
+                changes = self._wait_changes()
+                if not changes:
+                    continue
+
+                logger.debug("[WATCH] changed: %s", ", ".join(map(str, changes)))
+                self._cancel_run()
+                if changes & self._config_paths or not is_loaded:
+                    is_loaded = self._load_config()
+                if is_loaded:
+                    self._start_run()
+        finally:
+            self._cancel_run()
+            if self._watcher is not None:
+                self._watcher.close()
+            if self._parser is not None:
+                self._parser.close()
+
+    def stop(self) -> None:
+        """Stop watching, the running task is cancelled."""
+        self._stop.set()
+
+    def _load_config(self) -> bool:
+        """Evaluate the config and watch the paths of the task."""
+        try:
+            parser = ConfigParser.from_file(self.config_path, use_cache=False)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.error("[WATCH] The config can't be evaluated: %s", exc)
+            self._watch([str(self.config_path), *map(str, self._config_paths)])
+            return False
+
+        if self._parser is not None:
+            self._parser.close()
+        self._parser = parser
+        self._config_paths = {self.config_path, *parser.module_paths}
+
+        task = next((t for t in parser.tasks if t.name == self.task_name), None)
+        patterns = [] if task is None else task.watch or task.inputs
+        if task is None:
+            logger.error("The task `%s` doesn't exist.", self.task_name)
+        elif not patterns:
+            logger.warning("[WATCH] The task `%s` has no files to watch.", task.name)
+
+        self._watch([*map(str, self._config_paths), *patterns])
+        return task is not None
+
+    def _watch(self, patterns: List[str]) -> None:
+        """Watch the patterns, the watcher is created again if they change."""
+        if self._watcher is not None and self._watcher.patterns == patterns:
+            return
+        if self._watcher is not None:
+            self._watcher.close()
+        self._watcher = create_watcher(patterns, self.use_polling)
+
+    def _wait_changes(self) -> Set[Path]:
+        """Wait a tick for changes, and collect changes until they stop."""
+        assert self._watcher is not None
+        changes = self._watcher.wait(TICK)
+        if changes:
+            while True:
+                more = self._watcher.wait(self.debounce)
+                if not more:
+                    break
+                changes |= more
+        return changes
+
+    def _start_run(self) -> None:
+        """Run the task in a child process, or in this process without fork."""
+        assert self._parser is not None
+        self.runs += 1
+        logger.info("[WATCH] `%s` runs (#%s).", self.task_name, self.runs)
+        if not self.use_fork:
+            self._log_result(self._run_task())
+            return
+
+        flush_logs()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 1
+            try:
+                os.setpgid(0, 0)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                read_fd, write_fd = os.pipe()
+                os.set_blocking(write_fd, False)
+                signal.set_wakeup_fd(write_fd)
+                signal.signal(signal.SIGTERM, _ignore_signal)
+                threading.Thread(
+                    target=_cancel_on_signal, args=(read_fd,), daemon=True
+                ).start()
+                exit_code = self._run_task()
+            finally:
+                _terminate_processes()
+                flush_logs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exit_code)
+
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass
+        self._child = pid
+
+    def _run_task(self) -> int:
+        """Run the task and get its exit code."""
+        assert self._parser is not None
+        try:
+            is_successful = self._parser.run_task(
+                self.task_name, self.params, jobs=self.jobs, force=self.force
+            )
+        except Exception:  # pylint: disable=broad-except
+            traceback.print_exc()
+            return 1
+        return 0 if is_successful else 1
+
+    def _reap_child(self, block: bool = False) -> bool:
+        """Check if the running task has finished, and log its result."""
+        if self._child is None:
+            return True
+        pid, status = os.waitpid(self._child, 0 if block else os.WNOHANG)
+        if pid == 0:
+            return False
+        self._child = None
+        self._log_result(os.waitstatus_to_exitcode(status))
+        return True
+
+    def _cancel_run(self) -> None:
+        """Stop the running task and its processes."""
+        pid = self._child
+        if pid is None or self._reap_child():
+            return
+
+        # the run terminates its spawned processes and kills its group.
+        logger.warning("[WATCH] `%s` is cancelled.", self.task_name)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+        deadline = time.monotonic() + CANCEL_TIMEOUT
+        while not self._reap_child():
+            if time.monotonic() > deadline:
+                self._signal_group(pid, signal.SIGKILL)
+                self._reap_child(block=True)
+                break
+            time.sleep(0.01)
+        # processes left in the group of the run are killed.
+        self._signal_group(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _signal_group(pgid: int, signal_number: int) -> None:
+        """Send the signal to the process group of a run, it may be gone."""
+        try:
+            os.killpg(pgid, signal_number)
+        except OSError:
+            pass
+
+    def _log_result(self, exit_code: int) -> None:
+        """Log the result of a run."""
+        if exit_code == 0:
+            logger.info("[WATCH] `%s` is done, waiting for changes.", self.task_name)
+        else:
+            logger.error(
+                "[WATCH] `%s` failed (exit code: %s), waiting for changes.",
+                self.task_name,
+                exit_code,
+            )
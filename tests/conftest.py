@@ -0,0 +1,8 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_directory(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "dosh-cache"
+    monkeypatch.setenv("DOSH_CACHE_DIR", str(cache_dir))
+    return cache_dir
@@ -0,0 +1,53 @@
+import contextlib
+import json
+
+from benchmarks import runner
+from benchmarks.runner import Benchmark, Case, compare_results, run_benchmarks
+
+
+def test_run_benchmarks():
+    calls = []
+
+    @contextlib.contextmanager
+    def setup(workdir, size):
+        assert workdir.is_dir()
+        yield Case(lambda: calls.append(size) or size, reset=lambda: calls.append(0))
+
+    bench = Benchmark("sample", setup, params=(1, 2), quick_params=(1,), number=2)
+    results = run_benchmarks(benchmarks=[bench], quick=True, repeat=3)
+
+    assert list(results) == ["sample[1]"]
+    assert results["sample[1]"].repeat == 3
+    assert results["sample[1]"].throughput > 0
+    # one warm up call and two calls per timing, each one is reset first.
+    assert calls == [0, 1] * 7
+
+    results = run_benchmarks(["sample[2]"], benchmarks=[bench], repeat=1)
+    assert list(results) == ["sample[2]"]
+
+
+def test_compare_results():
+    baseline = {"a": {"median": 1.0}, "b": {"median": 1.0}, "c": {"median": 1.0}}
+    current = {"a": {"median": 1.1}, "b": {"median": 1.5}, "d": {"median": 1.0}}
+
+    comparisons = {c.name: c for c in compare_results(baseline, current, 0.2)}
+
+    assert comparisons["a"].ratio == 1.1 and not comparisons["a"].is_regression
+    assert comparisons["b"].is_regression
+    assert comparisons["c"].current is None and not comparisons["c"].is_regression
+    assert comparisons["d"].baseline is None and not comparisons["d"].is_regression
+
+
+def test_main(tmp_path, monkeypatch):
+    baseline_path = tmp_path / "baseline.json"
+    output_path = tmp_path / "results.json"
+    args = ["config_parse[10]", "--repeat", "1", "--baseline", str(baseline_path)]
+
+    assert runner.main([*args, "--save-baseline"]) == 0
+    data = json.loads(baseline_path.read_text())
+    assert list(data["benchmarks"]) == ["config_parse[10]"]
+
+    data["benchmarks"]["config_parse[10]"]["median"] /= 100
+    baseline_path.write_text(json.dumps(data))
+    assert runner.main([*args, "--output", str(output_path)]) == 1
+    assert json.loads(output_path.read_text())["environment"] == data["environment"]
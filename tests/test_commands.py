@@ -1,13 +1,28 @@
+import asyncio
+import hashlib
+import http.client
+import json
+import os
 import pathlib
 import platform
+import subprocess
+import time
 import urllib.request
 from pathlib import Path
 
 import pytest
+from werkzeug import Response
 
+from dosh_core.commands import COMMANDS, packages, processes
 from dosh_core.commands import external as cmd
-from dosh_core.commands.base import CommandException, normalize_path
+from dosh_core.commands.base import CommandException, get_command_args, normalize_path
+from dosh_core.commands.copier import copy_file_data
+from dosh_core.commands.http_cache import HttpCache
+from dosh_core.commands.output import RingBuffer, run_and_capture
+from dosh_core.commands.packages import PackageInstaller
+from dosh_core.commands.resolver import CommandResolver
 from dosh_core.logger import get_logger, set_verbosity
+from dosh_core.lua_runtime import lua_runtime
 
 logger = get_logger()
 
@@ -87,6 +102,66 @@ def test_exists(tmp_path):
     assert cmd.exists(str(src_path3))
 
 
+def test_file_system_commands(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = lua_runtime.table_from
+
+    assert cmd.mkdir(table(["a/b", "c"])) == 2
+    assert cmd.mkdir(table(["a/b", "c"])) == 0
+    assert cmd.mkdir("d", table({"mode": "700"})) == 1
+    assert (tmp_path / "d").stat().st_mode & 0o777 == 0o700
+
+    # unchanged files keep their modification times.
+    assert cmd.write_file("a/b/file.txt", "hello", table({"mode": "600"}))
+    mtime = os.stat("a/b/file.txt").st_mtime_ns
+    assert not cmd.write_file("a/b/file.txt", "hello")
+    assert os.stat("a/b/file.txt").st_mtime_ns == mtime
+    assert cmd.write_file("a/b/file.txt", "hello!")
+    assert (tmp_path / "a/b/file.txt").stat().st_mode & 0o777 == 0o600
+
+    assert cmd.chmod("a/b/file.txt", "u+x,g=r") == 1
+    assert cmd.chmod("a/b/file.txt", "740") == 0
+    assert cmd.chmod("a", "go-rwx", table({"recursive": True})) == 3
+    assert cmd.chmod("a", "go-rwx", table({"recursive": True})) == 0
+
+    # a file at the link path is replaced, a correct link is skipped.
+    (tmp_path / "c/config").write_text("old")
+    assert cmd.link("a/b/file.txt", "c/config") == 1
+    assert cmd.link("a/b/file.txt", "c/config") == 0
+    assert (tmp_path / "c/config").read_text() == "hello!"
+    assert cmd.link("a/b/file.txt", "c/config", table({"relative": True})) == 1
+    assert os.readlink("c/config") == "../a/b/file.txt"
+    assert cmd.link(table(["a/b/*.txt", "d"]), "links") == 2
+    assert (tmp_path / "links/d").is_dir()
+    with pytest.raises(CommandException):
+        cmd.link("a/b/file.txt", "c")
+
+    assert cmd.move("a/b/file.txt", "e/moved.txt") == 1
+    assert cmd.move("a/b/file.txt", "e/moved.txt") == 0
+    assert cmd.move(table(["e/*.txt"]), "f") == 1
+    assert (tmp_path / "f/moved.txt").read_text() == "hello!"
+
+    assert cmd.remove(table(["a", "f/*.txt", "missing"])) == 2
+    assert cmd.remove("a") == 0
+    assert sorted(os.listdir("f")) == []
+
+    # empty paths, the base directory and the root are never removed.
+    for path in ("", ".", "f/..", "/"):
+        with pytest.raises(CommandException):
+            cmd.remove(path)
+    assert (tmp_path / "f").is_dir()
+
+    # Lua has no octal literals, numbers are read as octal digits.
+    assert cmd.chmod("f", 750) == 1
+    assert (tmp_path / "f").stat().st_mode & 0o7777 == 0o750
+    assert cmd.mkdir("g", table({"mode": 700})) == 1
+    assert (tmp_path / "g").stat().st_mode & 0o7777 == 0o700
+    assert cmd.write_file("g/file.txt", "", table({"mode": 640}))
+    assert (tmp_path / "g/file.txt").stat().st_mode & 0o7777 == 0o640
+    with pytest.raises(CommandException):
+        cmd.chmod("f", 789)
+
+
 def test_exists_command():
     if platform.system() == "Windows":
         assert cmd.exists_command("cmd.exe")
@@ -132,3 +207,653 @@ def test_scan_directory(monkeypatch):
     with pytest.raises(CommandException) as excinfo:
         cmd.scan_directory("./README.md")
         assert str(excinfo.value) == "Not a folder: ./README.md"
+
+
+def test_scan_directory_recursive(tmp_path):
+    for path in ["a.py", "src/b.py", "src/c.lua", "src/deep/d.py", "build/e.py"]:
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).touch()
+    (tmp_path / ".gitignore").write_text("# build output\nbuild/\n")
+
+    def scan(**opts):
+        options = lua_runtime.table_from(opts, recursive=True)
+        result = cmd.scan_directory(str(tmp_path), options)
+        return [os.path.relpath(p, tmp_path) for p in result.values()]
+
+    assert scan(include_dirs=False) == [".gitignore", "a.py"]
+    assert scan(recursive=True, pattern="*.py", gitignore=True) == [
+        "a.py",
+        os.path.join("src", "b.py"),
+        os.path.join("src", "deep", "d.py"),
+    ]
+    assert scan(max_depth=2, pattern="src/*", include_dirs=False) == [
+        os.path.join("src", "b.py"),
+        os.path.join("src", "c.lua"),
+    ]
+    assert scan(recursive=True, excludes=["src/**/*.py", "!src/b.py", ".*"]) == [
+        "a.py",
+        "build",
+        os.path.join("build", "e.py"),
+        "src",
+        os.path.join("src", "b.py"),
+        os.path.join("src", "c.lua"),
+        os.path.join("src", "deep"),
+    ]
+
+    iterator = cmd.scan_directory(
+        str(tmp_path), lua_runtime.table_from({"iterate": True, "recursive": True})
+    )
+    count_paths = lua_runtime.eval(
+        "function (iterator) local n = 0 for _ in iterator do n = n + 1 end return n end"
+    )
+    assert count_paths(iterator) == 9
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix shell commands")
+def test_spawn_and_wait(tmp_path):
+    started_at = time.monotonic()
+    handles = [cmd.spawn(f"sleep 0.5; exit {code}") for code in (0, 3)]
+    return_codes = cmd.wait_all(lua_runtime.table_from(handles))
+    assert list(return_codes.values()) == [0, 3]
+    assert time.monotonic() - started_at < 0.9
+
+    opts = lua_runtime.table_from({"env": {"GREETING": "hi"}, "cwd": str(tmp_path)})
+    handle = cmd.spawn('echo "$GREETING" > greeting.txt', opts)
+    assert cmd.wait(handle) == 0
+    assert (tmp_path / "greeting.txt").read_text() == "hi\n"
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix process groups")
+def test_spawn_timeout_kills_process_group(tmp_path):
+    pid_file = tmp_path / "child.pid"
+    opts = lua_runtime.table_from({"timeout": 0.3})
+    handle = cmd.spawn(f"sleep 30 & echo $! > {pid_file}; wait", opts)
+
+    assert cmd.wait(handle) != 0
+    assert handle.timed_out
+
+    # the orphaned child is killed, it may stay as a zombie until it's reaped.
+    assert_killed(pid_file.read_text().strip())
+
+    handle = cmd.spawn("sleep 30")
+    cmd.kill(handle)
+    assert cmd.wait(handle) != 0
+    assert handle.cancelled
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix process groups")
+def test_spawn_timeout_flushes_output(capsys):
+    opts = lua_runtime.table_from({"timeout": 0.3, "prefix": "slow"})
+    command = "trap 'seq 5000; exit 1' TERM; echo started; sleep 30 & wait"
+    handle = cmd.spawn(command, opts)
+    assert cmd.wait(handle) != 0
+    assert handle.timed_out
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[0] == "[slow] started"
+    assert lines[1:] == [f"[slow] {number}" for number in range(1, 5001)]
+
+    async def get_pumps():
+        return [
+            task
+            for task in asyncio.all_tasks()
+            if task.get_coro().__qualname__.endswith("._pump")
+        ]
+
+    loop = processes.get_process_engine()._get_loop()
+    assert asyncio.run_coroutine_threadsafe(get_pumps(), loop).result() == []
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix process groups")
+def test_run_and_capture_kills_process_group(tmp_path):
+    pid_file = tmp_path / "child.pid"
+
+    def on_line(line, stream):
+        raise RuntimeError("stop")
+
+    with pytest.raises(RuntimeError):
+        run_and_capture(
+            f"sleep 30 > /dev/null 2>&1 & echo $! > {pid_file}; echo started; wait",
+            on_line=on_line,
+        )
+    assert_killed(pid_file.read_text().strip())
+
+
+def assert_killed(pid):
+    for _ in range(50):
+        result = subprocess.run(
+            ["ps", "-o", "stat=", "-p", pid], capture_output=True, text=True
+        )
+        state = result.stdout.strip()
+        if not state or state.startswith("Z"):
+            break
+        time.sleep(0.05)
+    else:
+        pytest.fail("the child process is still alive")
+
+
+def test_command_resolver(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    monkeypatch.setenv("PATH", str(bin_dir))
+    monkeypatch.setenv("PATHEXT", ".EXE")
+    name = "dosh-tool.exe" if platform.system() == "Windows" else "dosh-tool"
+
+    cache_path = tmp_path / "commands.json"
+    resolver = CommandResolver(revalidate_interval=0, cache_path=cache_path)
+    assert resolver.which("dosh-tool") is None
+
+    # adding a file changes the directory mtime, the result is invalidated.
+    tool = bin_dir / name
+    tool.write_text("#!/bin/sh\n")
+    tool.chmod(0o755)
+    os.utime(bin_dir, ns=(1, 1))
+    assert resolver.which("dosh-tool") == str(tool)
+    assert resolver.resolve_all(["dosh-tool", "hsab"]) == {
+        "dosh-tool": str(tool),
+        "hsab": None,
+    }
+
+    # the results are kept between runs while PATH doesn't change.
+    resolver.save()
+    assert not list(tmp_path.glob("*.tmp"))
+    resolver = CommandResolver(revalidate_interval=60, cache_path=cache_path)
+    with monkeypatch.context() as patch:
+        patch.setattr(os, "listdir", lambda path: pytest.fail("listed again"))
+        assert resolver.which("dosh-tool") == str(tool)
+        assert resolver.which("hsab") is None
+
+    # a miss is checked again before it's returned, like `shutil.which`.
+    assert resolver.which("dosh-new") is None
+    new_tool = bin_dir / name.replace("tool", "new")
+    new_tool.write_text("#!/bin/sh\n")
+    new_tool.chmod(0o755)
+    os.utime(bin_dir, ns=(2, 2))
+    assert resolver.which("dosh-new") == str(new_tool)
+
+
+def test_run_url_cache(httpserver, cache_directory):
+    sh_content = "echo Hello!"
+    sh_checksum = hashlib.sha256(sh_content.encode()).hexdigest()
+    httpserver.expect_ordered_request("/hello.sh").respond_with_data(
+        sh_content, headers={"ETag": '"v1"'}
+    )
+    httpserver.expect_ordered_request(
+        "/hello.sh", headers={"If-None-Match": '"v1"'}
+    ).respond_with_data("", status=304)
+    url = httpserver.url_for("/hello.sh")
+
+    assert cmd.run_url(url) == 0
+    assert cmd.run_url(url) == 0
+    assert (cache_directory / "http" / "blobs" / sh_checksum).exists()
+    httpserver.check_assertions()
+
+    # the pinned or recently fetched scripts don't need a request.
+    httpserver.clear()
+    assert cmd.run_url(url, lua_runtime.table_from({"sha256": sh_checksum})) == 0
+    assert cmd.run_url(url, lua_runtime.table_from({"max_age": 60})) == 0
+    assert cmd.run_url(url, lua_runtime.table_from({"offline": True})) == 0
+    assert not httpserver.log
+
+    with pytest.raises(CommandException):
+        cmd.run_url(url, lua_runtime.table_from({"offline": True, "sha256": "0" * 64}))
+
+    # a download not matching the pin isn't stored, it would never be evicted.
+    httpserver.expect_request("/other.sh").respond_with_data("echo other")
+    with pytest.raises(CommandException, match="Checksum mismatch"):
+        options = lua_runtime.table_from({"sha256": "0" * 64})
+        cmd.run_url(httpserver.url_for("/other.sh"), options)
+    assert os.listdir(cache_directory / "http" / "blobs") == [sh_checksum]
+    httpserver.clear()
+
+    with pytest.raises(CommandException):
+        cmd.run_url(
+            httpserver.url_for("/missing.sh"), lua_runtime.table_from({"offline": True})
+        )
+
+
+def test_http_cache_eviction(httpserver, tmp_path):
+    http_cache = HttpCache(tmp_path / "http", max_size=20)
+    for name in ("first", "second"):
+        httpserver.expect_request(f"/{name}").respond_with_data(name * 3)
+
+    first_path = http_cache.fetch(httpserver.url_for("/first"))
+    second_path = http_cache.fetch(httpserver.url_for("/second"))
+    assert not first_path.exists()
+    assert second_path.read_text() == "secondsecondsecond"
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="requires sh")
+def test_run_url_stream(httpserver, tmp_path):
+    marker_path = tmp_path / "started"
+
+    def handler(request):
+        def generate():
+            yield f"touch '{marker_path}'\n"
+            # the rest is sent after the first line runs.
+            deadline = time.monotonic() + 5
+            while not marker_path.exists() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            yield f"test -e '{marker_path}' && exit 3\n"
+
+        return Response(generate(), content_type="text/plain")
+
+    httpserver.expect_request("/install.sh").respond_with_handler(handler)
+    options = lua_runtime.table_from({"stream": True})
+    assert cmd.run_url(httpserver.url_for("/install.sh"), options) == 3
+
+    httpserver.expect_request("/hello.py").respond_with_data(
+        f"open({str(tmp_path / 'hello.txt')!r}, 'w').write('hello')"
+    )
+    for stream in (True, False):
+        options = lua_runtime.table_from({"stream": stream, "interpreter": "python"})
+        assert cmd.run_url(httpserver.url_for("/hello.py"), options) == 0
+        assert (tmp_path / "hello.txt").read_text() == "hello"
+        (tmp_path / "hello.txt").unlink()
+
+    with pytest.raises(CommandException):
+        options = lua_runtime.table_from({"stream": True, "sha256": "0" * 64})
+        cmd.run_url(httpserver.url_for("/hello.py"), options)
+
+
+def test_copy_incremental(tmp_path):
+    src = tmp_path / "src"
+    (src / "sub").mkdir(parents=True)
+    for index in range(20):
+        (src / "sub" / f"{index}.txt").write_text(f"file {index}")
+    dst = str(tmp_path / "dst")
+
+    stats = cmd.copy(str(src), dst)
+    assert (stats.copied, stats.skipped, stats.bytes) == (20, 0, 130)
+    assert (tmp_path / "dst" / "sub" / "7.txt").read_text() == "file 7"
+
+    stats = cmd.copy(str(src / "*"), dst)
+    assert (stats.copied, stats.skipped) == (0, 20)
+
+    # same size and a different mtime, it's copied unless checksums are equal.
+    os.utime(src / "sub" / "1.txt", ns=(0, 0))
+    (src / "sub" / "2.txt").write_text("FILE 2")
+    stats = cmd.copy(str(src / "*"), dst, lua_runtime.table_from({"hash": True}))
+    assert (stats.copied, stats.skipped, stats.bytes) == (1, 19, 6)
+    assert (tmp_path / "dst" / "sub" / "2.txt").read_text() == "FILE 2"
+    assert (tmp_path / "dst" / "sub" / "1.txt").stat().st_mtime_ns == 0
+
+    os.utime(src / "sub" / "3.txt", ns=(0, 0))
+    stats = cmd.copy(str(src / "*"), dst, lua_runtime.table_from({"jobs": 1}))
+    assert (stats.copied, stats.skipped) == (1, 19)
+
+
+def test_copy_file_data(tmp_path, monkeypatch):
+    src = tmp_path / "src.bin"
+    src.write_bytes(os.urandom(3 * 1024 * 1024 + 7))
+    dst = tmp_path / "dst.bin"
+
+    with src.open("rb") as src_file, dst.open("wb") as dst_file:
+        copy_file_data(src_file, dst_file)
+
+    assert dst.read_bytes() == src.read_bytes()
+
+    # files of procfs and sysfs look empty to the kernel copies.
+    for name in ("copy_file_range", "sendfile"):
+        if hasattr(os, name):
+            monkeypatch.setattr(os, name, lambda *args: 0)
+    with src.open("rb") as src_file, dst.open("wb") as dst_file:
+        copy_file_data(src_file, dst_file)
+
+    assert dst.read_bytes() == src.read_bytes()
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix shell scripts")
+def test_package_installs(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    log_path = tmp_path / "calls.log"
+    fake_commands = {
+        "dpkg-query": (
+            "printf 'git\\tii \\t1:2.39\\ncurl:amd64\\tii \\t7.88\\nvim\\trc \\t2:9.0\\n'"
+        ),
+        "apt": f"echo apt $@ >> '{log_path}'",
+        "brew": (
+            'if [ "$1" = list ]; then [ "$2" = --cask ] && echo firefox 1.0'
+            " || echo fd 9.0; exit 0; fi\n"
+            '[ "$1" = tap ] && [ -z "$2" ] && echo homebrew/core && exit 0\n'
+            f"echo brew $@ >> '{log_path}'"
+        ),
+        "winget": (
+            '[ "$1" = export ] && echo \'{"Sources": [{"Packages": '
+            '[{"PackageIdentifier": "Git.Git"}]}]}\' > "$3" && exit 0\n'
+            f"echo winget $@ >> '{log_path}'"
+        ),
+    }
+    for name, script in fake_commands.items():
+        (bin_dir / name).write_text(f"#!/bin/sh\n{script}\n")
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    installer = PackageInstaller()
+    monkeypatch.setattr(cmd, "get_package_installer", lambda: installer)
+
+    with installer.batch():
+        cmd.apt_install(lua_runtime.table_from(["git", "jq", "git=1:2.39"]))
+        cmd.apt_install(["curl", "jq", "vim=2:9.0", "curl=7.90"])
+        cmd.brew_install(lua_runtime.table_from(["fd", "homebrew/core/rg"]))
+        assert not log_path.exists()
+
+        # the queued installs run before a new tap.
+        options = lua_runtime.table_from(
+            {"cask": True, "taps": lua_runtime.table_from(["homebrew/core", "a/b"])}
+        )
+        cmd.brew_install(lua_runtime.table_from(["firefox", "kitty"]), options)
+
+    # the snapshot is updated, nothing left to install.
+    cmd.apt_install(["jq", "vim"])
+    cmd.brew_install(["rg"])
+
+    assert log_path.read_text().splitlines() == [
+        "apt install jq vim=2:9.0 curl=7.90",
+        "brew install homebrew/core/rg",
+        "brew tap a/b",
+        "brew install --cask kitty",
+    ]
+
+    # winget installs one package identifier per command.
+    with installer.batch():
+        cmd.winget_install(["git.git", "Foo.Bar", "Baz.Qux"])
+    assert log_path.read_text().splitlines()[-2:] == [
+        "winget install -e --id Foo.Bar",
+        "winget install -e --id Baz.Qux",
+    ]
+
+    # other commands run after the queued installs, they may use them.
+    monkeypatch.setattr(packages, "get_package_installer", lambda: installer)
+    with installer.batch():
+        COMMANDS["apt_install"](lua_runtime.table_from(["htop"]))
+        assert "htop" not in log_path.read_text()
+        COMMANDS["exists_command"]("htop")
+        assert log_path.read_text().splitlines()[-1] == "apt install htop"
+
+    # failed installs are raised, also at the end of a batch.
+    (bin_dir / "apt").write_text("#!/bin/sh\nexit 100\n")
+    with pytest.raises(CommandException, match="exit code 100"):
+        cmd.apt_install(["broken"])
+    with pytest.raises(CommandException):
+        with installer.batch():
+            cmd.apt_install(["broken"])
+
+
+def git(*args, cwd=None):
+    return subprocess.run(
+        ["git", "-c", "user.name=dosh", "-c", "user.email=dosh@localhost", *args],
+        cwd=cwd,
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.strip()
+
+
+def test_clone(tmp_path, cache_directory, monkeypatch):
+    urls = []
+    for name in ("foo", "bar"):
+        origin = tmp_path / "origin" / name
+        origin.mkdir(parents=True)
+        git("init", "--quiet", cwd=origin)
+        for index in range(2):
+            (origin / "README.md").write_text(f"{name} {index}")
+            git("add", ".", cwd=origin)
+            git("commit", "--quiet", "-m", f"commit {index}", cwd=origin)
+        urls.append(origin.as_uri())
+
+    workspace = tmp_path / "workspace"
+    workspace.mkdir()
+    monkeypatch.chdir(workspace)
+    repos = lua_runtime.table_from(
+        [urls[0], lua_runtime.table_from({"url": urls[1], "destination": "bar2"})]
+    )
+    options = {"jobs": 2, "depth": 1, "mirror": True}
+    return_codes = cmd.clone(repos, lua_runtime.table_from(options))
+
+    assert dict(return_codes) == {str(workspace / "foo"): 0, str(workspace / "bar2"): 0}
+    assert git("rev-list", "--count", "HEAD", cwd=workspace / "foo") == "1"
+    assert not (workspace / "foo" / ".git" / "objects" / "info" / "alternates").exists()
+    assert len(list((cache_directory / "git").iterdir())) == 2
+
+    # existing repositories are skipped, or fetched if it's requested.
+    git(
+        "commit",
+        "--quiet",
+        "--allow-empty",
+        "-m",
+        "new",
+        cwd=tmp_path / "origin" / "foo",
+    )
+    assert dict(cmd.clone(urls[0])) == {str(workspace / "foo"): 0}
+    assert git("rev-list", "--count", "origin/HEAD", cwd=workspace / "foo") == "1"
+
+    cmd.clone(urls[0], lua_runtime.table_from({"fetch": True}))
+    expected = git("rev-parse", "HEAD", cwd=tmp_path / "origin" / "foo")
+    assert git("rev-parse", "FETCH_HEAD", cwd=workspace / "foo") == expected
+
+
+def test_run_without_shell(monkeypatch):
+    assert get_command_args("ls -la 'a b'") == ["ls", "-la", "a b"]
+    assert get_command_args("ls -la", shell=True) is None
+    for command in ("echo $HOME", "ls > out", "a | b", "FOO=1 env", "cd /tmp"):
+        assert get_command_args(command) is None
+
+    shell_run = subprocess.run
+    shell_commands = []
+
+    def run_in_shell(command, **kwargs):
+        shell_commands.append(command)
+        return shell_run(command, **kwargs)
+
+    monkeypatch.setattr(subprocess, "run", run_in_shell)
+    assert cmd.run("true") == 0
+    assert cmd.run(lua_runtime.table_from(["sh", "-c", "exit 3"])) == 3
+    assert cmd.run(lua_runtime.table_from(["sh", "-c", "kill -TERM $$"])) == 143
+    # signals ignored by python have their defaults, a closed pipe kills.
+    assert cmd.run(lua_runtime.table_from(["sh", "-c", "kill -PIPE $$"])) == 141
+    assert shell_commands == []
+
+    options = lua_runtime.table_from({"capture": True})
+    args = lua_runtime.table_from(["echo", "a b; $c"])
+    assert cmd.run(args, options) == (0, "a b; $c\n", "")
+
+    # missing programs and forced shells run in the shell.
+    assert cmd.run(lua_runtime.table_from(["dosh-missing-command"])) == 127
+    options = lua_runtime.table_from({"shell": True})
+    assert cmd.run(lua_runtime.table_from(["exit", "5"]), options) == 5
+    assert shell_commands == ["dosh-missing-command", "exit 5"]
+
+
+def test_run_capture(capsys):
+    code, stdout, stderr = cmd.run(
+        "echo out; echo err >&2; exit 4", lua_runtime.table_from({"capture": True})
+    )
+    assert (code, stdout, stderr) == (4, "out\n", "err\n")
+
+    options = lua_runtime.table_from({"capture": True, "max_output": 10})
+    _, stdout, _ = cmd.run("seq 1 100", options)
+    assert stdout == "\n97\n98\n99\n100\n"[-10:]
+
+    collect_lines = lua_runtime.eval(
+        """
+        function (run)
+            local lines = {}
+            local code = run("printf 'a\\\\nb\\\\n'; echo c >&2", {
+                on_line = function (line, stream)
+                    table.insert(lines, stream .. ":" .. line)
+                end
+            })
+            table.sort(lines)
+            return code, table.concat(lines, ",")
+        end
+        """
+    )
+    assert collect_lines(cmd.run) == (0, "stderr:c,stdout:a,stdout:b")
+    assert capsys.readouterr().out == ""
+
+    cmd.run("echo hello", lua_runtime.table_from({"prefix": "build"}))
+    handle = cmd.spawn("echo world", lua_runtime.table_from({"prefix": "test"}))
+    cmd.wait(handle)
+    assert capsys.readouterr().out == "[build] hello\n[test] world\n"
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(5)
+    for data in (b"abc", b"defg", b"h"):
+        buffer.write(data)
+    assert (buffer.getvalue(), buffer.truncated) == (b"defgh", True)
+
+    buffer.write(b"0123456789")
+    assert buffer.getvalue() == b"56789"
+
+
+def test_download(httpserver, tmp_path):
+    data = os.urandom(100_000)
+    checksum = hashlib.sha256(data).hexdigest()
+    ranges = []
+
+    def handler(request):
+        ranges.append(request.headers.get("Range"))
+        response = Response(data, headers={"ETag": '"v1"'})
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=len(data)
+        )
+
+    httpserver.expect_request("/data.bin").respond_with_handler(handler)
+    url = httpserver.url_for("/data.bin")
+
+    # large files are downloaded in parallel ranges.
+    options = {"sha256": checksum, "segments": 4, "min_segment_size": 20_000}
+    result = cmd.download(
+        url, str(tmp_path / "data.bin"), lua_runtime.table_from(options)
+    )
+    assert (tmp_path / "data.bin").read_bytes() == data
+    assert (result["size"], result["sha256"], result["segments"]) == (
+        100_000,
+        checksum,
+        4,
+    )
+    assert sorted(filter(None, ranges)) == [
+        "bytes=0-24999",
+        "bytes=25000-49999",
+        "bytes=50000-74999",
+        "bytes=75000-99999",
+    ]
+    assert not list(tmp_path.glob("*.part*"))
+
+    # files with the expected checksum are skipped.
+    ranges.clear()
+    result = cmd.download(
+        url, str(tmp_path / "data.bin"), lua_runtime.table_from(options)
+    )
+    assert result["skipped"] and not ranges
+
+    # the progress of segments is dropped without their partial file.
+    state = {
+        "url": url,
+        "size": len(data),
+        "segments": [[0, 50_000, 10], [50_000, len(data), 0]],
+    }
+    (tmp_path / "lost.bin.part.json").write_text(json.dumps(state))
+    result = cmd.download(
+        url, str(tmp_path / "lost.bin"), lua_runtime.table_from(options)
+    )
+    assert (tmp_path / "lost.bin").read_bytes() == data
+    assert not list(tmp_path.glob("lost.bin.part*"))
+    ranges.clear()
+
+    # partial files are continued.
+    (tmp_path / "resumed.bin.part").write_bytes(data[:30_000])
+    result = cmd.download(url, str(tmp_path / "resumed.bin"))
+    assert result["resumed"] and ranges == ["bytes=30000-"]
+    assert (tmp_path / "resumed.bin").read_bytes() == data
+
+    # the list form downloads into the folder.
+    httpserver.expect_request("/small.txt").respond_with_data("small")
+    results = cmd.download(
+        lua_runtime.table_from([url, httpserver.url_for("/small.txt")]),
+        str(tmp_path / "files"),
+    )
+    assert sorted(Path(path).name for path in results.keys()) == [
+        "data.bin",
+        "small.txt",
+    ]
+    assert (tmp_path / "files" / "small.txt").read_text() == "small"
+
+    with pytest.raises(CommandException, match="Checksum mismatch"):
+        options = lua_runtime.table_from({"sha256": "0" * 64})
+        cmd.download(url, str(tmp_path / "bad.bin"), options)
+    assert not list(tmp_path.glob("bad.bin*"))
+
+    httpserver.expect_request("/missing").respond_with_data("", status=404)
+    with pytest.raises(CommandException, match="404"):
+        cmd.download(httpserver.url_for("/missing"), str(tmp_path / "missing"))
+
+
+def test_download_resumes_after_redirect(httpserver, tmp_path):
+    versions = {"a": os.urandom(1000), "b": os.urandom(1000)}
+    current = {"etag": "a", "complete": False}
+    headers = []
+
+    def handler(request):
+        headers.append((request.headers.get("Range"), request.headers.get("If-Range")))
+        data = versions[current["etag"]]
+        if not current["complete"]:
+            # the connection is closed after the first 400 bytes.
+            return Response(
+                [data[:400]],
+                headers={"Content-Length": "1000", "ETag": '"a"'},
+                direct_passthrough=True,
+            )
+        response = Response(data, headers={"ETag": f'"{current["etag"]}"'})
+        return response.make_conditional(
+            request, accept_ranges=True, complete_length=len(data)
+        )
+
+    httpserver.expect_request("/start").respond_with_data(
+        "", status=302, headers={"Location": "/real"}
+    )
+    httpserver.expect_request("/real").respond_with_handler(handler)
+    url = httpserver.url_for("/start")
+    destination = tmp_path / "data.bin"
+
+    with pytest.raises((OSError, http.client.HTTPException, CommandException)):
+        cmd.download(url, str(destination))
+    assert (tmp_path / "data.bin.part").stat().st_size == 400
+
+    # the file changed on the server, so the partial file isn't continued.
+    current.update(etag="b", complete=True)
+    headers.clear()
+    result = cmd.download(url, str(destination))
+    assert headers[0] == ("bytes=400-", '"a"')
+    assert not result["resumed"]
+    assert destination.read_bytes() == versions["b"]
+
+
+def test_download_without_ranges(httpserver, tmp_path):
+    data = b"0123456789" * 1000
+    httpserver.expect_request("/data.bin").respond_with_data(data)
+
+    # the server sends the whole file, so the partial file is replaced.
+    (tmp_path / "data.bin.part").write_bytes(b"garbage")
+    options = lua_runtime.table_from({"min_segment_size": 1000})
+    result = cmd.download(
+        httpserver.url_for("/data.bin"), str(tmp_path / "data.bin"), options
+    )
+    assert (result["resumed"], result["segments"]) == (False, 1)
+    assert (tmp_path / "data.bin").read_bytes() == data
+
+    # segments answered with the whole file fail after the restart.
+    def handler(request):
+        if request.method == "HEAD":
+            return Response(
+                headers={"Content-Length": "10000", "Accept-Ranges": "bytes"}
+            )
+        return Response(data)
+
+    httpserver.expect_request("/liar.bin").respond_with_handler(handler)
+    with pytest.raises(CommandException, match="ignored the range request"):
+        cmd.download(
+            httpserver.url_for("/liar.bin"), str(tmp_path / "liar.bin"), options
+        )
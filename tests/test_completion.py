@@ -0,0 +1,67 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+from dosh_core.completion import TaskIndex, complete
+from dosh_core.config import ConfigParser
+
+CONFIG = textwrap.dedent(
+    """
+    cmd.add_task{
+        name="build",
+        description="build the project\\nwith all the targets",
+        command=function () end
+    }
+    cmd.add_task{ name="bundle", required_platforms={ "plan9" }, command=print }
+    cmd.add_task{ name="deploy", environments={ "production" }, command=print }
+    """
+)
+
+
+def test_complete_tasks(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv("DOSH_ENV", raising=False)
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(CONFIG)
+
+    # there's no index until the config is parsed.
+    assert [name for name, _ in complete()] == ["help", "init", "version", "watch"]
+
+    ConfigParser.from_file(config_path).close()
+    assert (tmp_path / ".dosh" / "tasks.json").exists()
+    assert complete("b") == [("build", "build the project")]
+    assert complete("h") == [("help", "print this output")]
+    assert ("--config", "specify config path (default: dosh.lua)") in complete("--")
+    assert [name for name, _ in complete("-v")] == ["-v", "-vv", "-vvv"]
+
+    monkeypatch.setenv("DOSH_ENV", "production")
+    assert [name for name, _ in complete("d")] == ["deploy"]
+
+    # the index is stale when the config changes.
+    config_path.write_text(CONFIG + "-- changed\n")
+    assert TaskIndex(config_path).load() is None
+    assert complete("b") == []
+
+    ConfigParser.from_file(config_path).close()
+    assert complete("b") == [("build", "build the project")]
+
+
+def test_completion_entry_point(tmp_path):
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(CONFIG)
+    ConfigParser.from_file(config_path).close()
+
+    code = (
+        "import sys; from dosh_core.completion import main; "
+        "main(sys.argv[1:]); assert 'lupa' not in sys.modules"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code, "--descriptions", "b"],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": os.getcwd()},
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    assert result.stdout == "build\tbuild the project\n"
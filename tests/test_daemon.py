@@ -0,0 +1,83 @@
+import platform
+import subprocess
+import sys
+import textwrap
+import time
+
+import pytest
+
+from dosh_core.client import run_task
+
+pytestmark = pytest.mark.skipif(
+    platform.system() == "Windows", reason="Unix sockets and fork"
+)
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    # the path length of Unix sockets is limited, pytest paths can be long.
+    socket_path = tmp_path / "d.sock"
+    server = subprocess.Popen(
+        [sys.executable, "-m", "dosh_core.daemon", "--socket", str(socket_path)],
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while not socket_path.exists() and time.monotonic() < deadline:
+        time.sleep(0.02)
+
+    yield socket_path
+
+    server.terminate()
+    server.wait(timeout=10)
+    assert not socket_path.exists()
+
+
+def test_daemon_runs_tasks(tmp_path, socket_path, monkeypatch):
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            cmd.add_task{
+                name="hello",
+                command=function (name)
+                    cmd.run("echo hello " .. name .. " $GREETING_SUFFIX; pwd")
+                end
+            }
+            """
+        )
+    )
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+    monkeypatch.setenv("GREETING_SUFFIX", "!")
+    output_path = tmp_path / "output.txt"
+
+    def run(task_name, *params):
+        with output_path.open("w") as output:
+            exit_code = run_task(
+                config_path,
+                task_name,
+                list(params),
+                socket_path=socket_path,
+                fds=(0, output.fileno(), output.fileno()),
+            )
+        return exit_code, output_path.read_text()
+
+    assert run("hello", "dosh") == (0, f"hello dosh !\n{work_dir}\n")
+    assert run("missing")[0] == 1
+
+    # the config is parsed again after it changes.
+    config_path.write_text(
+        'cmd.add_task{name="bye", command=function () cmd.run("echo bye") end}'
+    )
+    assert run("bye") == (0, "bye\n")
+
+    # configs depending on environment variables run locally.
+    monkeypatch.setenv("DOSH_ENV", "something-else")
+    assert run("bye")[0] is None
+
+
+def test_daemon_not_running(tmp_path):
+    assert (
+        run_task(tmp_path / "dosh.lua", "hello", [], socket_path=tmp_path / "x") is None
+    )
@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+
+# cumulative import time of dosh_core.config in microseconds, it's generous to
+# be stable on slow machines. heavy modules are checked one by one below.
+IMPORT_TIME_BUDGET = int(os.getenv("DOSH_IMPORT_TIME_BUDGET", "500000"))
+
+LAZY_MODULES = [
+    "asyncio",
+    "colorlog",
+    "getpass",
+    "http.client",
+    "importlib.metadata",
+    "urllib.request",
+]
+
+
+def get_import_times(module):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    import_times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        import_times[name.strip()] = int(cumulative)
+    return import_times
+
+
+def test_import_time():
+    import_times = get_import_times("dosh_core.config")
+
+    assert import_times["dosh_core.config"] < IMPORT_TIME_BUDGET
+    assert [module for module in LAZY_MODULES if module in import_times] == []
+
+
+def test_lazy_values():
+    code = (
+        "import sys; import dosh_core, dosh_core.lua_runtime as lr; "
+        "from dosh_core.environments import ENVIRONMENTS as envs; "
+        "assert lr._default_runtime is None; "
+        "assert 'getpass' not in sys.modules; "
+        "assert envs['USER'] and 'getpass' in sys.modules; "
+        "from dosh_core.environments import CURRENT_OS, SHELL; "
+        "assert envs['IS_LINUX'] == (CURRENT_OS.value == 'linux'); "
+        "assert envs['IS_BASH'] == SHELL.endswith('bash'); "
+        "assert dosh_core.__version__; "
+        "assert lr.lua_runtime is lr.get_lua_runtime()"
+    )
+    subprocess.run([sys.executable, "-c", code], check=True)
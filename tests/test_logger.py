@@ -1,6 +1,19 @@
-from logging import DEBUG, ERROR, INFO, WARNING
+import json
+import textwrap
+import threading
+from logging import DEBUG, ERROR, INFO, WARNING, Handler, Logger
 
-from dosh_core.logger import get_logger, set_verbosity
+from dosh_core.config import ConfigParser
+from dosh_core.logger import (
+    LogWriter,
+    add_json_sink,
+    flush_logs,
+    get_log_writer,
+    get_logger,
+    get_lua_log_function,
+    set_verbosity,
+)
+from dosh_core.lua_runtime import get_lua_runtime
 
 
 def test_verbosity_level():
@@ -15,3 +28,78 @@ def test_verbosity_level():
     for verbosity_level, log_level in levels:
         set_verbosity(verbosity_level)
         assert get_logger().level == log_level
+
+
+def test_lua_log_function_is_lazy(caplog):
+    set_verbosity(2)
+    runtime = get_lua_runtime()
+    debug = get_lua_log_function(DEBUG)
+    message = runtime.eval("function () calls = (calls or 0) + 1; return 'details' end")
+
+    debug(message)
+    assert runtime.globals().calls is None
+    assert caplog.records == []
+
+    set_verbosity(3)
+    debug(message)
+    debug("%s of %s", "part", runtime.eval("'lua'"))
+    assert runtime.globals().calls == 1
+    assert [r.message for r in caplog.records] == ["details", "part of lua"]
+
+
+def test_log_writer_runs_in_background():
+    written = []
+    threads = set()
+    unblocked = threading.Event()
+
+    class BlockedHandler(Handler):
+        def emit(self, record):
+            unblocked.wait()
+            threads.add(threading.current_thread().name)
+            written.append(record.getMessage())
+
+    writer = LogWriter([BlockedHandler()])
+    logger = Logger("blocked")
+    logger.addHandler(writer)
+
+    # logging doesn't wait for the blocked handler.
+    for index in range(20):
+        logger.warning("message %s", index)
+    assert written == []
+
+    unblocked.set()
+    writer.flush()
+    assert written == [f"message {index}" for index in range(20)]
+    assert threads == {"dosh-log-writer"}
+    writer.close()
+
+
+def test_json_sink(tmp_path):
+    set_verbosity(2)
+    log_path = tmp_path / "dosh.jsonl"
+    handler = add_json_sink(log_path, level=INFO)
+    content = textwrap.dedent(
+        """
+        cmd.add_task{
+            name="hello",
+            command=function ()
+                cmd.info("hello")
+                cmd.debug("hidden")
+                cmd.run("exit 0")
+            end
+        }
+        """
+    )
+    try:
+        ConfigParser(content).run_task("hello", params=[])
+        flush_logs()
+    finally:
+        get_log_writer().handlers.remove(handler)
+        handler.close()
+
+    records = [json.loads(line) for line in log_path.read_text().splitlines()]
+    assert [(r["level"], r["message"], r.get("command")) for r in records] == [
+        ("INFO", "hello", None),
+        ("INFO", "[RUN] exit 0", "exit 0"),
+    ]
+    assert {r["task"] for r in records} == {"hello"}
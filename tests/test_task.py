@@ -1,9 +1,17 @@
+import json
+import os
 import platform
 import textwrap
+from logging import WARNING
 
+import pytest
+
+from dosh_core.artifacts import get_artifact_cache
+from dosh_core.batch import evaluate_configs
 from dosh_core.commands.base import OperatingSystem
 from dosh_core.config import ConfigParser
 from dosh_core.logger import set_verbosity
+from dosh_core.lua_runtime import LuaRuntimePool, get_lua_runtime_pool
 
 
 def test_get_current_operating_system(monkeypatch):
@@ -51,3 +59,493 @@ def test_task_if_available_on_linux(monkeypatch, caplog):
 
     assert len(caplog.records) == 2
     assert caplog.records[1].message == "hello"
+
+
+def test_config_cache(tmp_path, monkeypatch, caplog):
+    set_verbosity(2)
+    monkeypatch.setenv("DOSH_CACHE_DIR", str(tmp_path / "cache"))
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            env.HELP_DESCRIPTION = "cached config"
+            cmd.info("evaluated")
+            cmd.add_task{
+                name="hello",
+                description="say hello",
+                required_platforms={ "linux", "macos", "windows" },
+                command=function (name)
+                    cmd.info("hello " .. name)
+                end
+            }
+            """
+        )
+    )
+
+    ConfigParser.from_file(config_path)
+    assert [r.message for r in caplog.records] == ["evaluated"]
+    assert len(list((tmp_path / "cache" / "config").glob("*.json"))) == 1
+
+    # the second parse is restored from the cache without evaluating lua.
+    config_parser = ConfigParser.from_file(config_path)
+    assert len(caplog.records) == 1
+    assert config_parser.description == "cached config"
+    assert [t.name for t in config_parser.tasks] == ["hello"]
+    assert config_parser.tasks[0].required_platforms == ["linux", "macos", "windows"]
+
+    config_parser.run_task("hello", params=["dosh"])
+    assert [r.message for r in caplog.records] == [
+        "evaluated",
+        "evaluated",
+        "hello dosh",
+    ]
+
+    # changing the content invalidates the cache.
+    config_path.write_text(config_path.read_text().replace("say hello", "hi"))
+    config_parser = ConfigParser.from_file(config_path)
+    assert config_parser.tasks[0].description == "hi"
+    assert len(caplog.records) == 4
+
+
+def test_task_dependencies(caplog):
+    set_verbosity(2)
+    content = textwrap.dedent(
+        """
+        local function log(name)
+            return function () cmd.info(name) end
+        end
+
+        cmd.add_task{ name="setup", command=log("setup") }
+        cmd.add_task{ name="deps", depends_on={ "setup" }, command=log("deps") }
+        cmd.add_task{ name="assets", depends_on={ "setup" }, command=log("assets") }
+        cmd.add_task{
+            name="build",
+            depends_on={ "deps", "assets" },
+            command=function (target) cmd.info("build " .. target) end
+        }
+        """
+    )
+    config_parser = ConfigParser(content=content)
+
+    for jobs in (1, 2):
+        caplog.clear()
+        assert config_parser.run_task("build", params=["all"], jobs=jobs)
+
+        messages = [r.message for r in caplog.records]
+        assert sorted(messages) == ["assets", "build all", "deps", "setup"]
+        assert messages[0] == "setup"
+        assert messages[-1] == "build all"
+
+
+def test_worker_copies_skip_top_level_commands(tmp_path, monkeypatch, caplog):
+    set_verbosity(2)
+    monkeypatch.chdir(tmp_path)
+    content = textwrap.dedent(
+        """
+        cmd.run("echo evaluated >> top.log")
+        cmd.info("top level")
+        if cmd.exists("top.log") then
+            cmd.add_task{ name="a", command=function () cmd.run("echo a >> tasks.log") end }
+        end
+        cmd.add_task{ name="b", command=function () cmd.run("echo b >> tasks.log") end }
+        cmd.add_task{ name="all", depends_on={ "a", "b" }, command=function () end }
+        """
+    )
+    config_parser = ConfigParser(content=content)
+    assert config_parser.run_task("all", params=[], jobs=2)
+
+    # the config is evaluated once, queries still define the same tasks.
+    assert (tmp_path / "top.log").read_text() == "evaluated\n"
+    assert caplog.messages.count("top level") == 1
+    assert sorted((tmp_path / "tasks.log").read_text().split()) == ["a", "b"]
+
+
+def test_task_dependency_errors(caplog):
+    set_verbosity(2)
+    content = textwrap.dedent(
+        """
+        cmd.add_task{ name="a", depends_on={ "b" }, command=function () end }
+        cmd.add_task{ name="b", depends_on={ "a" }, command=function () end }
+        cmd.add_task{ name="fail", command=function () error("boom") end }
+        cmd.add_task{ name="slow", command=function () cmd.info("slow") end }
+        cmd.add_task{
+            name="c",
+            depends_on={ "fail", "slow" },
+            command=function () cmd.info("c") end
+        }
+        """
+    )
+    config_parser = ConfigParser(content=content)
+
+    assert not config_parser.run_task("a", params=[])
+    assert caplog.records[-1].message == "Circular task dependency: a -> b -> a"
+
+    caplog.clear()
+    assert not config_parser.run_task("c", params=[], jobs=2)
+    messages = [r.message for r in caplog.records]
+    assert any(m.startswith("The task `fail` failed:") for m in messages)
+    assert messages[-1] == "The task `c` is cancelled."
+    assert "c" not in messages
+
+
+def test_add_task_in_loop():
+    content = textwrap.dedent(
+        """
+        for i = 1, 50 do
+            cmd.add_task{ name="task" .. i, command=function () cmd.run("true") end }
+        end
+        """
+    )
+    config_parser = ConfigParser(content=content)
+    assert [t.name for t in config_parser.tasks] == [f"task{i}" for i in range(1, 51)]
+
+
+def test_task_up_to_date(tmp_path, monkeypatch, caplog):
+    set_verbosity(2)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "app.txt").write_text("v1")
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            cmd.add_task{
+                name="build",
+                inputs={ "src/*.txt" },
+                outputs={ "dist.txt" },
+                hash_inputs=true,
+                command=function ()
+                    cmd.info("building")
+                    local output = io.open("dist.txt", "w")
+                    output:write("built")
+                    output:close()
+                end
+            }
+            """
+        )
+    )
+    config_parser = ConfigParser.from_file(config_path, use_cache=False)
+
+    def run(**kwargs):
+        caplog.clear()
+        assert config_parser.run_task("build", params=[], **kwargs)
+        return [r.message for r in caplog.records if r.message.startswith("[TASK]")]
+
+    assert run() == ["[TASK] `build` runs: no previous successful run"]
+    assert (tmp_path / ".dosh" / "fingerprints.json").exists()
+    assert run() == ["[TASK] `build` is up to date, skipped."]
+    assert "building" not in caplog.messages
+
+    # touching the input doesn't matter, its content hash is the same.
+    (tmp_path / "src" / "app.txt").write_text("v1")
+    os.utime(tmp_path / "src" / "app.txt", ns=(1, 1))
+    assert run() == ["[TASK] `build` is up to date, skipped."]
+    # the new modification time is stored, so the file isn't hashed again.
+    records = json.loads((tmp_path / ".dosh" / "fingerprints.json").read_text())
+    assert records["build"]["inputs"][str(tmp_path / "src" / "app.txt")][0] == 1
+
+    (tmp_path / "src" / "app.txt").write_text("v2")
+    input_path = tmp_path / "src" / "app.txt"
+    assert run() == [f"[TASK] `build` runs: input changed: {input_path}"]
+
+    (tmp_path / "dist.txt").unlink()
+    assert run(explain=True) == ["[TASK] `build` runs: output missing: dist.txt"]
+    assert caplog.records[0].levelno == WARNING
+
+    assert run(force=True) == ["[TASK] `build` runs: forced"]
+
+    # editing the task command runs it again.
+    config_path.write_text(config_path.read_text().replace('"built"', '"rebuilt"'))
+    config_parser = ConfigParser.from_file(config_path, use_cache=False)
+    assert run() == ["[TASK] `build` runs: command changed"]
+    assert (tmp_path / "dist.txt").read_text() == "rebuilt"
+    assert run() == ["[TASK] `build` is up to date, skipped."]
+
+
+def test_task_up_to_date_with_config_cache(tmp_path, monkeypatch, caplog):
+    set_verbosity(2)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src.txt").write_text("v1")
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            cmd.add_task{
+                name="build",
+                inputs={ "src.txt" },
+                outputs={ "out.txt" },
+                command=function () cmd.write_file("out.txt", "built") end
+            }
+            """
+        )
+    )
+
+    def run(use_cache):
+        caplog.clear()
+        with ConfigParser.from_file(config_path, use_cache=use_cache) as parser:
+            assert parser.run_task("build", params=[])
+        return [r.message for r in caplog.records if r.message.startswith("[TASK]")]
+
+    # the cold, warm and uncached parses have the same command checksum.
+    assert run(True) == ["[TASK] `build` runs: no previous successful run"]
+    assert run(True) == ["[TASK] `build` is up to date, skipped."]
+    assert run(False) == ["[TASK] `build` is up to date, skipped."]
+
+
+def test_check_required_commands():
+    content = textwrap.dedent(
+        """
+        cmd.add_task{ name="a", required_commands={ "python" }, command=function () end }
+        cmd.add_task{ name="b", required_commands={ "hsab", "python" }, command=function () end }
+        """
+    )
+    config_parser = ConfigParser(content=content)
+    assert config_parser.check_required_commands() == {"b": ["hsab"]}
+
+
+def test_parsers_have_own_runtimes(caplog):
+    set_verbosity(2)
+    content = textwrap.dedent(
+        """
+        name = "%s"
+        cmd.add_task{
+            name="hello",
+            command=function () cmd.info("hello " .. name) end
+        }
+        """
+    )
+    first = ConfigParser(content % "first")
+    second = ConfigParser(content % "second")
+
+    first.run_task("hello", params=[])
+    second.run_task("hello", params=[])
+    assert [r.message for r in caplog.records] == ["hello first", "hello second"]
+
+    pool = get_lua_runtime_pool()
+    idle = len(pool)
+    with second:
+        pass
+    assert second.tasks == [] and second.description == first.description
+    assert len(pool) == min(idle + 1, pool.max_size)
+    first.close()
+
+
+def test_lua_runtime_pool():
+    pool = LuaRuntimePool(max_size=1)
+    runtime = pool.acquire()
+    runtime.execute("value = {1, 2, 3}")
+    pool.release(runtime)
+
+    with pool.runtime() as reused:
+        assert reused is runtime
+        assert reused.eval("value") is None
+        assert reused.eval("string.upper('ok')") == "OK"
+        assert len(pool) == 0
+    assert len(pool) == 1
+
+    pool = LuaRuntimePool(max_memory=0)
+    pool.release(pool.acquire())
+    assert len(pool) == 0
+
+
+def test_evaluate_configs(tmp_path):
+    config_paths = []
+    for index in range(12):
+        config_path = tmp_path / f"dosh_{index}.lua"
+        config_path.write_text(
+            f'cmd.add_task{{ name="task_{index}", command=function () end }}'
+        )
+        config_paths.append(config_path)
+    config_paths[5].write_text("cmd.add_task{")
+
+    for use_processes in (False, True):
+        summaries = list(
+            evaluate_configs(config_paths, jobs=4, use_processes=use_processes)
+        )
+        assert [s.config_path for s in summaries] == config_paths
+        assert summaries[5].error and summaries[5].tasks == []
+        assert [s.task_names for s in summaries if not s.error] == [
+            [f"task_{index}"] for index in range(12) if index != 5
+        ]
+
+
+def test_include_and_require(tmp_path, monkeypatch, caplog, cache_directory):
+    set_verbosity(2)
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "lib" / "text").mkdir(parents=True)
+    (tmp_path / "lib" / "text" / "init.lua").write_text(
+        "return { name = ..., upper = string.upper }"
+    )
+    (tmp_path / "helpers.lua").write_text(
+        textwrap.dedent(
+            """
+            loads = (loads or 0) + 1
+            return { greet = function (name) cmd.info("hello " .. name) end }
+            """
+        )
+    )
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            local text = require("lib.text")
+            local helpers = cmd.include("helpers.lua")
+            assert(helpers == cmd.include("helpers"))
+            cmd.add_task{
+                name="hello",
+                command=function ()
+                    helpers.greet(text.upper(text.name) .. " " .. tostring(loads))
+                end
+            }
+            """
+        )
+    )
+
+    ConfigParser.from_file(config_path).run_task("hello", params=[])
+    assert caplog.records[-1].message == "hello LIB.TEXT 1"
+    assert len(list((cache_directory / "lua").glob("*.luac"))) == 2
+
+    # the cached task list is used until an included module changes.
+    assert ConfigParser.from_file(config_path)._is_evaluated is False
+    (tmp_path / "helpers.lua").write_text(
+        'return { greet = function (name) cmd.info("hi " .. name) end }'
+    )
+    parser = ConfigParser.from_file(config_path)
+    assert parser._is_evaluated is True
+    parser.run_task("hello", params=[])
+    assert caplog.records[-1].message == "hi LIB.TEXT nil"
+
+
+def test_artifact_cache(tmp_path, monkeypatch, caplog):
+    set_verbosity(2)
+    content = textwrap.dedent(
+        """
+        cmd.add_task{
+            name="build",
+            inputs={ "src/*.txt" },
+            outputs={ "dist/app.txt" },
+            cache=true,
+            cache_env={ "BUILD_MODE" },
+            command=function ()
+                cmd.info("building")
+                local source = io.open("src/app.txt"):read("a")
+                os.execute("mkdir -p dist")
+                local output = io.open("dist/app.txt", "w")
+                output:write(source .. " built")
+                output:close()
+            end
+        }
+        """
+    )
+
+    def run(checkout, source):
+        (checkout / "src").mkdir(parents=True, exist_ok=True)
+        (checkout / "src" / "app.txt").write_text(source)
+        (checkout / "dosh.lua").write_text(content)
+        monkeypatch.chdir(checkout)
+        caplog.clear()
+        with ConfigParser.from_file(checkout / "dosh.lua", use_cache=False) as parser:
+            assert parser.run_task("build", params=[])
+        assert (checkout / "dist" / "app.txt").read_text() == f"{source} built"
+        return "building" in caplog.messages
+
+    # another checkout restores the outputs without running the command.
+    assert run(tmp_path / "first", "v1")
+    assert not run(tmp_path / "second", "v1")
+    assert "[TASK] `build` is restored from the artifact cache." in caplog.messages
+    assert os.stat(tmp_path / "second" / "dist" / "app.txt").st_nlink > 1
+
+    # a restored output is replaced with a copy before the command writes it.
+    assert run(tmp_path / "second", "v2")
+    monkeypatch.setenv("BUILD_MODE", "release")
+    assert run(tmp_path / "second", "v2")
+
+    cache = get_artifact_cache()
+    stats = cache.get_stats()
+    assert (stats.hits, stats.misses, stats.stores) == (1, 3, 3)
+    assert (stats.entries, stats.size) == (3, len("v1 built") + 2 * len("v2 built"))
+
+    # the least recently used entries are evicted.
+    cache.max_size = len("v2 built")
+    assert cache.evict() == 2
+    monkeypatch.delenv("BUILD_MODE")
+    assert run(tmp_path / "first", "v2")
+    assert cache.get_stats().evictions == 2
+
+
+def test_artifact_key_of_cached_config(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src.txt").write_text("v1")
+    config_path = tmp_path / "dosh.lua"
+    template = textwrap.dedent(
+        """
+        cmd.add_task{
+            name="build",
+            inputs={ "src.txt" },
+            outputs={ "out.txt" },
+            cache=true,
+            command=function ()
+                cmd.write_file("out.txt", "%s")
+            end
+        }
+        """
+    )
+
+    def get_key(output):
+        config_path.write_text(template % output)
+        with ConfigParser.from_file(config_path) as parser:
+            task = parser._find_task("build")
+            command_hash = parser._get_command_hash(task)
+            key = get_artifact_cache().get_key(task, [], command_hash)
+            return key, parser._is_evaluated
+
+    # the restored task has the command checksum of the cold parse.
+    cold_key, is_evaluated = get_key("built by A")
+    assert is_evaluated
+    assert get_key("built by A") == (cold_key, False)
+
+    get_key("built by B")
+    other_key, is_evaluated = get_key("built by B")
+    assert not is_evaluated
+    assert other_key != cold_key
+
+    # a warm config doesn't restore the outputs of another command.
+    for output in ("built by A", "built by B"):
+        config_path.write_text(template % output)
+        (tmp_path / "out.txt").unlink(missing_ok=True)
+        with ConfigParser.from_file(config_path) as parser:
+            assert parser.run_task("build", params=[])
+        assert (tmp_path / "out.txt").read_text() == output
+
+
+@pytest.mark.skipif(platform.system() == "Windows", reason="posix shell scripts")
+def test_failed_install_fails_task(tmp_path, monkeypatch, caplog):
+    monkeypatch.chdir(tmp_path)
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    for name, script in (("dpkg-query", "exit 0"), ("apt", "exit 100")):
+        (bin_dir / name).write_text(f"#!/bin/sh\n{script}\n")
+        (bin_dir / name).chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            cmd.add_task{
+                name="setup",
+                outputs={ "setup.txt" },
+                command=function ()
+                    cmd.write_file("setup.txt", "done")
+                    cmd.apt_install{ "jq" }
+                end
+            }
+            """
+        )
+    )
+    config_parser = ConfigParser.from_file(config_path, use_cache=False)
+
+    # the install is queued, it fails when the task ends.
+    assert not config_parser.run_task("setup", params=[])
+    assert "exit code 100" in caplog.text
+    assert not (tmp_path / ".dosh" / "fingerprints.json").exists()
@@ -0,0 +1,63 @@
+import json
+import textwrap
+
+from dosh_core import tracing
+from dosh_core.config import ConfigParser
+from dosh_core.tracing import Tracer
+
+
+def test_tracer_disabled():
+    tracer = Tracer()
+    with tracer.span("noop"):
+        tracer.annotate(bytes=1)
+    assert tracer.spans == []
+
+
+def test_tracer_records_tasks_and_commands(tmp_path, monkeypatch):
+    tracer = Tracer(enabled=True)
+    monkeypatch.setattr(tracing, "__TRACER", tracer)
+
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src" / "data.txt").write_text("x" * 100)
+    content = textwrap.dedent(
+        f"""
+        cmd.add_task{{
+            name="build",
+            command=function ()
+                cmd.run("true")
+                cmd.copy("{tmp_path / "src"}", "{tmp_path / "dst"}")
+            end
+        }}
+        """
+    )
+    ConfigParser(content).run_task("build", [])
+
+    names = [span.name for span in tracer.spans]
+    assert names == ["evaluate config", "cmd.run", "cmd.copy", "task build"]
+
+    copy_span = tracer.spans[2]
+    assert copy_span.args["bytes"] == 100
+    assert copy_span.args["copied"] == 1
+
+    task_span = tracer.spans[3]
+    assert task_span.start_ns <= tracer.spans[1].start_ns
+    assert task_span.duration_ns >= copy_span.duration_ns
+
+    trace_path = tmp_path / "trace.json"
+    tracer.export_chrome_trace(trace_path)
+    events = json.loads(trace_path.read_text())["traceEvents"]
+    assert [event["name"] for event in events][0] == "evaluate config"
+    assert {event["ph"] for event in events} == {"X"}
+
+    summary = tracer.format_summary(limit=2).splitlines()
+    assert summary[0].split() == [
+        "STEP",
+        "WALL",
+        "ms",
+        "CPU",
+        "ms",
+        "CHILD",
+        "ms",
+        "BYTES",
+    ]
+    assert len(summary) == 3
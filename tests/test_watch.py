@@ -0,0 +1,176 @@
+import os
+import textwrap
+import threading
+import time
+
+import pytest
+
+from dosh_core.watcher import TaskWatcher, WatchTarget
+
+CONFIG = textwrap.dedent(
+    """
+    cmd.add_task{
+        name="build",
+        watch={ "src/*.txt" },
+        command=function ()
+            local source = io.open("src/mode.txt"):read("a")
+            local output = io.open("out.txt", "a")
+            output:write(source .. " start\\n")
+            output:flush()
+            if source == "slow" then
+                os.execute("sleep 5")
+            end
+            output:write(source .. " done\\n")
+            output:close()
+        end
+    }
+    """
+)
+
+
+def read_lines(path):
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def wait_for_line(path, line, timeout=10):
+    deadline = time.monotonic() + timeout
+    while line not in read_lines(path):
+        assert time.monotonic() < deadline, f"`{line}` isn't written"
+        time.sleep(0.05)
+
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def watch_in_background(watcher, max_runs, change):
+    timer = threading.Timer(20, watcher.stop)
+    thread = threading.Thread(target=change, daemon=True)
+    timer.start()
+    thread.start()
+    try:
+        watcher.run(max_runs=max_runs)
+    finally:
+        timer.cancel()
+        thread.join()
+
+
+def test_watch_target(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src").mkdir()
+
+    target = WatchTarget.from_pattern("src/**/*.py")
+    assert target.root == tmp_path / "src"
+    assert target.matches(tmp_path / "src/a/b.py")
+    assert not target.matches(tmp_path / "src/a/b.txt")
+    assert not target.matches(tmp_path / "other/b.py")
+
+    target = WatchTarget.from_pattern("src")
+    assert target.matches(tmp_path / "src/a/b.txt")
+
+    target = WatchTarget.from_pattern("dosh.lua")
+    assert target.matches(tmp_path / "dosh.lua")
+    assert not target.matches(tmp_path / "dosh.lua.bak")
+
+
+@pytest.mark.parametrize("use_polling", [False, True])
+def test_watch_runs_task_again(tmp_path, monkeypatch, use_polling):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src/mode.txt").write_text("first")
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(CONFIG)
+    output = tmp_path / "out.txt"
+
+    def change():
+        wait_for_line(output, "first done")
+        (tmp_path / "src/mode.txt").write_text("second")
+        wait_for_line(output, "second done")
+        # the config is evaluated again if it changes.
+        config_path.write_text(CONFIG.replace(" done", " finished"))
+
+    watcher = TaskWatcher(config_path, "build", debounce=0.1, use_polling=use_polling)
+    watch_in_background(watcher, 3, change)
+
+    assert read_lines(output) == [
+        "first start",
+        "first done",
+        "second start",
+        "second done",
+        "second start",
+        "second finished",
+    ]
+
+
+def test_watch_cancels_running_task(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src/mode.txt").write_text("slow")
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(CONFIG)
+    output = tmp_path / "out.txt"
+
+    def change():
+        wait_for_line(output, "slow start")
+        (tmp_path / "src/mode.txt").write_text("fast")
+
+    started = time.monotonic()
+    watcher = TaskWatcher(config_path, "build", debounce=0.1)
+    watch_in_background(watcher, 2, change)
+
+    assert read_lines(output) == ["slow start", "fast start", "fast done"]
+    assert time.monotonic() - started < 5
+
+
+def test_watch_cancels_spawned_processes(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "src").mkdir()
+    (tmp_path / "src/mode.txt").write_text("serve")
+    config_path = tmp_path / "dosh.lua"
+    config_path.write_text(
+        textwrap.dedent(
+            """
+            cmd.add_task{
+                name="serve",
+                watch={ "src/*.txt" },
+                command=function ()
+                    local mode = io.open("src/mode.txt"):read("a")
+                    if mode == "serve" then
+                        local server = cmd.spawn("echo $$ > server.pid; exec sleep 30")
+                        cmd.wait(server)
+                    end
+                end
+            }
+            """
+        )
+    )
+    pid_path = tmp_path / "server.pid"
+
+    def change():
+        deadline = time.monotonic() + 10
+        while not pid_path.exists() or not pid_path.read_text().strip():
+            assert time.monotonic() < deadline, "the server isn't started"
+            time.sleep(0.05)
+        (tmp_path / "src/mode.txt").write_text("stop")
+
+    watcher = TaskWatcher(config_path, "serve", debounce=0.1)
+    watch_in_background(watcher, 2, change)
+
+    # the spawned process is in its own session, it's terminated too.
+    pid = int(pid_path.read_text())
+    deadline = time.monotonic() + 5
+    while is_running(pid):
+        assert time.monotonic() < deadline, "the spawned process is running"
+        time.sleep(0.05)
+
+
+def test_watch_ignores_dosh_directory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    target = WatchTarget.from_pattern(".")
+    assert target.matches(tmp_path / "src/app.txt")
+    assert not target.matches(tmp_path / ".dosh/fingerprints.json")
+    assert not target.matches(tmp_path / "src/.dosh/tasks.json")